@@ -0,0 +1,143 @@
+import json
+import logging
+import random
+import time
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger("backend_django.requests")
+
+
+class QueryTimer:
+    """
+    Database execute wrapper counting the queries run through it and the
+    time they took
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+class RequestTiming:
+    # the timings of one request, kept on the request while it is handled
+
+    def __init__(self):
+        self.queries = QueryTimer()
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.view_ended = None
+        self.view_db = 0.0
+        self.rendered = None
+
+    def end_view(self):
+        if self.view_ended is None:
+            self.view_ended = time.perf_counter()
+            self.view_db = self.queries.duration
+
+    def end_render(self, response):
+        self.rendered = time.perf_counter()
+        return response
+
+    def get_metrics(self):
+        """
+        The durations in milliseconds. `serialize` is the time spent in the
+        view outside of the database, which in an API view is mostly
+        querying the ORM and serializing the result.
+        """
+        ended = time.perf_counter()
+        view = (self.view_ended - self.view_started) if self.view_started and self.view_ended else 0.0
+        return {
+            "queries" : self.queries.count,
+            "db" : self.queries.duration * 1000,
+            "serialize" : max(view - self.view_db, 0.0) * 1000,
+            "render" : (self.rendered - self.view_ended) * 1000 if self.rendered else 0.0,
+            "total" : (ended - self.started) * 1000,
+        }
+
+
+class RequestTimingMiddleware:
+    """
+    Measures the number of queries, the database time, the serializer time
+    and the render time of a sample of the requests. They are sent back in
+    a Server-Timing header and logged as a JSON line tagged with the name
+    of the URL, to the "backend_django.requests" logger.
+
+    Configured by the REQUEST_TIMING setting:
+      SAMPLE_RATE           the fraction of requests measured, 0 to 1
+      SLOW_REQUEST_MS       requests left out of the sample that take
+                            longer than this are still logged with their
+                            total time. None to turn this off
+      SERVER_TIMING_HEADER  whether the measured requests get the header
+
+    Queries run while a streaming response is consumed come after the
+    response leaves the middleware, so they aren't counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = getattr(settings, "REQUEST_TIMING", {})
+        self.sample_rate = options.get("SAMPLE_RATE", 1.0)
+        self.slow_request_ms = options.get("SLOW_REQUEST_MS", None)
+        self.server_timing_header = options.get("SERVER_TIMING_HEADER", True)
+
+    def __call__(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            # the requests left out only pay for reading the clock
+            started = time.perf_counter()
+            response = self.get_response(request)
+            total = (time.perf_counter() - started) * 1000
+            if self.slow_request_ms is not None and total >= self.slow_request_ms:
+                self.log(request, response, {"total" : total}, sampled=False)
+            return response
+
+        timing = request.timing = RequestTiming()
+        with connection.execute_wrapper(timing.queries):
+            response = self.get_response(request)
+        timing.end_view()
+
+        metrics = timing.get_metrics()
+        if self.server_timing_header:
+            response["Server-Timing"] = ", ".join([
+                f'db;dur={metrics["db"]:.1f};desc="{metrics["queries"]} queries"',
+                f'serialize;dur={metrics["serialize"]:.1f}',
+                f'render;dur={metrics["render"]:.1f}',
+                f'total;dur={metrics["total"]:.1f}',
+            ])
+        self.log(request, response, metrics, sampled=True)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timing = getattr(request, "timing", None)
+        if timing is not None:
+            timing.view_started = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns, the callback
+        # runs once they are
+        timing = getattr(request, "timing", None)
+        if timing is not None:
+            timing.end_view()
+            response.add_post_render_callback(timing.end_render)
+        return response
+
+    def log(self, request, response, metrics, sampled):
+        match = request.resolver_match
+        record = {
+            "url_name" : match.url_name if match and match.url_name else None,
+            "method" : request.method,
+            "path" : request.path,
+            "status" : response.status_code,
+            "sampled" : sampled,
+            **{name : round(value, 2) for name, value in metrics.items()},
+        }
+        logger.info(json.dumps(record), extra={"timing" : record})
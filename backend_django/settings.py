@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend_django.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
@@ -142,8 +143,10 @@ DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 # Rest framework config
 REST_FRAMEWORK = {
+    # the same JSON as rest_framework.renderers.JSONRenderer, encoded with
+    # orjson when it is installed
     'DEFAULT_RENDERER_CLASSES': (
-        'rest_framework.renderers.JSONRenderer',
+        'backend_django.renderers.FastJSONRenderer',
     ),
     'DEFAULT_PARSER_CLASSES': (
         'rest_framework.parsers.JSONParser',
@@ -157,6 +160,98 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME' : timedelta(days = 15)
 }
 
+# shoe catalog listing
+SHOE_LIST_PAGE_SIZE = 24
+SHOE_LIST_MAX_PAGE_SIZE = 100
+
+# shoes read per query by the streaming catalog export
+SHOE_EXPORT_CHUNK_SIZE = 500
+
+# upper bounds of the price buckets counted by the shoe facets
+SHOE_PRICE_BUCKETS = [50, 100, 150, 200]
+
+# the in-process shoe search index is rebuilt at least this often (seconds).
+# catalog changes are announced through a version kept in the default cache,
+# which without CACHES is local to each process: the other workers then only
+# see a change once their index is older than this. configure a shared
+# default cache (redis, memcached) for every worker to see it on the next
+# search
+SHOE_SEARCH_INDEX_TTL = 300
+
+# how long each worker keeps its shoe size name -> id map (seconds)
+SHOE_SIZE_LOOKUP_TTL = 300
+
+# response cache of the shoe list. "shoes.cache.DjangoCacheBackend" stores
+# it in CACHES[OPTIONS["ALIAS"]] instead, shared between workers.
+# set BACKEND to None to turn it off
+SHOE_LIST_CACHE = {
+    "BACKEND" : "shoes.cache.LocalMemoryBackend",
+    "TIMEOUT" : 60,
+    "OPTIONS" : {
+        "MAX_ENTRIES" : 512,
+    },
+}
+
+# the responsive sizes made of every shoe image, listed in its srcset. the
+# encoder options of each format are passed to Pillow, "avif" can be added
+# with a Pillow that writes AVIF. JPEG are the options of the medium and
+# thumbnail sizes of JPEG images
+SHOE_IMAGE_DERIVATIVES = {
+    "WIDTHS" : [320, 640, 960, 1280],
+    "FORMATS" : {
+        "webp" : {"quality" : 80, "method" : 6},
+    },
+    "JPEG" : {"quality" : 85, "optimize" : True, "progressive" : True},
+}
+
+# the image sizes made on request by shoes/images/<id>/resized/ and the
+# on-disk cache they are kept in, least recently used evicted past MAX_BYTES
+SHOE_IMAGE_RESIZE = {
+    "CACHE_DIR" : os.path.join(BASE_DIR, "image_cache"),
+    "MAX_BYTES" : 512 * 1024 * 1024,
+    # the widths asked for are rounded up to the next of these
+    "WIDTHS" : [64, 128, 160, 240, 320, 480, 640, 800, 960, 1280, 1600, 2000],
+    # "avif" is only served by a Pillow that writes it
+    "FORMATS" : ["webp", "avif", "jpeg", "png"],
+    # seconds, for requests naming the image version with ?v= and without
+    "MAX_AGE" : 365 * 24 * 60 * 60,
+    "UNVERSIONED_MAX_AGE" : 60 * 60,
+}
+
+# the workers making the medium and thumbnail images of uploads, started
+# with `manage.py process_image_jobs`
+IMAGE_JOBS = {
+    # defaults to the number of CPUs
+    "PROCESSES" : None,
+    # jobs claimed at a time
+    "BATCH_SIZE" : 20,
+    # seconds between checks of an empty queue
+    "POLL_INTERVAL" : 2,
+    "MAX_ATTEMPTS" : 5,
+    # seconds before a failed job is retried, doubled after each attempt
+    "RETRY_DELAY" : 30,
+    # jobs running for longer (seconds) are assumed lost and queued again
+    "RUNNING_TIMEOUT" : 600,
+}
+
+# query count and timing of each request, see backend_django.middleware
+REQUEST_TIMING = {
+    "SAMPLE_RATE" : float(os.environ.get("REQUEST_TIMING_SAMPLE_RATE", 1.0)),
+    "SLOW_REQUEST_MS" : 1000,
+    "SERVER_TIMING_HEADER" : True,
+}
+
+LOGGING = {
+    "version" : 1,
+    "disable_existing_loggers" : False,
+    "handlers" : {
+        "console" : {"class" : "logging.StreamHandler"},
+    },
+    "loggers" : {
+        "backend_django.requests" : {"handlers" : ["console"], "level" : "INFO", "propagate" : False},
+    },
+}
+
 STRIPE_SECRET_KEY = os.environ.get("STRIPE_SECRET_KEY")
 
 STRIPE_ENDPOINT_SECRET = os.environ.get("STRIPE_ENDPOINT_SECRET")
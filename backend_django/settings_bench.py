@@ -0,0 +1,49 @@
+"""
+Settings for seeding and benchmarking a throwaway copy of the store:
+
+    DJANGO_SETTINGS_MODULE=backend_django.settings_bench python manage.py migrate
+    DJANGO_SETTINGS_MODULE=backend_django.settings_bench python manage.py seed_catalog --shoes 5000
+    DJANGO_SETTINGS_MODULE=backend_django.settings_bench python manage.py benchmark_endpoints --output bench.json
+
+BENCH_DB=sqlite (the default) keeps the data in bench.sqlite3. BENCH_DB=mysql
+uses a MySQL server such as one started with
+
+    docker run -d -p 3307:3306 -e MYSQL_ROOT_PASSWORD=bench -e MYSQL_DATABASE=shoe_store_bench mysql:8
+
+configured through the BENCH_DB_* variables below.
+"""
+from .settings import *
+
+# the seeding and benchmark commands refuse to run against other settings
+BENCHMARK = True
+
+SECRET_KEY = SECRET_KEY or "benchmark"
+DEBUG = False
+
+if os.environ.get("BENCH_DB", "sqlite") == "mysql":
+    DATABASES = {
+        'default': {
+            'ENGINE' : 'django.db.backends.mysql',
+            'NAME' : os.environ.get('BENCH_DB_NAME', 'shoe_store_bench'),
+            'USER' : os.environ.get('BENCH_DB_USER', 'root'),
+            'PASSWORD' : os.environ.get('BENCH_DB_PASSWORD', 'bench'),
+            'HOST' : os.environ.get("BENCH_DB_HOST", '127.0.0.1'),
+            'PORT' : os.environ.get("BENCH_DB_PORT", '3307'),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('BENCH_DB_NAME', BASE_DIR / 'bench.sqlite3'),
+        }
+    }
+
+MEDIA_ROOT = os.path.join(BASE_DIR, 'bench_media')
+
+# the webhook is benchmarked with events signed with this secret
+STRIPE_ENDPOINT_SECRET = "whsec_benchmark"
+
+# the benchmark counts queries itself, and logging every request would be
+# timed along with it
+REQUEST_TIMING = {**REQUEST_TIMING, "SAMPLE_RATE" : 0, "SLOW_REQUEST_MS" : None}
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+def new_counter():
+    # counters start from the clock rather than 0 so a counter that was
+    # lost (evicted, restarted) never comes back with a value seen before
+    return time.time_ns()
+
+
+class LocalMemoryBackend:
+    """
+    Process-local store with a TTL on every entry and least recently used
+    eviction past MAX_ENTRIES. Counters are kept apart from the entries so
+    they are never evicted.
+    """
+
+    def __init__(self, MAX_ENTRIES=512, **options):
+        self.max_entries = MAX_ENTRIES
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        expires = time.monotonic() + timeout if timeout is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_counters(self, keys):
+        with self.lock:
+            return {key : self.counters.setdefault(key, new_counter()) for key in keys}
+
+    def incr_counter(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, new_counter()) + 1
+
+
+class DjangoCacheBackend:
+    """
+    Stores entries in one of the CACHES, so that a shared cache (memcached,
+    redis, database) serves and invalidates every worker at once
+    """
+
+    def __init__(self, ALIAS="default", **options):
+        self.cache = caches[ALIAS]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, timeout)
+
+    def get_counters(self, keys):
+        counters = self.cache.get_many(keys)
+        for key in keys:
+            if key not in counters:
+                self.cache.add(key, new_counter(), None)
+                counters[key] = self.cache.get(key)
+        return counters
+
+    def incr_counter(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, new_counter(), None)
+
+
+class ResponseCache:
+    """
+    Caches the shoe list responses by their normalized query params.
+
+    Each entry records the cache generation and the version of every shoe
+    it contains. Writes that can change which shoes match a filter or in
+    what order bump the generation, dropping every entry; writes that only
+    change how a shoe is shown bump that shoe's version, dropping only the
+    entries that contain it.
+    """
+    generation_key = "shoes:list:generation"
+    list_params = ["categories", "sizes", "fields", "expand"]
+    number_params = ["price_min", "price_max", "page_size"]
+    text_params = ["q", "order", "cursor"]
+
+    def __init__(self, backend, timeout):
+        self.backend = backend
+        self.timeout = timeout
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, "SHOE_LIST_CACHE", {})
+        backend = options.get("BACKEND", "shoes.cache.LocalMemoryBackend")
+        if not backend:
+            return None
+        backend = import_string(backend)(**options.get("OPTIONS", {}))
+        return cls(backend, options.get("TIMEOUT", 60))
+
+    def get_key(self, request):
+        params = request.GET
+        normalized = {"host" : request.get_host()}
+        for param in self.list_params:
+            if params.get(param):
+                normalized[param] = sorted(set(value.strip() for value in params[param].split(",")))
+        for param in self.number_params:
+            try:
+                normalized[param] = float(params[param])
+            except (KeyError, ValueError):
+                pass
+        for param in self.text_params:
+            if params.get(param):
+                normalized[param] = " ".join(params[param].split())
+        if "q" in normalized:
+            normalized["q"] = normalized["q"].lower()
+
+        digest = hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+        return f"shoes:list:{digest}"
+
+    @staticmethod
+    def get_shoe_key(shoe_id):
+        return f"shoes:list:shoe:{shoe_id}"
+
+    def get(self, request):
+        entry = self.backend.get(self.get_key(request))
+        if entry is None:
+            return None
+
+        shoe_keys = [self.get_shoe_key(shoe_id) for shoe_id in entry["versions"]]
+        counters = self.backend.get_counters([self.generation_key] + shoe_keys)
+        if counters[self.generation_key] != entry["generation"]:
+            return None
+        for shoe_id, version in entry["versions"].items():
+            if counters[self.get_shoe_key(shoe_id)] != version:
+                return None
+        return entry["data"]
+
+    def get_generation(self):
+        return self.backend.get_counters([self.generation_key])[self.generation_key]
+
+    def get_versions(self, shoe_ids):
+        """
+        The versions of `shoe_ids`, read as soon as their rows are fetched
+        and before the response is built from them
+        """
+        shoe_keys = {shoe_id : self.get_shoe_key(shoe_id) for shoe_id in shoe_ids}
+        counters = self.backend.get_counters(list(shoe_keys.values()))
+        return {shoe_id : counters[key] for shoe_id, key in shoe_keys.items()}
+
+    def set(self, request, data, versions, generation):
+        """
+        Stores the response `data` listing the shoes of `versions`, see
+        get_versions. `generation` must be read before the shoes are
+        queried, so that a write committing while the response is built
+        leaves the entry already stale. The counters are bumped when writes
+        commit, see shoes.signals, and a response some of them were bumped
+        for while it was built isn't stored.
+        """
+        shoe_keys = {shoe_id : self.get_shoe_key(shoe_id) for shoe_id in versions}
+        counters = self.backend.get_counters([self.generation_key] + list(shoe_keys.values()))
+        if counters[self.generation_key] != generation:
+            return
+        if any(counters[key] != versions[shoe_id] for shoe_id, key in shoe_keys.items()):
+            return
+        entry = {
+            "generation" : generation,
+            "versions" : versions,
+            "data" : data,
+        }
+        self.backend.set(self.get_key(request), entry, self.timeout)
+
+    def invalidate_all(self):
+        self.backend.incr_counter(self.generation_key)
+
+    def invalidate_shoe(self, shoe_id):
+        self.backend.incr_counter(self.get_shoe_key(shoe_id))
+
+
+_list_cache = None
+_list_cache_lock = threading.Lock()
+
+def get_list_cache():
+    """
+    The shoe list response cache configured by SHOE_LIST_CACHE, or None
+    when it is turned off
+    """
+    global _list_cache
+    if _list_cache is None:
+        with _list_cache_lock:
+            if _list_cache is None:
+                _list_cache = ResponseCache.from_settings() or False
+    return _list_cache or None
+
+def reset_list_cache():
+    """
+    Makes the next get_list_cache() read SHOE_LIST_CACHE again
+    """
+    global _list_cache
+    with _list_cache_lock:
+        _list_cache = None
@@ -0,0 +1,52 @@
+import threading
+
+from .models import Category, ChangeStamp
+from .serializers import ParentCategoryListSerializer
+
+
+class CategoryTree:
+    """
+    Process-local copy of the category tree.
+
+    It is only reloaded when the "categories" change stamp moves, which
+    every Category write bumps, so all workers see a write on their next
+    read for the cost of one primary key lookup.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.nodes = {}
+        self.serialized = []
+
+    def get_version(self):
+        stamp = ChangeStamp.objects.read(["categories"]).get("categories")
+        return stamp.version if stamp else 0
+
+    def load(self):
+        version = self.get_version()
+        if version == self.version:
+            return self
+        with self.lock:
+            if version != self.version:
+                roots = Category.objects.filter(parent_id = None).prefetch_related("children")
+                serialized = ParentCategoryListSerializer(roots, many=True).data
+                nodes = {category["id"] : category for category in Category.objects.values("id", "name", "parent_id")}
+                self.nodes, self.serialized, self.version = nodes, serialized, version
+        return self
+
+    def get_serialized(self):
+        """
+        The top level categories with their children, as served by
+        CategoryListView
+        """
+        return self.load().serialized
+
+    def get_nodes(self):
+        """
+        {id : {"id", "name", "parent_id"}} of every category
+        """
+        return self.load().nodes
+
+
+category_tree = CategoryTree()
@@ -0,0 +1,106 @@
+import atexit
+import logging
+import queue
+import threading
+from functools import partial
+from django.apps import apps
+from django.db import connections, models, transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_file_fields():
+    # (model, field) of every file field of the project
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, models.FileField):
+                yield model, field
+
+def get_referenced_names(names=None, batch_size=500):
+    """
+    The file names rows refer to, and the default files of the fields.
+    With `names` only those of them are looked up.
+    """
+    referenced = set()
+    names = list(names) if names is not None else None
+    for model, field in get_file_fields():
+        if isinstance(field.default, str):
+            referenced.add(field.default)
+        rows = model._default_manager.exclude(**{field.attname : ""}).exclude(**{f"{field.attname}__isnull" : True})
+        if names is None:
+            referenced.update(rows.values_list(field.attname, flat=True).iterator(chunk_size=batch_size))
+            continue
+        for start in range(0, len(names), batch_size):
+            referenced.update(rows.filter(**{f"{field.attname}__in" : names[start:start + batch_size]}).values_list(
+                field.attname, flat=True))
+    return referenced
+
+
+class FileCleaner:
+    """
+    Deletes the files of deleted rows once the transaction deleting them
+    commits, so a rolled back delete keeps its files. The files are deleted
+    on a background thread, in batches of whatever was queued since the
+    last one, so a delete cascading to many rows doesn't wait on the
+    filesystem. Names a row refers to again by then, such as content stored
+    again, are kept. Files left queued by a process that died are found by
+    `manage.py sweep_media`.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def delete_on_commit(self, files):
+        # the names are read now, the instances are gone by the commit
+        files = [(file.storage, file.name) for file in files if file]
+        if files:
+            transaction.on_commit(partial(self.put, files))
+
+    def put(self, files):
+        self.queue.put(files)
+        with self.lock:
+            if self.thread is None:
+                # queued files are deleted before the process exits
+                atexit.register(self.join)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="file-cleaner", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            batches = [self.queue.get()]
+            while True:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.delete([file for files in batches for file in files])
+            except Exception:
+                logger.exception("Deleting the files of deleted rows failed")
+            finally:
+                # the thread's own database connection
+                connections.close_all()
+                for files in batches:
+                    self.queue.task_done()
+
+    def delete(self, files):
+        referenced = get_referenced_names({name for storage, name in files})
+        for storage, name in files:
+            if name in referenced:
+                continue
+            try:
+                storage.delete(name)
+            except OSError as error:
+                logger.warning("Could not delete %s: %s", name, error)
+
+    def join(self):
+        # waits for the queued files to be deleted
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+
+file_cleaner = FileCleaner()
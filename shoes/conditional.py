@@ -0,0 +1,28 @@
+import hashlib
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .models import ChangeStamp
+
+
+def conditional_get(request, scopes, get_response):
+    """
+    Answers a GET with 304 Not Modified when the client already holds the
+    current version of every change stamp in `scopes`. Otherwise the
+    response is built by `get_response()` and tagged with a strong ETag
+    and a Last-Modified header derived from the stamps.
+    """
+    stamps = ChangeStamp.objects.read(scopes)
+    versions = ",".join(f"{scope}:{stamps[scope].version if scope in stamps else 0}" for scope in sorted(scopes))
+    etag = '"%s"' % hashlib.sha1(versions.encode()).hexdigest()
+    modified = [stamp.modified_at.timestamp() for stamp in stamps.values()]
+    last_modified = int(max(modified)) if modified else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = get_response()
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+    return response
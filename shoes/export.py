@@ -0,0 +1,94 @@
+import csv
+import json
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch, prefetch_related_objects
+
+from .models import Shoe, ShoeCategory, ShoeColor, ShoeVariant
+from .serializers import get_summary
+from .sizes import size_lookup
+
+
+# the export is read in chunks of shoes that follow each other by id, each
+# chunk with one query per relation, so the memory used doesn't grow with
+# the catalog. (QuerySet.iterator() leaves out prefetch_related.)
+
+def iter_shoes(chunk_size=None):
+    chunk_size = chunk_size or getattr(settings, "SHOE_EXPORT_CHUNK_SIZE", 500)
+    shoes = Shoe.objects.select_related("summary").order_by("id")
+    last_id = 0
+    while True:
+        chunk = list(shoes.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        prefetch_related_objects(chunk, "features",
+            Prefetch("categories", queryset=ShoeCategory.objects.select_related("category")),
+            Prefetch("colors", queryset=ShoeColor.objects.prefetch_related("images")),
+            Prefetch("variants", queryset=ShoeVariant.objects.order_by("id")))
+        yield from chunk
+        last_id = chunk[-1].id
+
+def get_record(shoe):
+    """
+    The exported fields of a shoe, its relations included
+    """
+    colors = {color.id : color for color in shoe.colors.all()}
+    summary = get_summary(shoe)
+    return {
+        "id" : shoe.id,
+        "sku" : shoe.sku,
+        "name" : shoe.name,
+        "description" : shoe.description,
+        "display" : shoe.display,
+        "date_added" : shoe.date_added,
+        "date_restocked" : shoe.date_restocked,
+        "features" : [feature.feature for feature in shoe.features.all()],
+        "categories" : [shoe_category.category.name for shoe_category in shoe.categories.all()],
+        "colors" : [{"id" : color.id, "name" : color.name, "hex_code" : color.hex_code,
+            "images" : [{"image" : image.image.url, "medium" : image.medium.url if image.medium else None,
+                "thumbnail" : image.thumbnail.url if image.thumbnail else None} for image in color.images.all()]}
+            for color in colors.values()],
+        "variants" : [{"id" : variant.id, "size" : size_lookup.get_name(variant.size_id), "color" : colors[variant.color_id].name,
+            "price" : variant.price, "discount" : variant.discount, "quantity" : variant.quantity} for variant in shoe.variants.all()],
+        "quantity" : summary.quantity,
+        "price_min" : summary.price_min,
+        "price_max" : summary.price_max,
+        "ratings" : {"stars" : summary.rating_avg, "count" : summary.rating_count},
+    }
+
+def export_ndjson(shoes):
+    for shoe in shoes:
+        yield json.dumps(get_record(shoe), cls=DjangoJSONEncoder) + "\n"
+
+
+class Echo:
+    # a file-like object handing back what is written to it, for csv.writer
+    def write(self, value):
+        return value
+
+# the columns read by the import_catalog command, so an export can be
+# imported again
+CSV_COLUMNS = ["id", "sku", "name", "description", "display", "features", "categories", "color", "hex_code",
+    "size", "price", "quantity", "discount"]
+
+def export_csv(shoes):
+    """
+    One row per variant, and one for each shoe without variants
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for shoe in shoes:
+        record = get_record(shoe)
+        shoe_columns = [record["id"], record["sku"], record["name"], record["description"], record["display"],
+            "|".join(record["features"]), "|".join(record["categories"])]
+        hex_codes = {color["name"] : color["hex_code"] for color in record["colors"]}
+        for variant in record["variants"]:
+            yield writer.writerow(shoe_columns + [variant["color"], hex_codes[variant["color"]], variant["size"],
+                variant["price"], variant["quantity"], variant["discount"]])
+        if not record["variants"]:
+            yield writer.writerow(shoe_columns + [""] * 6)
+
+EXPORTERS = {
+    "ndjson" : (export_ndjson, "application/x-ndjson"),
+    "csv" : (export_csv, "text/csv"),
+}
@@ -0,0 +1,88 @@
+from decimal import Decimal
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Value, When
+
+from .categories import category_tree
+from .models import Shoe, ShoeCategory, ShoeVariant
+from .sizes import size_lookup
+
+
+# each facet is counted over the shoes matching every filter except its own,
+# so that picking a size still shows how many shoes the other sizes have.
+# every facet is a single grouped query rather than a query per value.
+
+def get_price_buckets():
+    """
+    The (min, max) price range of each bucket, the last one being open ended
+    """
+    bounds = [Decimal(str(bound)) for bound in getattr(settings, "SHOE_PRICE_BUCKETS", [50, 100, 150, 200])]
+    lower = [Decimal("0")] + bounds
+    return list(zip(lower, bounds + [None]))
+
+def count_sizes(shoe_filter):
+    shoes = shoe_filter.filter(Shoe.objects.all(), variants=False)
+    variants = ShoeVariant.objects.filter(shoe__in=shoes.values("pk"))
+    variant_query = shoe_filter.get_variant_query(exclude=["sizes"])
+    if variant_query is not None:
+        variants = variants.filter(variant_query)
+
+    counts = variants.order_by().values("size_id").annotate(count=Count("shoe_id", distinct=True))
+    return [{"id" : row["size_id"], "name" : size_lookup.get_name(row["size_id"]), "count" : row["count"]}
+        for row in counts.order_by("size_id")]
+
+def count_prices(shoe_filter):
+    shoes = shoe_filter.filter(Shoe.objects.all(), variants=False)
+    variants = ShoeVariant.objects.filter(shoe__in=shoes.values("pk"))
+    variant_query = shoe_filter.get_variant_query(exclude=["price"])
+    if variant_query is not None:
+        variants = variants.filter(variant_query)
+
+    # a shoe counts towards every bucket one of its variants is priced in
+    buckets = get_price_buckets()
+    bucket = Case(*[When(price__lt=upper, then=Value(index)) for index, (lower, upper) in enumerate(buckets) if upper is not None],
+        default=Value(len(buckets) - 1), output_field=IntegerField())
+    counts = variants.order_by().annotate(bucket=bucket).values("bucket").annotate(count=Count("shoe_id", distinct=True))
+    counts = {row["bucket"] : row["count"] for row in counts}
+
+    return [{"min" : lower, "max" : upper, "count" : counts.get(index, 0)}
+        for index, (lower, upper) in enumerate(buckets)]
+
+def count_categories(shoe_filter):
+    shoes = shoe_filter.filter(Shoe.objects.all(), exclude=["categories"])
+    nodes = category_tree.get_nodes()
+
+    # a shoe in a category is also counted once in every category above it
+    counts = ShoeCategory.objects.filter(shoe__in=shoes.values("pk")).order_by().values(
+        "category__ancestor_links__ancestor_id").annotate(count=Count("shoe_id", distinct=True))
+    counts = {row["category__ancestor_links__ancestor_id"] : row["count"] for row in counts}
+
+    return [{"id" : category_id, "name" : nodes[category_id]["name"], "parent" : nodes[category_id]["parent_id"],
+        "count" : counts[category_id]} for category_id in sorted(counts) if category_id in nodes]
+
+def count_facets(shoe_filter):
+    # a search matching many shoes is counted a slice of its matches at a
+    # time, see ShoeFilter.split
+    facets = None
+    for part in shoe_filter.split():
+        counts = {
+            "sizes" : count_sizes(part),
+            "categories" : count_categories(part),
+            "prices" : count_prices(part),
+        }
+        facets = counts if facets is None else add_facets(facets, counts)
+    return facets
+
+def add_facets(facets, counts):
+    # the counts of two slices of the matches, which have no shoe in common
+    added = {}
+    for facet in ["sizes", "categories"]:
+        rows = {row["id"] : dict(row) for row in facets[facet]}
+        for row in counts[facet]:
+            if row["id"] in rows:
+                rows[row["id"]]["count"] += row["count"]
+            else:
+                rows[row["id"]] = row
+        added[facet] = [rows[row_id] for row_id in sorted(rows)]
+    added["prices"] = [{**total, "count" : total["count"] + row["count"]}
+        for total, row in zip(facets["prices"], counts["prices"])]
+    return added
@@ -0,0 +1,116 @@
+import copy
+import operator
+from functools import reduce
+from django.db.models import Exists, OuterRef, Q
+
+from .models import ShoeCategory, ShoeVariant
+from .search import search_index
+from .sizes import size_lookup
+from .utils import float_or_none
+
+
+class ShoeFilter:
+    """
+    The storefront filters of the shoe catalog, read from the `categories`,
+    `q`, `price_min`, `price_max` and `sizes` query params
+    """
+    # the matches of a search put in a single `id IN (...)` at most, see
+    # split()
+    max_match_ids = 500
+
+    def __init__(self, params):
+        # splitting the categories into a list
+        categories = params.get("categories")
+        self.categories = categories.split(",") if categories else []
+        self.search_query = params.get("q")
+        self.price_max = float_or_none(params.get("price_max"))
+        self.price_min = float_or_none(params.get("price_min"))
+
+        # getting the sizes to display
+        sizes = params.get("sizes")
+        self.sizes = sizes.replace("-", " ").split(",") if sizes else []
+        self.match_ids = None
+
+    def get_variant_query(self, exclude=()):
+        """
+        The conditions a single variant of the shoe has to match
+        """
+        query = []
+
+        # getting the max price
+        if self.price_max and "price" not in exclude:
+            query.append(Q(price__lte=self.price_max))
+
+        # getting the minimum price
+        if self.price_min and "price" not in exclude:
+            query.append(Q(price__gte=self.price_min))
+
+        if self.sizes and "sizes" not in exclude:
+            query.append(Q(size_id__in=size_lookup.get_ids(self.sizes)))
+
+        return reduce(operator.and_, query) if query else None
+
+    def get_query(self, exclude=(), variants=True):
+        """
+        The conditions on the shoe itself. Filters named in `exclude` are
+        left out, and the variant conditions too when `variants` is False.
+        """
+        # relations are matched with subqueries rather than joins so that
+        # no shoe is repeated and no DISTINCT is needed
+        query = []
+
+        if self.search_query and "q" not in exclude:
+            # search by name, description, features and categories of the shoe
+            query.append(Q(id__in=self.get_match_ids()))
+
+        if self.categories and "categories" not in exclude:
+            # for each category, return any shoe that is in it or in any
+            # category under it
+            categories = ShoeCategory.objects.filter(category__ancestor_links__ancestor__name__in=self.categories)
+            query.append(Q(id__in=categories.values("shoe_id")))
+
+        variant_query = self.get_variant_query(exclude) if variants else None
+        if variant_query is not None:
+            query.append(Exists(ShoeVariant.objects.filter(variant_query, shoe=OuterRef("pk"))))
+
+        return reduce(operator.and_, query) if query else None
+
+    def get_search_results(self):
+        if not hasattr(self, "search_results"):
+            self.search_results = search_index.search(self.search_query) if self.search_query else []
+        return self.search_results
+
+    def get_match_ids(self):
+        if self.match_ids is not None:
+            return self.match_ids
+        return [shoe_id for shoe_id, score in self.get_search_results()]
+
+    def split(self):
+        """
+        The filter itself, or for a search matching more than
+        `max_match_ids` shoes, copies of it each matching a slice of them,
+        so that no query lists every match. The slices don't overlap, so
+        counts over the copies add up to those of the whole search.
+        """
+        match_ids = self.get_match_ids() if self.search_query else []
+        if len(match_ids) <= self.max_match_ids:
+            yield self
+            return
+        for start in range(0, len(match_ids), self.max_match_ids):
+            part = copy.copy(self)
+            part.match_ids = match_ids[start:start + self.max_match_ids]
+            yield part
+
+    def get_ranking(self):
+        """
+        (shoe id, relevance) of every shoe matching the search query, most
+        relevant first, or None without a query. The relevance is a whole
+        number so it stays exact when it is put in a cursor.
+        """
+        if not self.search_query:
+            return None
+        return [(shoe_id, round(score * 1000)) for shoe_id, score in self.get_search_results()]
+
+    def filter(self, queryset, exclude=(), variants=True):
+        query = self.get_query(exclude, variants)
+        return queryset if query is None else queryset.filter(query)
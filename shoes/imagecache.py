@@ -0,0 +1,155 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class DiskLRUCache:
+    """
+    Files kept under `directory` up to about `max_bytes`, the least
+    recently used evicted first. Reading a file touches its modification
+    time, which is what recency is judged by, so the cache is shared by
+    every process using the same directory.
+
+    Each process keeps an estimate of the total size, read from the disk
+    when it starts and grown by its own writes. Once the estimate passes
+    `max_bytes` the directory is scanned and the oldest files are evicted
+    down to `low_water` of it.
+    """
+
+    def __init__(self, directory, max_bytes, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.size = None
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        The path of the file cached under `key`, or None
+        """
+        path = self.get_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def set(self, key, data):
+        # written aside and moved in place so readers never see part of it
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".", delete=False) as file:
+            file.write(data)
+        os.replace(file.name, path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = self.get_total_size()
+            self.size += len(data)
+            evict = self.size > self.max_bytes
+        if evict:
+            self.evict()
+        return path
+
+    @contextmanager
+    def lock_key(self, key):
+        """
+        Held while the file of `key` is made, so concurrent requests for it
+        wait for the first one rather than making it again: a thread lock
+        within the process, and between processes, where fcntl is
+        available, one of 256 file locks picked by the key
+        """
+        with self.lock:
+            lock, users = self.key_locks.get(key, (threading.Lock(), 0))
+            self.key_locks[key] = (lock, users + 1)
+        try:
+            with lock, self.lock_file(f"{key[:2]}.lock"):
+                yield
+        finally:
+            with self.lock:
+                lock, users = self.key_locks[key]
+                if users == 1:
+                    del self.key_locks[key]
+                else:
+                    self.key_locks[key] = (lock, users - 1)
+
+    @contextmanager
+    def lock_file(self, name):
+        if fcntl is None:
+            yield
+            return
+        path = os.path.join(self.directory, ".locks", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def scan(self):
+        # (modification time, size, path) of every cached file
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        with os.scandir(self.directory) as folders:
+            for folder in folders:
+                if not folder.is_dir() or folder.name.startswith("."):
+                    continue
+                with os.scandir(folder.path) as files:
+                    for file in files:
+                        if file.name.startswith("."):
+                            continue
+                        try:
+                            stat = file.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, file.path))
+        return entries
+
+    def get_total_size(self):
+        return sum(size for modified, size, path in self.scan())
+
+    def evict(self):
+        with self.lock_file("evict.lock"):
+            entries = sorted(self.scan())
+            total = sum(size for modified, size, path in entries)
+            target = self.max_bytes * self.low_water
+            for modified, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        with self.lock:
+            self.size = total
+
+
+_resize_cache = None
+_resize_cache_lock = threading.Lock()
+
+def get_resize_cache():
+    """
+    The cache of the on-demand image sizes configured by SHOE_IMAGE_RESIZE
+    """
+    global _resize_cache
+    if _resize_cache is None:
+        with _resize_cache_lock:
+            if _resize_cache is None:
+                options = getattr(settings, "SHOE_IMAGE_RESIZE", {})
+                _resize_cache = DiskLRUCache(options.get("CACHE_DIR", os.path.join(settings.BASE_DIR, "image_cache")),
+                    options.get("MAX_BYTES", 512 * 1024 * 1024))
+    return _resize_cache
@@ -0,0 +1,266 @@
+import hashlib
+import io
+import os
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .imagecache import get_resize_cache
+from .models import ImageBlob, ShoeImage, ShoeImageDerivative
+
+
+# the derivatives of each ShoeImage, by field, and the length their
+# shorter side is scaled down to
+DERIVATIVE_SIZES = {
+    "medium" : 300,
+    "thumbnail" : 128,
+}
+
+# the EXIF tag of how the camera was held, 5 to 8 are turned a quarter turn
+ORIENTATION = 0x0112
+
+
+def get_derivative_size(width, height, limit):
+    """
+    The size an image is scaled to for a derivative of `limit`, or None when
+    it fits in `limit` x `limit` already and is kept as it is
+    """
+    if width <= limit and height <= limit:
+        return None
+    if width <= height:
+        return (limit, int(limit * height / width))
+    return (int(limit * width / height), limit)
+
+def get_ladder_widths(width, widths):
+    """
+    The widths of the responsive ladder of an image `width` wide. Images
+    are never scaled up, the image's own width stands in for the widths
+    above it.
+    """
+    ladder = sorted(set(ladder_width for ladder_width in widths if ladder_width < width))
+    if len(ladder) < len(set(widths)):
+        ladder.append(width)
+    return ladder
+
+def get_ladder_formats():
+    """
+    The {format : encoder options} of SHOE_IMAGE_DERIVATIVES["FORMATS"] this
+    Pillow can write. AVIF needs a Pillow built with it, or the
+    pillow-avif-plugin package imported, and is skipped otherwise.
+    """
+    formats = getattr(settings, "SHOE_IMAGE_DERIVATIVES", {}).get("FORMATS", {})
+    Image.init()
+    return {format : options for format, options in formats.items() if format.upper() in Image.SAVE}
+
+def to_web_mode(image):
+    # webp and avif only take RGB(A), palette and CMYK images are converted
+    if image.mode in ("RGB", "RGBA"):
+        return image
+    transparent = image.mode in ("LA", "PA") or "transparency" in image.info
+    return image.convert("RGBA" if transparent else "RGB")
+
+def get_upright_size(image):
+    # the size of an opened image once its EXIF orientation is applied
+    if image.getexif().get(ORIENTATION) in (5, 6, 7, 8):
+        return (image.height, image.width)
+    return image.size
+
+def decode(image, box):
+    """
+    Decodes an opened image upright and in RGB(A), for the sizes up to `box`
+    made of it. JPEGs are decoded with draft(), which scales them by 1/2,
+    1/4 or 1/8 in the decoder to no less than `box`, so a big original is
+    never decoded at full size for small derivatives.
+    """
+    if image.format == "JPEG":
+        width, height = box
+        upright = get_upright_size(image)
+        image.draft(None, (width, height) if upright == image.size else (height, width))
+    icc_profile = image.info.get("icc_profile") if image.mode != "CMYK" else None
+    image = to_web_mode(ImageOps.exif_transpose(image))
+    if icc_profile:
+        image.info["icc_profile"] = icc_profile
+    return image
+
+def resize_all(image, sizes):
+    """
+    Yields (size, image) of `image` resized to each of `sizes`, the largest
+    first. Each size is resized from the smallest one made before it that
+    is at least twice as large rather than from the original every time,
+    and only the sizes still useful for that are kept in memory.
+    """
+    made = []
+    for size in sorted(set(sizes), reverse=True):
+        sources = [resized for resized in made if resized.width >= 2 * size[0] and resized.height >= 2 * size[1]]
+        source = min(sources, key=lambda resized: resized.width) if sources else image
+        resized = image if size == image.size else source.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        made = [kept for kept in made if kept.width <= source.width] + [resized]
+        yield size, resized
+
+def render_derivatives(data):
+    """
+    The medium, thumbnail and responsive sizes of the image in `data`,
+    decoded once. Returns the format of the image, {field : bytes, or None
+    to keep the original} of DERIVATIVE_SIZES and (width, height, format,
+    bytes) of each size of the ladder.
+    """
+    options = getattr(settings, "SHOE_IMAGE_DERIVATIVES", {})
+    original = Image.open(io.BytesIO(data))
+    format = original.format
+    width, height = get_upright_size(original)
+
+    fields = {field : get_derivative_size(width, height, limit) for field, limit in DERIVATIVE_SIZES.items()}
+    ladder = [(ladder_width, max(1, round(height * ladder_width / width)))
+        for ladder_width in get_ladder_widths(width, options.get("WIDTHS", []))]
+    contents = dict.fromkeys(fields)
+    sizes = [size for size in fields.values() if size is not None] + ladder
+    if not sizes:
+        return format, contents, []
+
+    image = decode(original, max(sizes))
+    icc_profile = image.info.get("icc_profile")
+    formats = get_ladder_formats()
+    renditions = []
+    # each size is encoded as soon as it is made
+    for size, resized in resize_all(image, sizes):
+        for field in [field for field, field_size in fields.items() if field_size == size]:
+            output = io.BytesIO()
+            if format == "JPEG":
+                resized.convert("RGB").save(output, format, icc_profile=icc_profile, **options.get("JPEG", {}))
+            else:
+                resized.save(output, format, icc_profile=icc_profile)
+            contents[field] = output.getvalue()
+        if size in ladder:
+            for ladder_format, encoder_options in formats.items():
+                output = io.BytesIO()
+                resized.save(output, ladder_format.upper(), icc_profile=icc_profile, **encoder_options)
+                renditions.append((*size, ladder_format, output.getvalue()))
+    return format, contents, sorted(renditions)
+
+def make_derivatives(blob):
+    """
+    Writes the medium, thumbnail and responsive sizes of an ImageBlob to
+    the storage, from its file read and decoded once. The medium and
+    thumbnail names are set on the blob without saving it, the responsive
+    sizes are returned as unsaved ShoeImageDerivative rows.
+    """
+    with blob.file.open("rb") as file:
+        data = file.read()
+    format, contents, renditions = render_derivatives(data)
+    name = os.path.basename(blob.file.name)
+
+    for field, content in contents.items():
+        getattr(blob, field).save(name, ContentFile(data if content is None else content), save=False)
+
+    derivatives = []
+    for width, height, ladder_format, content in renditions:
+        derivative = ShoeImageDerivative(blob=blob, width=width, height=height, format=ladder_format, size=len(content))
+        derivative.file.save(f"{width}w.{ladder_format}", ContentFile(content), save=False)
+        derivatives.append(derivative)
+    return derivatives
+
+
+# the formats sizes can be asked for in, as (Pillow format, content type)
+OUTPUT_FORMATS = {
+    "webp" : ("WEBP", "image/webp"),
+    "avif" : ("AVIF", "image/avif"),
+    "jpeg" : ("JPEG", "image/jpeg"),
+    "png" : ("PNG", "image/png"),
+}
+
+def get_output_formats():
+    # the OUTPUT_FORMATS of SHOE_IMAGE_RESIZE["FORMATS"] this Pillow can write
+    outputs = getattr(settings, "SHOE_IMAGE_RESIZE", {}).get("FORMATS", list(OUTPUT_FORMATS))
+    Image.init()
+    return [output for output in outputs if output in OUTPUT_FORMATS and OUTPUT_FORMATS[output][0] in Image.SAVE]
+
+def open_resized(blob, width, output):
+    """
+    The image of `blob` at `width` in `output`, opened from the resize
+    cache and rendered into it on the first request. Concurrent requests
+    for a size not cached yet wait for the one rendering it. The file is
+    opened as soon as it is found, and an open file stays readable once
+    evicted; a file evicted before it is opened is rendered again.
+    """
+    cache = get_resize_cache()
+    key = hashlib.sha256(f"{blob.hash}:{width}:{output}".encode()).hexdigest()
+    path = cache.get(key)
+    if path is not None:
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            pass
+
+    with cache.lock_key(key):
+        path = cache.get(key)
+        content = None
+        if path is None:
+            content = render_size(blob, width, output)
+            path = cache.set(key, content)
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            return io.BytesIO(content if content is not None else render_size(blob, width, output))
+
+def render_size(blob, width, output):
+    """
+    The bytes of the image of `blob` scaled down to `width` (never up) in
+    the `output` format of OUTPUT_FORMATS, with the encoder options of
+    SHOE_IMAGE_DERIVATIVES
+    """
+    options = getattr(settings, "SHOE_IMAGE_DERIVATIVES", {})
+    format = OUTPUT_FORMATS[output][0]
+    with blob.file.open("rb") as file:
+        original = Image.open(io.BytesIO(file.read()))
+
+    original_width, original_height = get_upright_size(original)
+    width = min(width, original_width)
+    size = (width, max(1, round(original_height * width / original_width)))
+    image = decode(original, size)
+    image = next(resize_all(image, [size]))[1] if image.width > width else image
+    if format == "JPEG":
+        image, encoder_options = image.convert("RGB"), options.get("JPEG", {})
+    else:
+        encoder_options = options.get("FORMATS", {}).get(output, {})
+
+    content = io.BytesIO()
+    image.save(content, format, icc_profile=image.info.get("icc_profile"), **encoder_options)
+    return content.getvalue()
+
+
+# ------ WORKERS ------
+
+def init_worker():
+    # forked workers open their own database connections on first use,
+    # spawned ones load Django first
+    django.setup()
+
+def process_image(image_id):
+    """
+    Makes the derivatives of one image, in a worker process. Returns None
+    once they are written or the error that stopped it, for the job to be
+    retried.
+    """
+    try:
+        shoe_image = ShoeImage.objects.select_related("blob").filter(id=image_id).first()
+        # deleted since it was queued
+        if shoe_image is None:
+            return None
+        blob = shoe_image.blob
+        if blob is None:
+            return "The image has no stored file"
+        # the sizes are made once per blob, images of content seen before
+        # take the existing ones
+        if not blob.medium:
+            derivatives = make_derivatives(blob)
+            with transaction.atomic():
+                ImageBlob.objects.filter(hash=blob.hash).update(medium=blob.medium.name, thumbnail=blob.thumbnail.name)
+                # the same sizes made concurrently for another image of the blob
+                ShoeImageDerivative.objects.bulk_create(derivatives, ignore_conflicts=True)
+        ShoeImage.objects.filter(id=image_id).update(medium=blob.medium.name, thumbnail=blob.thumbnail.name,
+            status=ShoeImage.READY)
+    except Exception as error:
+        return f"{type(error).__name__}: {error}"
+    return None
@@ -0,0 +1,172 @@
+import csv
+import json
+import string
+from decimal import Decimal, InvalidOperation
+from itertools import groupby
+from django.db import transaction
+
+from .categories import category_tree
+from .models import Shoe, ShoeCategory, ShoeColor, ShoeFeature, ShoeVariant
+from .signals import catalog_bulk_changed
+from .sizes import size_lookup
+
+
+class CatalogRecordError(ValueError):
+    pass
+
+
+# a catalog is a stream of shoe records:
+#   {"sku", "name", "description", "display", "features" : [text],
+#    "categories" : [name], "colors" : [{"name", "hex_code"}],
+#    "variants" : [{"size", "color", "price", "quantity", "discount"}]}
+# as JSON lines, or as CSV with one row per variant, the rows of a shoe
+# following each other, and the features and categories separated by "|"
+
+CSV_SHOE_COLUMNS = ["sku", "name", "description", "display", "features", "categories"]
+
+def read_jsonl(file):
+    for line in file:
+        if line.strip():
+            # a malformed line is passed on as a malformed record
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield None
+
+def read_csv(file):
+    def split(value):
+        return [item.strip() for item in value.split("|") if item.strip()] if value else []
+
+    for sku, rows in groupby(csv.DictReader(file), key=lambda row: row.get("sku")):
+        rows = list(rows)
+        record = {column : rows[0].get(column) for column in CSV_SHOE_COLUMNS}
+        record["features"] = split(record["features"])
+        record["categories"] = split(record["categories"])
+        record["colors"] = [{"name" : row.get("color"), "hex_code" : row.get("hex_code")} for row in rows if row.get("color")]
+        record["variants"] = [{field : row.get(field) for field in ["size", "color", "price", "quantity", "discount"]}
+            for row in rows if row.get("size")]
+        yield record
+
+READERS = {"jsonl" : read_jsonl, "csv" : read_csv}
+
+
+class CatalogImporter:
+    """
+    Writes catalog records in batches, each batch in one transaction with
+    a bulk insert per table. Sizes and categories are resolved from the
+    in-memory lookups, and shoes whose sku already exists are skipped, so
+    a batch that was written but not checkpointed can be run again.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.counts = {"shoes" : 0, "features" : 0, "categories" : 0, "colors" : 0, "variants" : 0, "skipped" : 0}
+        # shoes can only be put in categories under a top level one
+        self.category_ids = {node["name"] : category_id for category_id, node in category_tree.get_nodes().items()
+            if node["parent_id"] is not None}
+
+    def prepare(self, record):
+        """
+        Validates a raw record, returning it with its sizes and categories
+        resolved. Raises CatalogRecordError if it can't be imported.
+        """
+        if not isinstance(record, dict):
+            raise CatalogRecordError("a record must be an object")
+        sku = str(record.get("sku") or "").strip()
+        name = str(record.get("name") or "").strip()
+        if not sku or len(sku) > 64:
+            raise CatalogRecordError("sku must be 1 to 64 characters")
+        if not name or len(name) > 50:
+            raise CatalogRecordError("name must be 1 to 50 characters")
+
+        display = record.get("display")
+        if isinstance(display, str):
+            display = display.strip().lower() in ("1", "true", "yes")
+
+        features = [str(feature)[:255] for feature in record.get("features") or [] if feature]
+        categories = []
+        for category in record.get("categories") or []:
+            if category not in self.category_ids:
+                raise CatalogRecordError(f"unknown category {category!r}")
+            categories.append(self.category_ids[category])
+
+        colors = {}
+        for color in record.get("colors") or []:
+            color_name = str(color.get("name") or "default")[:50]
+            hex_code = (color.get("hex_code") or "").upper() or None
+            if hex_code and (len(hex_code) != 6 or any(letter not in string.hexdigits for letter in hex_code)):
+                raise CatalogRecordError(f"invalid hex code {hex_code!r}")
+            colors.setdefault(color_name, hex_code)
+
+        variants = {}
+        for variant in record.get("variants") or []:
+            size_id = size_lookup.get_id(variant.get("size"))
+            if size_id is None:
+                raise CatalogRecordError(f"unknown size {variant.get('size')!r}")
+            color_name = str(variant.get("color") or "default")[:50]
+            colors.setdefault(color_name, None)
+            try:
+                price = Decimal(str(variant.get("price")))
+                discount = Decimal(str(variant.get("discount") or 0))
+                quantity = int(variant.get("quantity") or 0)
+            except (InvalidOperation, ValueError):
+                raise CatalogRecordError("price, discount and quantity must be numbers")
+            if not (price.is_finite() and discount.is_finite()) or not 0 <= price < 100000 or not 0 <= discount < 1000 \
+                    or not 0 <= quantity <= 32767:
+                raise CatalogRecordError("price, discount or quantity out of range")
+            if (size_id, color_name) in variants:
+                raise CatalogRecordError(f"repeated variant {variant.get('size')!r} / {color_name!r}")
+            variants[(size_id, color_name)] = {"price" : price, "discount" : discount, "quantity" : quantity}
+
+        return {
+            "sku" : sku, "name" : name, "description" : record.get("description") or None, "display" : bool(display),
+            "features" : features, "categories" : sorted(set(categories)), "colors" : colors, "variants" : variants,
+        }
+
+    def write(self, records):
+        """
+        Inserts a batch of prepared records
+        """
+        with transaction.atomic():
+            existing = set(Shoe.objects.filter(sku__in=[record["sku"] for record in records]).values_list("sku", flat=True))
+            batch = {}
+            for record in records:
+                if record["sku"] in existing or record["sku"] in batch:
+                    self.counts["skipped"] += 1
+                else:
+                    batch[record["sku"]] = record
+            if not batch:
+                return
+
+            shoes = Shoe.objects.bulk_create([Shoe(sku=sku, name=record["name"], description=record["description"],
+                display=record["display"]) for sku, record in batch.items()], batch_size=self.batch_size)
+            # the inserted ids aren't returned by every database, in which
+            # case they are read back by sku
+            if all(shoe.pk is not None for shoe in shoes):
+                shoe_ids = {shoe.sku : shoe.pk for shoe in shoes}
+            else:
+                shoe_ids = dict(Shoe.objects.filter(sku__in=list(batch)).values_list("sku", "id"))
+
+            features = [ShoeFeature(shoe_id=shoe_ids[sku], feature=feature) for sku, record in batch.items() for feature in record["features"]]
+            categories = [ShoeCategory(shoe_id=shoe_ids[sku], category_id=category_id)
+                for sku, record in batch.items() for category_id in record["categories"]]
+            colors = ShoeColor.objects.bulk_create([ShoeColor(shoe_id=shoe_ids[sku], name=name, hex_code=hex_code)
+                for sku, record in batch.items() for name, hex_code in record["colors"].items()], batch_size=self.batch_size)
+            if all(color.pk is not None for color in colors):
+                color_ids = {(color.shoe_id, color.name) : color.pk for color in colors}
+            else:
+                color_ids = {(shoe_id, name) : color_id for shoe_id, name, color_id in
+                    ShoeColor.objects.filter(shoe_id__in=shoe_ids.values()).values_list("shoe_id", "name", "id")}
+            variants = [ShoeVariant(shoe_id=shoe_ids[sku], size_id=size_id, color_id=color_ids[(shoe_ids[sku], color_name)], **values)
+                for sku, record in batch.items() for (size_id, color_name), values in record["variants"].items()]
+
+            ShoeFeature.objects.bulk_create(features, batch_size=self.batch_size)
+            ShoeCategory.objects.bulk_create(categories, batch_size=self.batch_size)
+            ShoeVariant.objects.bulk_create(variants, batch_size=self.batch_size)
+            catalog_bulk_changed.send(sender=Shoe, shoe_ids=list(shoe_ids.values()))
+
+        self.counts["shoes"] += len(shoe_ids)
+        self.counts["features"] += len(features)
+        self.counts["categories"] += len(categories)
+        self.counts["colors"] += len(colors)
+        self.counts["variants"] += len(variants)
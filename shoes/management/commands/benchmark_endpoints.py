@@ -0,0 +1,202 @@
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import platform
+import random
+import statistics
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from payments.serializers import ProductCheckoutSerializer
+from shoes.cache import reset_list_cache
+from shoes.models import CartItem, Category, Shoe, ShoeSize, ShoeVariant
+from shoes.utils import get_user_tokens
+from users.models import User
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = ("Times the hot endpoints against the current database and writes the p50/p95 latency and query "
+        "counts of each to a JSON file, optionally comparing them with an earlier run")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=30, help="timed requests per scenario")
+        parser.add_argument("--warmup", type=int, default=3, help="untimed requests per scenario first")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", help="the JSON file the results are written to")
+        parser.add_argument("--compare", help="the JSON file of an earlier run to compare against")
+        parser.add_argument("--only", help="only run the scenarios whose name contains this")
+        parser.add_argument("--list-cache", action="store_true", help="keep the shoe list response cache on")
+        parser.add_argument("--force", action="store_true", help="run without the benchmark settings")
+
+    def handle(self, *args, **options):
+        if not getattr(settings, "BENCHMARK", False) and not options["force"]:
+            raise CommandError("The webhook scenario changes stock, run this with "
+                "DJANGO_SETTINGS_MODULE=backend_django.settings_bench or pass --force")
+        if not Shoe.objects.exists():
+            raise CommandError("There are no shoes, run seed_catalog first")
+        self.rng = random.Random(options["seed"])
+
+        with ExitStack() as stack:
+            # the list is timed doing its work rather than answering from
+            # the cache, unless asked otherwise
+            if not options["list_cache"]:
+                stack.enter_context(override_settings(SHOE_LIST_CACHE={"BACKEND" : None}))
+            stack.callback(reset_list_cache)
+            reset_list_cache()
+
+            results = {}
+            for name, run in self.get_scenarios():
+                if options["only"] and options["only"] not in name:
+                    continue
+                results[name] = self.measure(run, options["iterations"], options["warmup"])
+                self.stdout.write(f"{name:<48} p50 {results[name]['p50_ms']:8.2f}ms  p95 {results[name]['p95_ms']:8.2f}ms"
+                    f"  queries {results[name]['queries']}")
+
+        report = {
+            "meta" : {
+                "created" : timezone.now().isoformat(),
+                "database" : connection.vendor,
+                "python" : platform.python_version(),
+                "shoes" : Shoe.objects.count(),
+                "variants" : ShoeVariant.objects.count(),
+                "iterations" : options["iterations"],
+                "list_cache" : options["list_cache"],
+            },
+            "results" : results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                self.compare(json.load(file), report)
+
+    def measure(self, run, iterations, warmup):
+        """
+        Calls `run(iteration)` and returns the latency percentiles and the
+        number of queries, which should be the same on every call
+        """
+        for iteration in range(warmup):
+            run(iteration)
+        durations, queries, statuses = [], [], set()
+        for iteration in range(iterations):
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                status = run(warmup + iteration)
+                durations.append((time.perf_counter() - started) * 1000)
+            queries.append(len(context))
+            statuses.add(status)
+        return {
+            "p50_ms" : round(percentile(durations, 0.5), 3),
+            "p95_ms" : round(percentile(durations, 0.95), 3),
+            "mean_ms" : round(statistics.mean(durations), 3),
+            "queries" : max(queries),
+            "min_queries" : min(queries),
+            "status" : sorted(statuses),
+        }
+
+    def get_scenarios(self):
+        client = Client()
+        shoe_ids = list(Shoe.objects.values_list("id", flat=True))
+        sample = [self.rng.choice(shoe_ids) for iteration in range(200)]
+        category = Category.objects.filter(parent__isnull=False, shoes__isnull=False).values_list("name", flat=True).first()
+        sizes = ",".join(ShoeSize.objects.filter(shoes__isnull=False).values_list("name", flat=True).distinct()[:2])
+        term = Shoe.objects.values_list("name", flat=True).first().split()[0]
+
+        def get(path):
+            return lambda iteration: client.get(path).status_code
+
+        # the shoe list with every combination of its filters
+        filters = {"categories" : f"categories={category}", "sizes" : f"sizes={sizes}",
+            "price" : "price_min=40&price_max=150", "q" : f"q={term}"}
+        for count in range(len(filters) + 1):
+            for names in itertools.combinations(filters, count):
+                query = "&".join(filters[name] for name in names)
+                yield f"shoe_list[{','.join(names) or 'none'}]", get(f"/shoes/?{query}")
+        for order in ["price", "newest"]:
+            yield f"shoe_list[order={order}]", get(f"/shoes/?order={order}")
+        yield "shoe_list[fields=id,name,price_min,images]", get("/shoes/?fields=id,name,price_min,images")
+        yield "shoe_facets", get(f"/shoes/facets/?categories={category}")
+
+        yield "shoe_detail", lambda iteration: client.get(f"/shoes/{sample[iteration % len(sample)]}/").status_code
+        yield "shoe_page", lambda iteration: client.get(f"/shoes/{sample[iteration % len(sample)]}/page/").status_code
+        yield "shoe_variants", lambda iteration: client.get(f"/shoes/{sample[iteration % len(sample)]}/variants/").status_code
+
+        buyer = User.objects.filter(shopping_cart__isnull=False).first() or User.objects.filter(user_type=2).first()
+        if buyer is not None:
+            token = get_user_tokens(buyer)["access"]
+            yield "user_cart", lambda iteration: client.get(f"/users/{buyer.id}/cart/",
+                HTTP_AUTHORIZATION=f"Bearer {token}").status_code
+            yield "checkout_validation", self.checkout_validation(buyer)
+            yield "stripe_webhook", self.stripe_webhook(client, buyer)
+
+    def checkout_validation(self, buyer):
+        # validating the cart is what the checkout views do before calling
+        # stripe, which isn't benchmarked
+        products = [{"id" : item.shoe_id, "quantity" : 1} for item in CartItem.objects.filter(user=buyer, shoe__quantity__gt=0)[:5]] or \
+            [{"id" : variant_id, "quantity" : 1} for variant_id in
+                ShoeVariant.objects.filter(quantity__gt=0).values_list("id", flat=True)[:3]]
+
+        def run(iteration):
+            serializer = ProductCheckoutSerializer(data={"product_source" : 2, "products" : products})
+            serializer.is_valid(raise_exception=True)
+            return 200 if serializer.data else 400
+        return run
+
+    def stripe_webhook(self, client, buyer):
+        # the events are signed the way stripe signs them, with the secret
+        # of the benchmark settings
+        variants = list(ShoeVariant.objects.filter(quantity__gt=0).order_by("-quantity").values_list("id", "price", "discount")[:3])
+        # each event takes one of each variant out of stock
+        ShoeVariant.objects.filter(id__in=[variant[0] for variant in variants]).update(quantity=10000)
+        run_id = time.time_ns()
+
+        def run(iteration):
+            payload = json.dumps({
+                "id" : f"evt_bench_{run_id}_{iteration}",
+                "object" : "event",
+                "type" : "payment_intent.succeeded",
+                "data" : {"object" : {
+                    "id" : f"pi_bench_{run_id}_{iteration}",
+                    "object" : "payment_intent",
+                    "amount" : 1000,
+                    "metadata" : {
+                        "user_id" : str(buyer.id),
+                        "product_source" : "2",
+                        "products" : json.dumps([{"id" : variant_id, "quantity" : 1, "price" : str(price), "discount" : str(discount)}
+                            for variant_id, price, discount in variants]),
+                    },
+                }},
+            })
+            timestamp = int(time.time())
+            signature = hmac.new(settings.STRIPE_ENDPOINT_SECRET.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+            return client.post("/payments/stripe-webhooks/", payload, content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}").status_code
+        return run
+
+    def compare(self, before, after):
+        self.stdout.write(f"\nCompared with the run of {before['meta']['created']}:")
+        for name, result in after["results"].items():
+            previous = before["results"].get(name)
+            if previous is None:
+                self.stdout.write(f"{name:<48} new")
+                continue
+            change = (result["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"] * 100 if previous["p50_ms"] else 0
+            queries = result["queries"] - previous["queries"]
+            self.stdout.write(f"{name:<48} p50 {previous['p50_ms']:8.2f} -> {result['p50_ms']:8.2f}ms ({change:+.0f}%)"
+                f"  p95 {previous['p95_ms']:8.2f} -> {result['p95_ms']:8.2f}ms  queries {queries:+d}")
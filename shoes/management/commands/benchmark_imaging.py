@@ -0,0 +1,143 @@
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+import PIL
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from PIL import Image
+
+from shoes.imaging import (DERIVATIVE_SIZES, get_derivative_size, get_ladder_formats, get_ladder_widths, init_worker,
+    render_derivatives)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+# the folders of sizes made of the originals, which are not benchmarked
+DERIVATIVE_FOLDERS = ("medium", "thumbnail", "derivatives")
+
+
+def get_peak_memory():
+    # the peak resident memory of this process in bytes, ru_maxrss is in
+    # kilobytes on linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def render_per_size(data):
+    """
+    The sizes of render_derivatives made the way ShoeImage.save made the
+    medium and thumbnail: the image decoded again at full size for each
+    one, and each resized from the full original. The encoder options are
+    the same, so only the decoding and resizing differ.
+    """
+    options = getattr(settings, "SHOE_IMAGE_DERIVATIVES", {})
+    for limit in DERIVATIVE_SIZES.values():
+        image = Image.open(io.BytesIO(data))
+        size = get_derivative_size(image.width, image.height, limit)
+        if size is not None:
+            image.resize(size).save(io.BytesIO(), image.format, **(options.get("JPEG", {}) if image.format == "JPEG" else {}))
+    for width in get_ladder_widths(Image.open(io.BytesIO(data)).width, options.get("WIDTHS", [])):
+        for format, encoder_options in get_ladder_formats().items():
+            image = Image.open(io.BytesIO(data)).convert("RGB")
+            image.resize((width, max(1, round(image.height * width / image.width)))).save(io.BytesIO(),
+                format.upper(), **encoder_options)
+
+RENDERERS = {
+    "per_size" : render_per_size,
+    "single_decode" : render_derivatives,
+}
+
+def measure(renderer, path, repeat):
+    """
+    The median CPU time of rendering the sizes of the image at `path` and
+    the peak memory it took, called in a new process so the peak is that
+    of the rendering alone
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    baseline = get_peak_memory()
+    durations = []
+    for attempt in range(repeat):
+        started = time.process_time()
+        RENDERERS[renderer](data)
+        durations.append(time.process_time() - started)
+    peak = get_peak_memory()
+    return {
+        "cpu_ms" : round(statistics.median(durations) * 1000, 2),
+        "peak_mb" : round((peak - baseline) / 1024 / 1024, 2) if peak is not None else None,
+    }
+
+
+class Command(BaseCommand):
+    help = ("Times making the medium, thumbnail and responsive sizes of sample images, decoding each image once "
+        "against decoding it for every size, and reports the CPU time and peak memory per image")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--directory", help="the images to time, defaults to MEDIA_ROOT/shoe_images")
+        parser.add_argument("--repeat", type=int, default=3, help="renders per image, the median is reported")
+        parser.add_argument("--limit", type=int, help="only time this many images")
+        parser.add_argument("--output", help="the JSON file the results are written to")
+
+    def handle(self, *args, **options):
+        directory = options["directory"] or os.path.join(settings.MEDIA_ROOT, "shoe_images")
+        paths = self.find_images(directory)[:options["limit"]]
+        if not paths:
+            raise CommandError(f"There are no images in {directory}")
+
+        results = {}
+        for path in paths:
+            with Image.open(path) as image:
+                result = {"size" : f"{image.width}x{image.height}", "format" : image.format}
+            for renderer in RENDERERS:
+                # a process per image and renderer, peak memory only grows
+                with multiprocessing.Pool(1, initializer=init_worker) as pool:
+                    result[renderer] = pool.apply(measure, (renderer, path, options["repeat"]))
+            results[os.path.relpath(path, directory)] = result
+            self.stdout.write(f"{os.path.basename(path)[:40]:<40} {result['size']:>10}  "
+                + "  ".join(self.format_result(renderer, result[renderer]) for renderer in RENDERERS))
+
+        summary = {renderer : {
+            "cpu_ms" : round(statistics.median(result[renderer]["cpu_ms"] for result in results.values()), 2),
+            "peak_mb" : round(statistics.median(result[renderer]["peak_mb"] for result in results.values()), 2)
+                if resource is not None else None,
+        } for renderer in RENDERERS}
+        self.stdout.write("\nmedian per image  " + "  ".join(self.format_result(renderer, summary[renderer])
+            for renderer in RENDERERS))
+
+        if options["output"]:
+            report = {
+                "meta" : {
+                    "created" : timezone.now().isoformat(),
+                    "python" : platform.python_version(),
+                    "pillow" : PIL.__version__,
+                    "images" : len(results),
+                    "repeat" : options["repeat"],
+                },
+                "summary" : summary,
+                "results" : results,
+            }
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def find_images(self, directory):
+        paths = []
+        for root, folders, files in os.walk(directory):
+            folders[:] = sorted(folder for folder in folders if folder not in DERIVATIVE_FOLDERS)
+            paths.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(IMAGE_EXTENSIONS))
+        return paths
+
+    def format_result(self, renderer, result):
+        peak = f"{result['peak_mb']:7.1f}MB" if result["peak_mb"] is not None else "      -"
+        return f"{renderer} {result['cpu_ms']:8.1f}ms {peak}"
@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from shoes.importer import READERS, CatalogImporter
+
+
+class Command(BaseCommand):
+    help = ("Imports shoes with their features, categories, colors and variants from a CSV or JSON lines catalog. "
+        "Progress is checkpointed after every batch, and an interrupted import resumes from the last checkpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="the catalog file, or - to read standard input")
+        parser.add_argument("--format", choices=sorted(READERS), help="defaults to the file extension")
+        parser.add_argument("--batch-size", type=int, default=500, help="shoes written per transaction")
+        parser.add_argument("--checkpoint", help="defaults to <path>.checkpoint")
+        parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the first record")
+
+    def handle(self, *args, **options):
+        path, batch_size = options["path"], options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+        reader = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if reader not in READERS:
+            raise CommandError("Pass --format, the format can't be told from the file name")
+        checkpoint = options["checkpoint"] or (None if path == "-" else f"{path}.checkpoint")
+
+        skip = 0
+        if checkpoint and os.path.exists(checkpoint) and not options["restart"]:
+            with open(checkpoint) as file:
+                skip = json.load(file)["records"]
+            self.stdout.write(f"Resuming after record {skip}")
+
+        importer = CatalogImporter(batch_size=batch_size)
+        started = time.monotonic()
+        errors = 0
+        position = 0
+        batch = []
+
+        def flush():
+            importer.write(batch)
+            batch.clear()
+            # the checkpoint only moves past records once they are committed
+            if checkpoint:
+                with open(f"{checkpoint}.tmp", "w") as progress:
+                    json.dump({"records" : position}, progress)
+                os.replace(f"{checkpoint}.tmp", checkpoint)
+            elapsed = max(time.monotonic() - started, 0.001)
+            self.stdout.write(f"{position} records, {importer.counts['shoes']} shoes, {importer.counts['variants']} variants "
+                f"in {elapsed:.1f}s ({importer.counts['shoes'] / elapsed:.0f} shoes/s)")
+
+        file = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        try:
+            for record in READERS[reader](file):
+                position += 1
+                if position <= skip:
+                    continue
+                try:
+                    batch.append(importer.prepare(record))
+                except (ValueError, TypeError, AttributeError) as exc:
+                    errors += 1
+                    self.stderr.write(f"record {position}: {exc}")
+                if len(batch) >= batch_size:
+                    flush()
+            flush()
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        counts = importer.counts
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['shoes']} shoes, {counts['features']} features, {counts['categories']} categories, "
+            f"{counts['colors']} colors and {counts['variants']} variants in {time.monotonic() - started:.1f}s. "
+            f"{counts['skipped']} shoes already existed, {errors} records were invalid."))
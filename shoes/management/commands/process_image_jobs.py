@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import socket
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from shoes.imaging import init_worker, process_image
+from shoes.models import ImageJob, ShoeColor, ShoeImage
+from shoes.signals import catalog_bulk_changed
+
+
+class Command(BaseCommand):
+    help = ("Makes the medium and thumbnail images of uploaded shoe images from the queued image jobs, "
+        "with a pool of worker processes")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, help="defaults to IMAGE_JOBS['PROCESSES'], else the number of CPUs")
+        parser.add_argument("--batch-size", type=int, help="jobs claimed at a time, defaults to IMAGE_JOBS['BATCH_SIZE']")
+        parser.add_argument("--once", action="store_true", help="exit once no job is due rather than waiting for more")
+
+    def handle(self, *args, **options):
+        config = getattr(settings, "IMAGE_JOBS", {})
+        processes = options["processes"] or config.get("PROCESSES") or os.cpu_count()
+        batch_size = options["batch_size"] or config.get("BATCH_SIZE", 20)
+        self.max_attempts = config.get("MAX_ATTEMPTS", 5)
+        self.retry_delay = config.get("RETRY_DELAY", 30)
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+
+        # the pool processes must not share the connection of this one
+        connections.close_all()
+        with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+            self.stdout.write(f"Processing image jobs with {processes} processes, backlog {ImageJob.objects.backlog()}")
+            while True:
+                requeued = ImageJob.objects.requeue_stale(config.get("RUNNING_TIMEOUT", 600))
+                if requeued:
+                    self.stdout.write(f"Queued {requeued} stale jobs again")
+
+                jobs = ImageJob.objects.claim(batch_size, worker)
+                if not jobs:
+                    if options["once"]:
+                        break
+                    time.sleep(config.get("POLL_INTERVAL", 2))
+                    continue
+
+                started = time.monotonic()
+                errors = pool.map(process_image, [job.image_id for job in jobs])
+                self.record(jobs, errors)
+                self.stdout.write(f"{len(jobs)} jobs in {time.monotonic() - started:.2f}s, "
+                    f"{errors.count(None)} done, backlog {ImageJob.objects.backlog()}")
+
+    def record(self, jobs, errors):
+        ImageJob.objects.complete([job for job, error in zip(jobs, errors) if error is None])
+        for job, error in zip(jobs, errors):
+            if error is not None:
+                self.stderr.write(f"Image {job.image_id} failed (attempt {job.attempts}): {error}")
+                ImageJob.objects.fail(job, error, self.max_attempts, self.retry_delay)
+
+        # the images were written with update(), which sends no post_save
+        image_ids = [job.image_id for job in jobs]
+        shoe_ids = ShoeColor.objects.filter(images__id__in=image_ids).values_list("shoe_id", flat=True).distinct()
+        catalog_bulk_changed.send(sender=ShoeImage, shoe_ids=list(shoe_ids))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shoes.models import Shoe, ShoeSummary
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the precomputed stock, price and rating summary of every shoe"
+
+    def add_arguments(self, parser):
+        parser.add_argument("shoe_ids", nargs="*", type=int, help="only rebuild the summaries of these shoes")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        shoes = Shoe.objects.all()
+        if options["shoe_ids"]:
+            shoes = shoes.filter(pk__in=options["shoe_ids"])
+
+        with transaction.atomic():
+            count = ShoeSummary.objects.rebuild(shoes, batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} shoe summaries"))
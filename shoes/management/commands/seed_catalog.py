@@ -0,0 +1,170 @@
+import io
+import math
+import random
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from PIL import Image
+
+from payments.models import Purchase, Transaction
+from shoes.importer import CatalogImporter
+from shoes.models import CartItem, Category, ImageBlob, Rating, Shoe, ShoeColor, ShoeImage, ShoeSize, ShoeVariant
+from shoes.signals import catalog_bulk_changed
+from users.models import User
+
+
+CATEGORIES = {
+    "gender" : ["men", "women", "kids"],
+    "style" : ["running", "casual", "formal", "boots", "sandals", "basketball"],
+    "season" : ["summer", "winter", "all-season"],
+}
+SIZES = [str(size) for size in range(36, 48)]
+COLORS = [("black", "000000"), ("white", "FFFFFF"), ("red", "C0392B"), ("navy", "1F3A5F"), ("grey", "808080"),
+    ("brown", "7B4A12"), ("green", "2E7D32"), ("beige", "D8C3A5"), ("pink", "E91E63"), ("orange", "F57C00")]
+ADJECTIVES = ["Air", "Ultra", "Classic", "Trail", "Street", "Cloud", "Swift", "Urban", "Retro", "Prime", "Flex", "Storm"]
+NOUNS = ["Runner", "Glide", "Walker", "Court", "Boot", "Slide", "Trainer", "Racer", "Loafer", "Hiker", "Sneaker"]
+FEATURES = ["breathable mesh upper", "cushioned midsole", "rubber outsole", "water resistant", "removable insole",
+    "reflective details", "lightweight foam", "padded collar", "slip resistant", "recycled materials"]
+# how likely a rating is to give each number of stars
+STAR_WEIGHTS = [5, 7, 15, 33, 40]
+PLACEHOLDER_IMAGES = 8
+
+
+class Command(BaseCommand):
+    help = ("Fills the database with a reproducible synthetic catalog of shoes with colors, images, variants, "
+        "categories, buyers, purchases, ratings and carts, for benchmarking")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shoes", type=int, default=1000)
+        parser.add_argument("--users", type=int, help="defaults to one buyer per 10 shoes, at least 50")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--force", action="store_true", help="run without the benchmark settings")
+
+    def handle(self, *args, **options):
+        if not getattr(settings, "BENCHMARK", False) and not options["force"]:
+            raise CommandError("This writes synthetic data, run it with DJANGO_SETTINGS_MODULE=backend_django.settings_bench "
+                "or pass --force")
+        rng = random.Random(options["seed"])
+        started = time.monotonic()
+
+        self.create_categories()
+        for name in SIZES:
+            ShoeSize.objects.get_or_create(name=name)
+        users = self.create_users(options["users"] or max(50, options["shoes"] // 10))
+        images = self.create_placeholder_images()
+
+        importer = CatalogImporter(batch_size=options["batch_size"])
+        for start in range(0, options["shoes"], options["batch_size"]):
+            numbers = range(start, min(start + options["batch_size"], options["shoes"]))
+            with transaction.atomic():
+                records = [self.make_shoe(rng, number) for number in numbers]
+                existing = set(Shoe.objects.filter(sku__in=[record["sku"] for record in records]).values_list("sku", flat=True))
+                importer.write([importer.prepare(record) for record in records])
+                self.add_activity(rng, [record["sku"] for record in records if record["sku"] not in existing], users, images)
+            self.stdout.write(f"{numbers[-1] + 1} shoes in {time.monotonic() - started:.1f}s")
+
+        self.stdout.write(self.style.SUCCESS(f"Seeded {importer.counts['shoes']} shoes and {importer.counts['variants']} "
+            f"variants ({importer.counts['skipped']} already existed) in {time.monotonic() - started:.1f}s"))
+
+    def create_categories(self):
+        for parent_name, children in CATEGORIES.items():
+            parent, created = Category.objects.get_or_create(name=parent_name, defaults={"parent" : None})
+            for name in children:
+                Category.objects.get_or_create(name=name, defaults={"parent" : parent})
+
+    def create_users(self, count):
+        # created in bulk so the post_save signal doesn't register each of
+        # them with stripe
+        password = make_password("benchmark")
+        emails = [f"buyer{number}@bench.example.com" for number in range(count)]
+        existing = set(User.objects.filter(email__in=emails).values_list("email", flat=True))
+        User.objects.bulk_create([User(email=email, password=password, first_name="Bench", last_name=f"Buyer {number}",
+            user_type=2) for number, email in enumerate(emails) if email not in existing])
+        return list(User.objects.filter(email__in=emails).values_list("id", flat=True))
+
+    def create_placeholder_images(self):
+        """
+        A few stored images every seeded color picks its images from, as
+        blobs with their medium and thumbnail sizes
+        """
+        blobs = []
+        for number in range(PLACEHOLDER_IMAGES):
+            hue = int(255 * number / PLACEHOLDER_IMAGES)
+            files = []
+            for size in [(1200, 900), (300, 225), (128, 96)]:
+                content = io.BytesIO()
+                Image.new("RGB", size, (hue, 120, 255 - hue)).save(content, "JPEG")
+                files.append(ContentFile(content.getvalue(), name=f"placeholder{number}.jpg"))
+            # the references are counted once the images are created
+            blob = ImageBlob.objects.store(files[0])
+            if not blob.medium:
+                blob.medium.save(files[1].name, files[1], save=False)
+                blob.thumbnail.save(files[2].name, files[2], save=False)
+                blob.save(update_fields=["medium", "thumbnail"])
+            blobs.append(blob)
+        return blobs
+
+    def make_shoe(self, rng, number):
+        # a log-normal base price, most shoes costing 50 to 130
+        price = Decimal(min(max(rng.lognormvariate(math.log(80), 0.5), 15), 600)).quantize(Decimal("0.01"))
+        discount = rng.choice(["0.1", "0.2", "0.3"]) if rng.random() < 0.2 else "0"
+        colors = rng.sample(COLORS, rng.choices([1, 2, 3, 4], weights=[40, 30, 20, 10])[0])
+        first_size = rng.randint(0, 4)
+        sizes = SIZES[first_size:first_size + rng.randint(5, 10)]
+
+        categories = [rng.choice(CATEGORIES["gender"]), rng.choice(CATEGORIES["style"])]
+        if rng.random() < 0.5:
+            categories.append(rng.choice(CATEGORIES["season"]))
+        return {
+            "sku" : f"BENCH-{number:07d}",
+            "name" : f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {number}",
+            "description" : f"A {rng.choice(CATEGORIES['style'])} shoe with a {rng.choice(FEATURES)}.",
+            "display" : rng.random() < 0.9,
+            "features" : rng.sample(FEATURES, rng.randint(1, 5)),
+            "categories" : sorted(set(categories)),
+            "colors" : [{"name" : name, "hex_code" : hex_code} for name, hex_code in colors],
+            "variants" : [{"size" : size, "color" : name, "price" : price, "discount" : discount,
+                "quantity" : 0 if rng.random() < 0.1 else rng.randint(1, 40)} for name, hex_code in colors for size in sizes],
+        }
+
+    def add_activity(self, rng, skus, users, images):
+        """
+        Adds images to the colors of the new shoes, and has the buyers buy,
+        rate and put them in their carts. A few shoes get most ratings.
+        """
+        colors = list(ShoeColor.objects.filter(shoe__sku__in=skus).values_list("id", "shoe_id"))
+        ShoeImage.objects.bulk_create([ShoeImage(color_id=color_id, image=blob.file.name, medium=blob.medium.name,
+            thumbnail=blob.thumbnail.name, blob=blob, status=ShoeImage.READY)
+            for color_id, shoe_id in colors for blob in rng.sample(images, rng.randint(2, 5))])
+        ImageBlob.objects.recount([blob.hash for blob in images])
+
+        variants = {}
+        for variant_id, shoe_id, price, discount in ShoeVariant.objects.filter(shoe__sku__in=skus).values_list(
+                "id", "shoe_id", "price", "discount"):
+            variants.setdefault(shoe_id, []).append((variant_id, price, discount))
+
+        purchases = []
+        for shoe_id, shoe_variants in variants.items():
+            buyers = rng.sample(users, min(len(users), int(rng.paretovariate(1.2)) - 1, 50))
+            for user_id in buyers:
+                purchases.append((f"bench_{shoe_id}_{user_id}", user_id, shoe_id, rng.choice(shoe_variants)))
+        Transaction.objects.bulk_create([Transaction(payment_intent_id=payment_id, user_id=user_id)
+            for payment_id, user_id, shoe_id, variant in purchases])
+        transactions = dict(Transaction.objects.filter(payment_intent_id__in=[purchase[0] for purchase in purchases]).values_list(
+            "payment_intent_id", "id"))
+        Purchase.objects.bulk_create([Purchase(transaction_id=transactions[payment_id], shoe_id=variant_id,
+            quantity=rng.randint(1, 2), price=price, discount=discount)
+            for payment_id, user_id, shoe_id, (variant_id, price, discount) in purchases])
+        Rating.objects.bulk_create([Rating(shoe_id=shoe_id, user_id=user_id, stars=rng.choices(range(1, 6), weights=STAR_WEIGHTS)[0])
+            for payment_id, user_id, shoe_id, variant in purchases if rng.random() < 0.6])
+
+        CartItem.objects.bulk_create([CartItem(user_id=rng.choice(users), shoe_id=rng.choice(shoe_variants)[0], quantity=rng.randint(1, 3))
+            for shoe_variants in variants.values() if rng.random() < 0.3])
+
+        catalog_bulk_changed.send(sender=ShoeImage, shoe_ids=list(variants))
+        catalog_bulk_changed.send(sender=Rating, shoe_ids=list(variants))
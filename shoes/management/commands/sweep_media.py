@@ -0,0 +1,70 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from shoes.cleanup import get_referenced_names
+
+
+class Command(BaseCommand):
+    help = ("Deletes the files under MEDIA_ROOT no row refers to: those of rows deleted by a process that stopped "
+        "before deleting them, uploads of rolled back requests, and the copies of duplicate images left by the "
+        "image blob migration")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="list the files instead of deleting them")
+        parser.add_argument("--grace-hours", type=float, default=24,
+            help="files modified more recently are kept, they may belong to uploads still being saved")
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(settings.MEDIA_ROOT)
+        if not os.path.isdir(root):
+            raise CommandError(f"{root} is not a directory")
+        dry_run = options["dry_run"]
+
+        # files saved after this are younger than the grace period anyway
+        referenced = get_referenced_names()
+        cutoff = time.time() - options["grace_hours"] * 60 * 60
+
+        count = size = 0
+        folders = set()
+        for path, name, stat in self.scan(root):
+            if name in referenced or stat.st_mtime > cutoff:
+                continue
+            count += 1
+            size += stat.st_size
+            if dry_run or options["verbosity"] > 1:
+                self.stdout.write(name)
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                folders.add(os.path.dirname(path))
+        self.remove_empty(root, folders)
+
+        summary = f"{count} unreferenced files, {size / 1024 / 1024:.1f}MB"
+        self.stdout.write(f"Would delete {summary}" if dry_run else self.style.SUCCESS(f"Deleted {summary}"))
+
+    def scan(self, root):
+        # (path, name relative to the root as stored in the rows, stat) of
+        # every file under `root`
+        folders = [root]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.path, os.path.relpath(entry.path, root).replace(os.sep, "/"), entry.stat()
+
+    def remove_empty(self, root, folders):
+        # the folders emptied, such as those of a content hash prefix, and
+        # their parents emptied in turn
+        for folder in sorted(folders, key=len, reverse=True):
+            while folder != root and folder.startswith(root):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
@@ -0,0 +1,71 @@
+# Generated by Django 4.0.6 on 2026-10-18 13:35
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Avg, Count, F, Max, Min, Sum
+
+
+def build_summaries(apps, schema_editor):
+    Shoe = apps.get_model("shoes", "Shoe")
+    ShoeVariant = apps.get_model("shoes", "ShoeVariant")
+    ShoeImage = apps.get_model("shoes", "ShoeImage")
+    Rating = apps.get_model("shoes", "Rating")
+    ShoeSummary = apps.get_model("shoes", "ShoeSummary")
+
+    variants = ShoeVariant.objects.values("shoe_id").annotate(quantity=Sum("quantity"), price_min=Min("price"),
+        price_max=Max("price"), price_avg=Avg("price"), discounted_price_min=Min(F("price") - F("price") * F("discount")))
+    variants = {row.pop("shoe_id") : row for row in variants}
+    in_stock = set(ShoeVariant.objects.filter(quantity__gt=0).values_list("shoe_id", flat=True))
+    ratings = {row.pop("shoe_id") : row for row in Rating.objects.values("shoe_id").annotate(rating_sum=Sum("stars"), rating_count=Count("id"))}
+
+    # the first image of each shoe's default color, else of its first color
+    images = {}
+    for image in ShoeImage.objects.order_by("color_id", "id").values("id", "color__shoe_id", "color__name"):
+        current = images.get(image["color__shoe_id"])
+        if current is None or (image["color__name"] == "default" and current["color__name"] != "default"):
+            images[image["color__shoe_id"]] = image
+
+    ShoeSummary.objects.bulk_create([ShoeSummary(
+        shoe_id=shoe_id,
+        in_stock=shoe_id in in_stock,
+        primary_image_id=images[shoe_id]["id"] if shoe_id in images else None,
+        **variants.get(shoe_id, {}),
+        **ratings.get(shoe_id, {}),
+    ) for shoe_id in Shoe.objects.values_list("id", flat=True)], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0007_alter_category_parent_alter_shoe_date_restocked'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 13, 35, 52, 657273)),
+        ),
+        migrations.CreateModel(
+            name='ShoeSummary',
+            fields=[
+                ('shoe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='shoes.shoe')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('price_min', models.DecimalField(decimal_places=2, max_digits=7, null=True)),
+                ('price_max', models.DecimalField(decimal_places=2, max_digits=7, null=True)),
+                ('price_avg', models.DecimalField(decimal_places=2, max_digits=9, null=True)),
+                ('discounted_price_min', models.DecimalField(decimal_places=2, max_digits=9, null=True)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('in_stock', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('primary_image', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='shoes.shoeimage')),
+            ],
+            options={
+                'verbose_name_plural': 'shoe summaries',
+                'db_table': 'shoe_summary',
+            },
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
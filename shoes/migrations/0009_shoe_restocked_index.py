@@ -0,0 +1,23 @@
+# Generated by Django 4.0.6 on 2026-10-18 13:37
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0008_shoesummary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 13, 37, 14, 432889)),
+        ),
+        migrations.AddIndex(
+            model_name='shoe',
+            index=models.Index(fields=['date_restocked', 'id'], name='shoe_restocked_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.6 on 2026-10-18 13:40
+
+import datetime
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0009_shoe_restocked_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeStamp',
+            fields=[
+                ('scope', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('version', models.PositiveBigIntegerField(default=1)),
+                ('modified_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'change_stamp',
+            },
+        ),
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 13, 40, 34, 439177)),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.0.6 on 2026-10-18 13:42
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_closure(apps, schema_editor):
+    Category = apps.get_model("shoes", "Category")
+    CategoryClosure = apps.get_model("shoes", "CategoryClosure")
+
+    parents = dict(Category.objects.values_list("id", "parent_id"))
+    links = []
+    for category_id in parents:
+        ancestor_id, depth = category_id, 0
+        while ancestor_id is not None and depth <= len(parents):
+            links.append(CategoryClosure(ancestor_id=ancestor_id, descendant_id=category_id, depth=depth))
+            ancestor_id, depth = parents.get(ancestor_id), depth + 1
+    CategoryClosure.objects.bulk_create(links, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0010_changestamp'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 13, 42, 5, 233840)),
+        ),
+        migrations.CreateModel(
+            name='CategoryClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='shoes.category')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='shoes.category')),
+            ],
+            options={
+                'db_table': 'category_closure',
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
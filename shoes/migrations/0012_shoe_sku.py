@@ -0,0 +1,24 @@
+# Generated by Django 4.0.6 on 2026-10-18 13:46
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0011_categoryclosure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoe',
+            name='sku',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 13, 46, 12, 513772)),
+        ),
+    ]
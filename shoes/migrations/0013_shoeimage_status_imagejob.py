@@ -0,0 +1,64 @@
+# Generated by Django 4.0.6 on 2026-10-18 13:58
+
+import datetime
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0012_shoe_sku'),
+    ]
+
+    operations = [
+        # the existing images already have their sizes, new ones start pending
+        migrations.AddField(
+            model_name='shoeimage',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'pending'), (2, 'ready'), (3, 'failed')], default=2),
+        ),
+        migrations.AlterField(
+            model_name='shoeimage',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'pending'), (2, 'ready'), (3, 'failed')], default=1),
+        ),
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 13, 58, 51, 497825)),
+        ),
+        migrations.AlterField(
+            model_name='shoeimage',
+            name='medium',
+            field=models.ImageField(blank=True, upload_to='shoe_images/medium', validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['png', 'jpg', 'jpeg', 'webp'])]),
+        ),
+        migrations.AlterField(
+            model_name='shoeimage',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to='shoe_images/thumbnail', validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['png', 'jpg', 'jpeg', 'webp'])]),
+        ),
+        migrations.CreateModel(
+            name='ImageJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'queued'), (2, 'running'), (3, 'failed')], default=1)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('worker', models.CharField(blank=True, default='', max_length=100)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='shoes.shoeimage')),
+            ],
+            options={
+                'db_table': 'image_job',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='imagejob',
+            index=models.Index(fields=['status', 'available_at'], name='image_job_due_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.0.6 on 2026-10-18 14:01
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0013_shoeimage_status_imagejob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 14, 1, 9, 116439)),
+        ),
+        migrations.CreateModel(
+            name='ShoeImageDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('width', models.PositiveSmallIntegerField()),
+                ('height', models.PositiveSmallIntegerField()),
+                ('format', models.CharField(max_length=10)),
+                ('file', models.FileField(max_length=255, upload_to='shoe_images/derivatives')),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='shoes.shoeimage')),
+            ],
+            options={
+                'db_table': 'shoe_image_derivative',
+                'unique_together': {('image', 'width', 'format')},
+            },
+        ),
+    ]
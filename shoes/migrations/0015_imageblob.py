@@ -0,0 +1,125 @@
+# Generated by Django 4.0.6 on 2026-10-18 14:03
+
+import datetime
+import hashlib
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import shoes.storage
+
+
+def link_blobs(apps, schema_editor):
+    """
+    Gives every stored image the blob of the sha256 of its file. Images
+    with the same content share the blob and are pointed at its file
+    unless their color already shows it, and the derivatives of each image
+    move to its blob. The copies no row points at any more are left on
+    disk.
+    """
+    ShoeImage = apps.get_model("shoes", "ShoeImage")
+    ImageBlob = apps.get_model("shoes", "ImageBlob")
+    ShoeImageDerivative = apps.get_model("shoes", "ShoeImageDerivative")
+    storage = ShoeImage._meta.get_field("image").storage
+
+    for shoe_image in ShoeImage.objects.order_by("id").iterator():
+        name = shoe_image.image.name
+        if not name or not storage.exists(name):
+            continue
+        digest = hashlib.sha256()
+        with storage.open(name, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 16), b""):
+                digest.update(chunk)
+        blob, created = ImageBlob.objects.get_or_create(hash=digest.hexdigest(), defaults={"file" : name,
+            "size" : storage.size(name), "medium" : shoe_image.medium.name, "thumbnail" : shoe_image.thumbnail.name})
+        shoe_image.blob = blob
+        if not ShoeImage.objects.filter(image=blob.file.name, color_id=shoe_image.color_id).exclude(id=shoe_image.id).exists():
+            shoe_image.image = blob.file.name
+        shoe_image.save(update_fields=["blob", "image"])
+        ImageBlob.objects.filter(hash=blob.hash).update(refcount=models.F("refcount") + 1)
+
+    for derivative in ShoeImageDerivative.objects.select_related("image").order_by("id").iterator():
+        blob_id = derivative.image.blob_id
+        if blob_id is None or ShoeImageDerivative.objects.filter(blob_id=blob_id, width=derivative.width,
+                format=derivative.format).exists():
+            derivative.delete()
+            continue
+        derivative.blob_id = blob_id
+        derivative.save(update_fields=["blob"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoes', '0014_shoeimagederivative'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('file', models.ImageField(storage=shoes.storage.ContentAddressedStorage(), upload_to='shoe_images')),
+                ('medium', models.ImageField(blank=True, storage=shoes.storage.ContentAddressedStorage(), upload_to='shoe_images/medium')),
+                ('thumbnail', models.ImageField(blank=True, storage=shoes.storage.ContentAddressedStorage(), upload_to='shoe_images/thumbnail')),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'image_blob',
+            },
+        ),
+        migrations.AlterField(
+            model_name='shoe',
+            name='date_restocked',
+            field=models.DateTimeField(blank=True, default=datetime.datetime(2026, 10, 18, 14, 3, 45, 127026)),
+        ),
+        migrations.AlterField(
+            model_name='shoeimage',
+            name='image',
+            field=models.ImageField(storage=shoes.storage.ContentAddressedStorage(), upload_to='shoe_images', validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['png', 'jpg', 'jpeg', 'webp'])]),
+        ),
+        migrations.AlterField(
+            model_name='shoeimage',
+            name='medium',
+            field=models.ImageField(blank=True, storage=shoes.storage.ContentAddressedStorage(), upload_to='shoe_images/medium', validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['png', 'jpg', 'jpeg', 'webp'])]),
+        ),
+        migrations.AlterField(
+            model_name='shoeimage',
+            name='thumbnail',
+            field=models.ImageField(blank=True, storage=shoes.storage.ContentAddressedStorage(), upload_to='shoe_images/thumbnail', validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['png', 'jpg', 'jpeg', 'webp'])]),
+        ),
+        migrations.AlterField(
+            model_name='shoeimagederivative',
+            name='file',
+            field=models.FileField(max_length=255, storage=shoes.storage.ContentAddressedStorage(), upload_to='shoe_images/derivatives'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='shoeimagederivative',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='shoeimage',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='images', to='shoes.imageblob'),
+        ),
+        migrations.AddField(
+            model_name='shoeimagederivative',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='shoes.imageblob'),
+        ),
+        migrations.RunPython(link_blobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='shoeimagederivative',
+            name='image',
+        ),
+        migrations.AlterField(
+            model_name='shoeimagederivative',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='shoes.imageblob'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='shoeimagederivative',
+            unique_together={('blob', 'width', 'format')},
+        ),
+    ]
@@ -1,11 +1,53 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import (Avg, Case, Count, Exists, ExpressionWrapper, F, Max, Min, OuterRef,
+Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce
 from django.core.validators import FileExtensionValidator
 from django.core.exceptions import ValidationError
 from users.models import User
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from PIL import Image
+from .storage import get_content_hash, image_storage
+
+def variant_stats(shoe):
+    """
+    Stock and price figures of the shoe referenced by `shoe` (an OuterRef),
+    as correlated subqueries so joins don't multiply each other's rows
+    """
+    variants = ShoeVariant.objects.filter(shoe=shoe).order_by().values("shoe")
+    discounted_price = ExpressionWrapper(F("price") - F("price") * F("discount"),
+        output_field=models.DecimalField(max_digits=9, decimal_places=2))
+    return {
+        "quantity" : Coalesce(Subquery(variants.annotate(total=Sum("quantity")).values("total")), 0),
+        "price_min" : Subquery(variants.annotate(value=Min("price")).values("value")),
+        "price_max" : Subquery(variants.annotate(value=Max("price")).values("value")),
+        "price_avg" : Subquery(variants.annotate(value=Avg("price")).values("value")),
+        "discounted_price_min" : Subquery(variants.annotate(value=Min(discounted_price)).values("value")),
+        "in_stock" : Exists(variants.filter(quantity__gt=0)),
+    }
+
+def rating_stats(shoe):
+    ratings = Rating.objects.filter(shoe=shoe).order_by().values("shoe")
+    return {
+        "rating_sum" : Coalesce(Subquery(ratings.annotate(value=Sum("stars")).values("value")), 0),
+        "rating_count" : Coalesce(Subquery(ratings.annotate(value=Count("id")).values("value")), 0),
+    }
+
+def primary_image_stats(shoe):
+    # the first image of the shoe's default color, else of its first color
+    images = ShoeImage.objects.filter(color__shoe=shoe).order_by(
+        Case(When(color__name="default", then=Value(0)), default=Value(1)), "color_id", "id"
+    ).values("id")[:1]
+    return {"primary_image_id" : Subquery(images)}
+
+
+class ShoeQuerySet(models.QuerySet):
+
+    def with_listing_stats(self):
+        shoe = OuterRef("pk")
+        return self.annotate(**variant_stats(shoe), **rating_stats(shoe), **primary_image_stats(shoe))
 
 # each shoe 
 class Shoe(models.Model):
@@ -15,9 +57,17 @@ class Shoe(models.Model):
     display = models.BooleanField(default=False, null=False)
     date_added = models.DateTimeField(auto_now_add=True, null=False)
     date_restocked = models.DateTimeField(null=False, blank=True, default=datetime.now())
+    # the supplier's reference, which imported shoes are matched by
+    sku = models.CharField(max_length=64, null=True, blank=True, unique=True)
+
+    objects = ShoeQuerySet.as_manager()
 
     class Meta:
         db_table = "shoe"
+        indexes = [
+            # keyset pagination of the newest/oldest orderings
+            models.Index(fields=["date_restocked", "id"], name="shoe_restocked_idx"),
+        ]
 
     def __str__(self):
         return self.name
@@ -52,32 +102,199 @@ class ShoeColor(models.Model):
     def __str__(self):
         return f"{self.shoe.name} - {self.name}"
 
-# the images for each shoe
+class ImageBlobManager(models.Manager):
+
+    def get_hash(self, content):
+        # the sha256 `content` is stored under, without storing it
+        field = self.model._meta.get_field("file")
+        return get_content_hash(field.storage.get_content_name(field.generate_filename(None, content.name), content))
+
+    def store(self, content, content_hash=None):
+        """
+        Saves the uploaded `content` once for every ShoeImage showing it and
+        returns its blob, with one more reference. Content stored already,
+        including files the blob migration kept under their old names,
+        only gains the reference and isn't written again.
+        """
+        content_hash = content_hash or self.get_hash(content)
+        blob = self.filter(hash=content_hash).first()
+        if blob is None:
+            field = self.model._meta.get_field("file")
+            name = field.storage.save(field.generate_filename(None, content.name), content)
+            blob, created = self.get_or_create(hash=content_hash, defaults={"file" : name, "size" : content.size})
+        self.filter(hash=blob.hash).update(refcount=F("refcount") + 1)
+        return blob
+
+    def release(self, blob_hashes):
+        """
+        Drops one reference to each blob, deleting those no image shows
+        any more along with their files and derivatives
+        """
+        for blob_hash in blob_hashes:
+            self.filter(hash=blob_hash, refcount__gt=0).update(refcount=F("refcount") - 1)
+        for blob in self.filter(hash__in=blob_hashes, refcount=0):
+            blob.delete()
+
+    def recount(self, blob_hashes):
+        # for images written in bulk, which don't take their references
+        images = ShoeImage.objects.filter(blob=OuterRef("hash")).order_by().values("blob")
+        return self.filter(hash__in=blob_hashes).update(
+            refcount=Coalesce(Subquery(images.annotate(count=Count("id")).values("count")), 0))
+
+# an uploaded image file stored once under the sha256 of its content, see
+# shoes.storage, with its sizes and the number of shoe images showing it
+class ImageBlob(models.Model):
+    hash = models.CharField(max_length=64, primary_key=True)
+    file = models.ImageField(upload_to="shoe_images", storage=image_storage)
+    medium = models.ImageField(upload_to="shoe_images/medium", storage=image_storage, blank=True)
+    thumbnail = models.ImageField(upload_to="shoe_images/thumbnail", storage=image_storage, blank=True)
+    # the size of the file in bytes
+    size = models.PositiveIntegerField(null=False, default=0)
+    refcount = models.PositiveIntegerField(null=False, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ImageBlobManager()
+
+    class Meta:
+        db_table = "image_blob"
+
+    def __str__(self):
+        return f"{self.hash} - {self.refcount} references"
+
+# the images for each shoe. the medium and thumbnail sizes are made from
+# the image by the image job workers after the upload, see shoes.imaging.
+# the files are those of the image's blob, shared by every image with the
+# same content
 class ShoeImage(models.Model):
+    PENDING = 1
+    READY = 2
+    FAILED = 3
+    STATUS_CHOICES = [
+        (PENDING, "pending"),
+        (READY, "ready"),
+        (FAILED, "failed"),
+    ]
     id = models.AutoField(primary_key=True, blank=False, auto_created=True, null=False)
-    image = models.ImageField (null=False, blank=False, upload_to="shoe_images",validators=[FileExtensionValidator(allowed_extensions=["png", "jpg", "jpeg", "webp"])])
-    medium = models.ImageField(upload_to="shoe_images/medium", validators=[FileExtensionValidator(allowed_extensions=["png", "jpg", "jpeg", "webp"])])
-    thumbnail = models.ImageField(upload_to="shoe_images/thumbnail", validators=[FileExtensionValidator(allowed_extensions=["png", "jpg", "jpeg", "webp"])])
+    image = models.ImageField (null=False, blank=False, upload_to="shoe_images", storage=image_storage, validators=[FileExtensionValidator(allowed_extensions=["png", "jpg", "jpeg", "webp"])])
+    medium = models.ImageField(upload_to="shoe_images/medium", storage=image_storage, blank=True, validators=[FileExtensionValidator(allowed_extensions=["png", "jpg", "jpeg", "webp"])])
+    thumbnail = models.ImageField(upload_to="shoe_images/thumbnail", storage=image_storage, blank=True, validators=[FileExtensionValidator(allowed_extensions=["png", "jpg", "jpeg", "webp"])])
+    blob = models.ForeignKey(ImageBlob, on_delete=models.PROTECT, null=True, related_name="images")
     color = models.ForeignKey(ShoeColor, on_delete=models.CASCADE, related_name='images')
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, null=False, default=PENDING)
 
     class Meta:
         db_table = "shoe_image"
         unique_together = ["image", "color"]
 
-    def save(self, *args, **kwargs):
-        super().save()
-        thumbnail = Image.open(self.thumbnail.path)
-        medium = Image.open(self.medium.path)
 
-        if thumbnail.width > 128 or thumbnail.height > 128:
-            thumbnail_size = (128, int(128 * thumbnail.height / thumbnail.width)) if thumbnail.width <= thumbnail.height else (int(128 * thumbnail.width / thumbnail.height), 128)
-            thumbnail = thumbnail.resize(thumbnail_size)
-            thumbnail.save(self.thumbnail.path)
+# the responsive sizes of an image blob, made in each configured width and
+# format (webp, avif) by the image job workers along with its medium and
+# thumbnail sizes
+class ShoeImageDerivative(models.Model):
+    id = models.BigAutoField(primary_key=True, auto_created=True, null=False, blank=False)
+    blob = models.ForeignKey(ImageBlob, on_delete=models.CASCADE, related_name="derivatives")
+    width = models.PositiveSmallIntegerField(null=False)
+    height = models.PositiveSmallIntegerField(null=False)
+    format = models.CharField(max_length=10, null=False, blank=False)
+    file = models.FileField(upload_to="shoe_images/derivatives", storage=image_storage, max_length=255)
+    # the size of the file in bytes
+    size = models.PositiveIntegerField(null=False, default=0)
+
+    class Meta:
+        db_table = "shoe_image_derivative"
+        unique_together = ["blob", "width", "format"]
+
+    def __str__(self):
+        return f"{self.blob_id} - {self.width}w {self.format}"
+
+
+class ImageJobManager(models.Manager):
+
+    def enqueue(self, image_ids):
+        """
+        Queues the medium and thumbnail sizes of the images to be made
+        """
+        return self.bulk_create([ImageJob(image_id=image_id) for image_id in image_ids])
+
+    def claim(self, count, worker):
+        """
+        Switches up to `count` due jobs to running for `worker` and returns
+        them. The rows are locked skipping those other workers hold where
+        the database can, and only queued jobs are switched, so a job is
+        never claimed twice.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            due = self.select_for_update(skip_locked=connections[self.db].features.has_select_for_update_skip_locked).filter(
+                status=ImageJob.QUEUED, available_at__lte=now).order_by("available_at", "id")
+            ids = list(due.values_list("id", flat=True)[:count])
+            self.filter(id__in=ids, status=ImageJob.QUEUED).update(status=ImageJob.RUNNING, worker=worker,
+                started_at=now, attempts=F("attempts") + 1)
+        return list(self.filter(id__in=ids, status=ImageJob.RUNNING, worker=worker))
+
+    def complete(self, jobs):
+        # finished jobs are dropped, the image status records the outcome
+        self.filter(id__in=[job.id for job in jobs]).delete()
+
+    def fail(self, job, error, max_attempts, retry_delay):
+        """
+        Queues `job` again after a delay doubling with each attempt, or
+        marks it and its image failed after `max_attempts`
+        """
+        if job.attempts >= max_attempts:
+            self.filter(id=job.id).update(status=ImageJob.FAILED, error=error)
+            ShoeImage.objects.filter(id=job.image_id).update(status=ShoeImage.FAILED)
+        else:
+            available_at = timezone.now() + timedelta(seconds=retry_delay * 2 ** (job.attempts - 1))
+            self.filter(id=job.id).update(status=ImageJob.QUEUED, available_at=available_at, worker="", error=error)
+
+    def requeue_stale(self, timeout):
+        # jobs of workers that died while running them
+        started = timezone.now() - timedelta(seconds=timeout)
+        return self.filter(status=ImageJob.RUNNING, started_at__lt=started).update(status=ImageJob.QUEUED, worker="")
+
+    def backlog(self):
+        """
+        The number of jobs in each status and the age in seconds of the
+        oldest queued one
+        """
+        counts = dict(self.order_by().values_list("status").annotate(count=Count("id")))
+        oldest = self.filter(status=ImageJob.QUEUED).aggregate(oldest=Min("created_at"))["oldest"]
+        backlog = {label : counts.get(status, 0) for status, label in ImageJob.STATUS_CHOICES}
+        backlog["oldest_queued_seconds"] = (timezone.now() - oldest).total_seconds() if oldest else 0
+        return backlog
+
+# a queued job making the medium, thumbnail and responsive sizes of an
+# uploaded image, run by `manage.py process_image_jobs`
+class ImageJob(models.Model):
+    QUEUED = 1
+    RUNNING = 2
+    FAILED = 3
+    STATUS_CHOICES = [
+        (QUEUED, "queued"),
+        (RUNNING, "running"),
+        (FAILED, "failed"),
+    ]
+    id = models.BigAutoField(primary_key=True, auto_created=True, null=False, blank=False)
+    image = models.ForeignKey(ShoeImage, on_delete=models.CASCADE, related_name="jobs")
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, null=False, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(null=False, default=0)
+    available_at = models.DateTimeField(null=False, default=timezone.now)
+    worker = models.CharField(max_length=100, null=False, blank=True, default="")
+    started_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=False, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ImageJobManager()
+
+    class Meta:
+        db_table = "image_job"
+        indexes = [
+            models.Index(fields=["status", "available_at"], name="image_job_due_idx"),
+        ]
 
-        if medium.width > 300 or medium.height > 300:
-            medium_size = (300, int(300 * medium.height / medium.width)) if medium.width <= medium.height else (int(300 * medium.width / medium.height), 300)
-            medium = medium.resize(medium_size)
-            medium.save(self.medium.path)
+    def __str__(self):
+        return f"image {self.image_id} - {self.get_status_display()}"
 
 # shoe variants
 class ShoeVariant(models.Model):
@@ -112,6 +329,60 @@ class Category(models.Model):
     def __str__(self):
         return f"{self.name}"
 
+class CategoryClosureManager(models.Manager):
+
+    def link(self, category):
+        """
+        Links `category` and the categories under it to the ancestors of its
+        current parent. Called after a category is created or moved.
+        """
+        parents = self.filter(descendant_id=category.id, depth=1).values_list("ancestor_id", flat=True)
+        subtree = list(self.filter(ancestor_id=category.id).values_list("descendant_id", "depth"))
+        if subtree and list(parents) == ([category.parent_id] if category.parent_id else []):
+            return
+        if not subtree:
+            self.create(ancestor_id=category.id, descendant_id=category.id, depth=0)
+            subtree = [(category.id, 0)]
+
+        # unlinking the subtree from its previous ancestors
+        subtree_ids = [descendant_id for descendant_id, depth in subtree]
+        self.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        if category.parent_id is None or category.parent_id in subtree_ids:
+            return
+
+        ancestors = self.filter(descendant_id=category.parent_id).values_list("ancestor_id", "depth")
+        self.bulk_create([CategoryClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + 1 + depth)
+            for ancestor_id, ancestor_depth in ancestors for descendant_id, depth in subtree])
+
+    def rebuild(self):
+        parents = dict(Category.objects.values_list("id", "parent_id"))
+        links = []
+        for category_id in parents:
+            ancestor_id, depth = category_id, 0
+            while ancestor_id is not None and depth <= len(parents):
+                links.append(CategoryClosure(ancestor_id=ancestor_id, descendant_id=category_id, depth=depth))
+                ancestor_id, depth = parents.get(ancestor_id), depth + 1
+        self.all().delete()
+        self.bulk_create(links, batch_size=1000)
+
+# every (ancestor, descendant) pair of the category tree, each category being
+# its own ancestor at depth 0, so that everything under a category is found
+# with one indexed join instead of walking the tree
+class CategoryClosure(models.Model):
+    id = models.AutoField(primary_key=True, auto_created=True, null=False)
+    ancestor = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="ancestor_links")
+    depth = models.PositiveSmallIntegerField(null=False)
+
+    objects = CategoryClosureManager()
+
+    class Meta:
+        db_table = "category_closure"
+        unique_together = ["ancestor", "descendant"]
+
+    def __str__(self):
+        return f"{self.ancestor_id} > {self.descendant_id} ({self.depth})"
+
 # the category each shoe falls under
 class ShoeCategory(models.Model):
     id = models.AutoField(primary_key=True,blank=False, null=False, auto_created=True)
@@ -161,4 +432,106 @@ class Rating(models.Model):
         unique_together = ["user", "shoe"]
 
     def __str__(self):
-        return f"{self.user.first_name} {self.user.last_name} - {self.stars} star(s)"
\ No newline at end of file
+        return f"{self.user.first_name} {self.user.last_name} - {self.stars} star(s)"
+
+
+class ShoeSummaryQuerySet(models.QuerySet):
+
+    # each refresh is a single UPDATE that recomputes one group of figures
+    # for the selected summaries from the rows they are derived from
+
+    def refresh_variants(self):
+        return self.update(updated_at=timezone.now(), **variant_stats(OuterRef("shoe_id")))
+
+    def refresh_ratings(self):
+        return self.update(updated_at=timezone.now(), **rating_stats(OuterRef("shoe_id")))
+
+    def refresh_primary_image(self):
+        return self.update(updated_at=timezone.now(), **primary_image_stats(OuterRef("shoe_id")))
+
+    def rebuild(self, shoes=None, batch_size=500):
+        """
+        Recreates the summaries of `shoes` (every shoe by default) from scratch
+        """
+        shoes = Shoe.objects.all() if shoes is None else shoes
+        fields = [field.attname for field in ShoeSummary._meta.concrete_fields if field.attname not in ("shoe_id", "updated_at")]
+        self.filter(shoe__in=shoes.values("pk")).delete()
+
+        created = 0
+        batch = []
+        for shoe in shoes.order_by().with_listing_stats().values("pk", *fields).iterator(chunk_size=batch_size):
+            batch.append(ShoeSummary(shoe_id=shoe.pop("pk"), **shoe))
+            if len(batch) >= batch_size:
+                created += len(self.bulk_create(batch))
+                batch = []
+        if batch:
+            created += len(self.bulk_create(batch))
+        return created
+
+# precomputed stock, price and rating figures of each shoe, kept up to date
+# by the signals in signals.py so listings don't aggregate on every request
+class ShoeSummary(models.Model):
+    shoe = models.OneToOneField(Shoe, on_delete=models.CASCADE, primary_key=True, related_name="summary")
+    quantity = models.PositiveIntegerField(null=False, default=0)
+    price_min = models.DecimalField(max_digits=7, decimal_places=2, null=True)
+    price_max = models.DecimalField(max_digits=7, decimal_places=2, null=True)
+    price_avg = models.DecimalField(max_digits=9, decimal_places=2, null=True)
+    discounted_price_min = models.DecimalField(max_digits=9, decimal_places=2, null=True)
+    rating_sum = models.PositiveIntegerField(null=False, default=0)
+    rating_count = models.PositiveIntegerField(null=False, default=0)
+    primary_image = models.ForeignKey(ShoeImage, on_delete=models.SET_NULL, null=True, related_name="+")
+    in_stock = models.BooleanField(null=False, default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ShoeSummaryQuerySet.as_manager()
+
+    class Meta:
+        db_table = "shoe_summary"
+        verbose_name_plural = "shoe summaries"
+
+    def __str__(self):
+        return f"{self.shoe.name} summary"
+
+    @property
+    def rating_avg(self):
+        if self.rating_count > 0:
+            return self.rating_sum / self.rating_count
+        return 0
+
+
+class ChangeStampManager(models.Manager):
+
+    def bump(self, *scopes):
+        now = timezone.now()
+        for scope in scopes:
+            if self.filter(scope=scope).update(version=F("version") + 1, modified_at=now):
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(scope=scope, modified_at=now)
+            except IntegrityError:
+                # created by a concurrent write in the meantime
+                self.filter(scope=scope).update(version=F("version") + 1, modified_at=now)
+
+    def read(self, scopes):
+        """
+        Returns the {scope : stamp} of `scopes`, scopes never written to
+        having none
+        """
+        return self.in_bulk(scopes)
+
+# a version number bumped on every write to a table ("categories") or to
+# the rows of one shoe ("shoe:12"), so conditional requests can be
+# answered without building the response
+class ChangeStamp(models.Model):
+    scope = models.CharField(max_length=50, primary_key=True)
+    version = models.PositiveBigIntegerField(null=False, default=1)
+    modified_at = models.DateTimeField(null=False, default=timezone.now)
+
+    objects = ChangeStampManager()
+
+    class Meta:
+        db_table = "change_stamp"
+
+    def __str__(self):
+        return f"{self.scope} - {self.version}"
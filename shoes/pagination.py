@@ -0,0 +1,277 @@
+import json
+import operator
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from functools import reduce
+from django.conf import settings
+from django.db.models import DecimalField, Q, Value
+from django.db.models.functions import Coalesce
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class ShoeCursorPagination(BasePagination):
+    """
+    Keyset pagination for the shoe catalog.
+
+    Each page is fetched with a `WHERE (sort key) > (last key seen)` clause
+    rather than an OFFSET, so deep pages cost the same as the first one.
+    Every ordering ends with the shoe id so that ties are broken the same
+    way on every request. The cursor is an opaque base64 token holding the
+    ordering, the sort key of the row it points at and the direction.
+
+    Searches sorted by relevance are paged over the ranking of every
+    match, given as `ranking`, rather than sorted by the database: the
+    rows of the matches after the cursor are read a chunk at a time, in
+    the order of the ranking, until the page is full. Searches sorted
+    otherwise look up a few matches by id, or read the ids of the rows
+    in order a chunk at a time and keep the matches among them, so no
+    query lists every match.
+    """
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    ordering_query_param = "order"
+    invalid_cursor_message = "Invalid cursor"
+
+    # the accepted `order` values and the fields each of them sorts by
+    orderings = {
+        "id" : ("id",),
+        "id_desc" : ("-id",),
+        "price" : ("sort_price", "id"),
+        "price_desc" : ("-sort_price", "-id"),
+        "newest" : ("date_restocked", "id"),
+        "oldest" : ("-date_restocked", "-id"),
+        "relevance" : ("-relevance", "id"),
+    }
+    default_ordering = "id"
+    # how the sort key each ordering field holds in a cursor is read back
+    position_types = {
+        "id" : "int",
+        "relevance" : "int",
+        "sort_price" : "decimal",
+        "date_restocked" : "datetime",
+    }
+    # matches of a search looked up at a time, at least
+    ranking_chunk_size = 100
+
+    def __init__(self, ranking=None):
+        self.ranking = ranking
+
+    def get_page_size(self, request):
+        page_size = getattr(settings, "SHOE_LIST_PAGE_SIZE", 24)
+        max_page_size = getattr(settings, "SHOE_LIST_MAX_PAGE_SIZE", 100)
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, page_size))
+        except ValueError:
+            pass
+        return max(1, min(page_size, max_page_size))
+
+    def get_ordering(self, request, queryset):
+        ordering = request.query_params.get(self.ordering_query_param)
+
+        # searches are sorted by relevance unless asked otherwise
+        searching = self.ranking is not None
+        if ordering is None and searching:
+            return "relevance"
+        if ordering not in self.orderings or (ordering == "relevance" and not searching):
+            return self.default_ordering
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset)
+        fields = self.orderings[self.ordering]
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor["reverse"]
+
+        # shoes without variants sort as the cheapest ones
+        queryset = queryset.annotate(sort_price=Coalesce("summary__price_min", Value(Decimal("0")),
+            output_field=DecimalField(max_digits=7, decimal_places=2)))
+
+        # a previous page is read backwards from the cursor, then flipped
+        order_by = [self.invert(field) for field in fields] if reverse else list(fields)
+        if self.ordering == "relevance":
+            results = self.get_ranked(queryset, cursor, reverse)
+        else:
+            queryset = queryset.order_by(*order_by)
+            if cursor is not None:
+                queryset = queryset.filter(self.keyset_filter(order_by, cursor["position"]))
+            if self.ranking is None:
+                results = list(queryset[:self.page_size + 1])
+            else:
+                results = self.get_matching(queryset, order_by)
+        has_following = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = has_following if not reverse else cursor is not None
+        self.has_previous = has_following if reverse else cursor is not None
+        self.first = self.get_position(results[0], fields) if results else None
+        self.last = self.get_position(results[-1], fields) if results else None
+        return results
+
+    def get_ranked(self, queryset, cursor, reverse):
+        """
+        Up to a page and one rows of the matches after the cursor in the
+        ranking, or before it when `reverse`, each given its `relevance`
+        """
+        keys = [(-relevance, shoe_id) for shoe_id, relevance in self.ranking]
+        if cursor is None:
+            ranking = self.ranking
+        else:
+            relevance, shoe_id = cursor["position"]
+            if reverse:
+                ranking = self.ranking[:bisect_left(keys, (-relevance, shoe_id))][::-1]
+            else:
+                ranking = self.ranking[bisect_right(keys, (-relevance, shoe_id)):]
+
+        results = []
+        chunk_size = max(self.ranking_chunk_size, 4 * (self.page_size + 1))
+        for start in range(0, len(ranking), chunk_size):
+            chunk = ranking[start:start + chunk_size]
+            # matches the other filters leave out aren't found
+            rows = {self.get_id(row) : row for row in queryset.filter(id__in=[shoe_id for shoe_id, relevance in chunk])}
+            for shoe_id, relevance in chunk:
+                if shoe_id in rows:
+                    row = rows[shoe_id]
+                    if isinstance(row, dict):
+                        row["relevance"] = relevance
+                    else:
+                        row.relevance = relevance
+                    results.append(row)
+            if len(results) > self.page_size:
+                break
+        return results[:self.page_size + 1]
+
+    def get_matching(self, queryset, order_by):
+        """
+        Up to a page and one rows of the ordered `queryset` that match the
+        search
+        """
+        match_ids = {shoe_id for shoe_id, relevance in self.ranking}
+        chunk_size = max(self.ranking_chunk_size, 4 * (self.page_size + 1))
+        if len(match_ids) <= chunk_size:
+            return list(queryset.filter(id__in=match_ids)[:self.page_size + 1])
+
+        # every ordering ends with the id
+        keys = queryset.prefetch_related(None).values_list(*[field.lstrip("-") for field in order_by])
+        page_ids = []
+        while len(page_ids) <= self.page_size:
+            chunk = list(keys[:chunk_size])
+            page_ids += [key[-1] for key in chunk if key[-1] in match_ids]
+            if len(chunk) < chunk_size:
+                break
+            keys = keys.filter(self.keyset_filter(order_by, chunk[-1]))
+        page_ids = page_ids[:self.page_size + 1]
+
+        rows = {self.get_id(row) : row for row in queryset.filter(id__in=page_ids)}
+        return [rows[shoe_id] for shoe_id in page_ids if shoe_id in rows]
+
+    @staticmethod
+    def get_id(shoe):
+        return shoe["id"] if isinstance(shoe, dict) else shoe.id
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next" : self.get_next_link(),
+            "previous" : self.get_previous_link(),
+            "results" : data,
+        })
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        # an empty page reached backwards starts again from the top
+        if self.last is None:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.last, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.first is None:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.first, reverse=True)
+
+    # ------ CURSORS ------
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith("-") else "-" + field
+
+    @staticmethod
+    def keyset_filter(order_by, position):
+        # (a, b) > (x, y) is expanded to a > x OR (a = x AND b > y)
+        # since row value comparisons can't mix ascending and descending keys
+        clauses = []
+        for index, field in enumerate(order_by):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            equal = {other.lstrip("-") : value for other, value in zip(order_by[:index], position[:index])}
+            clauses.append(Q(**equal, **{f"{name}__{lookup}" : position[index]}))
+        return reduce(operator.or_, clauses)
+
+    @staticmethod
+    def get_position(shoe, fields):
+        position = []
+        for field in fields:
+            # the shoes are model instances or rows of values
+            value = shoe[field.lstrip("-")] if isinstance(shoe, dict) else getattr(shoe, field.lstrip("-"))
+            if isinstance(value, Decimal):
+                value = str(value)
+            elif hasattr(value, "isoformat"):
+                value = value.isoformat()
+            position.append(value)
+        return position
+
+    def encode_cursor(self, position, reverse):
+        token = json.dumps({"o" : self.ordering, "p" : position, "r" : int(reverse)}, separators=(",", ":"))
+        token = urlsafe_b64encode(token.encode()).decode().rstrip("=")
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            cursor = json.loads(urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+            position = cursor["p"]
+            reverse = bool(cursor["r"])
+            ordering = cursor["o"]
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # a cursor only points at a row for the ordering it was made with
+        fields = self.orderings[self.ordering]
+        if ordering != self.ordering or not isinstance(position, list) or len(position) != len(fields):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            position = [self.parse_position(field, value) for field, value in zip(fields, position)]
+        except (TypeError, ValueError, InvalidOperation):
+            raise NotFound(self.invalid_cursor_message)
+        return {"position" : position, "reverse" : reverse}
+
+    def parse_position(self, field, value):
+        # the sort key of `field` as encoded by get_position, raising
+        # TypeError or ValueError for anything else the client sent
+        kind = self.position_types[field.lstrip("-")]
+        if kind == "int":
+            if type(value) is not int:
+                raise TypeError(value)
+            return value
+        if not isinstance(value, str):
+            raise TypeError(value)
+        if kind == "decimal":
+            # within the digits of a price, which the lookup quantizes to
+            value = Decimal(value)
+            if not value.is_finite() or abs(value) >= 10 ** 5:
+                raise ValueError(value)
+            return value.quantize(Decimal("0.01"))
+        return datetime.fromisoformat(value)
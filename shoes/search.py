@@ -0,0 +1,143 @@
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Shoe, ShoeCategory, ShoeFeature
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# how much a match in each field counts towards the relevance of a shoe
+FIELD_WEIGHTS = {
+    "name" : 3.0,
+    "category" : 2.0,
+    "feature" : 1.0,
+    "description" : 1.0,
+}
+
+# a term matched only as the prefix of a word counts less than a whole word
+PREFIX_WEIGHT = 0.5
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class SearchIndex:
+    """
+    In-process inverted index over the shoe names, descriptions, features
+    and category names.
+
+    The index is rebuilt lazily on the first search after the catalog
+    changes. Changes are announced through a version number kept in the
+    default cache, so with a shared cache backend every worker notices
+    them. The index is also rebuilt once it is older than
+    SHOE_SEARCH_INDEX_TTL seconds.
+    """
+    version_key = "shoes:search_index_version"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.terms = []
+        self.version = None
+        self.built_at = 0
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, None)
+        self.built_at = 0
+
+    def get_version(self):
+        return cache.get_or_set(self.version_key, 1, None)
+
+    def is_stale(self, version):
+        ttl = getattr(settings, "SHOE_SEARCH_INDEX_TTL", 300)
+        return version != self.version or time.monotonic() - self.built_at > ttl
+
+    def build(self):
+        documents = {}
+
+        def add(shoe_id, field, text):
+            weights = documents.setdefault(shoe_id, {})
+            for token in tokenize(text):
+                weights[token] = weights.get(token, 0) + FIELD_WEIGHTS[field]
+
+        for shoe_id, name, description in Shoe.objects.values_list("id", "name", "description").iterator():
+            add(shoe_id, "name", name)
+            add(shoe_id, "description", description)
+        for shoe_id, feature in ShoeFeature.objects.values_list("shoe_id", "feature").iterator():
+            add(shoe_id, "feature", feature)
+        for shoe_id, category in ShoeCategory.objects.values_list("shoe_id", "category__name").iterator():
+            add(shoe_id, "category", category)
+
+        # weighting each term by how rare it is across the catalog
+        postings = {}
+        for shoe_id, weights in documents.items():
+            for token, weight in weights.items():
+                postings.setdefault(token, {})[shoe_id] = weight
+        for token, shoes in postings.items():
+            idf = math.log(1 + len(documents) / len(shoes))
+            for shoe_id in shoes:
+                shoes[shoe_id] *= idf
+
+        return postings
+
+    def ensure_built(self):
+        version = self.get_version()
+        if not self.is_stale(version):
+            return
+        with self.lock:
+            if not self.is_stale(version):
+                return
+            postings = self.build()
+
+            # the index is swapped in whole so searches running meanwhile
+            # keep reading the previous one
+            self.postings, self.terms = postings, sorted(postings)
+            self.version, self.built_at = version, time.monotonic()
+
+    def match(self, token):
+        """
+        The scores of the shoes containing `token` as a word or word prefix
+        """
+        postings, terms = self.postings, self.terms
+        scores = dict(postings.get(token, {}))
+        index = bisect_left(terms, token)
+        while index < len(terms) and terms[index].startswith(token):
+            if terms[index] != token:
+                for shoe_id, score in postings[terms[index]].items():
+                    scores[shoe_id] = max(scores.get(shoe_id, 0), score * PREFIX_WEIGHT)
+            index += 1
+        return scores
+
+    def search(self, query, limit=None):
+        """
+        Returns (shoe id, score) pairs of the shoes matching every word of
+        the query, most relevant first
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        self.ensure_built()
+
+        scores = None
+        for token in tokens:
+            matches = self.match(token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {shoe_id : score + matches[shoe_id] for shoe_id, score in scores.items() if shoe_id in matches}
+            if not scores:
+                return []
+
+        results = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return results[:limit] if limit else results
+
+
+search_index = SearchIndex()
@@ -1,25 +1,133 @@
 import operator
 import string
 from functools import reduce
-from django.core.exceptions import ValidationError
-from django.db.models import Q, Max, Min, Avg
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import transaction
+from django.db.models import Q, Max, Min, Avg, Count, Prefetch
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 
 from payments.models import Purchase
 from users.models import User
 from .validators import validate_file_extension
-from .models import (CartItem, Category, Rating, Shoe, ShoeCategory, ShoeFeature, ShoeImage, 
-ShoeSize, ShoeVariant, ShoeColor)
+from .signals import catalog_bulk_changed
+from .sizes import size_lookup
+from .models import (CartItem, Category, ImageBlob, ImageJob, Rating, Shoe, ShoeCategory, ShoeFeature, ShoeImage, 
+ShoeImageDerivative, ShoeSize, ShoeSummary, ShoeVariant, ShoeColor)
 
 
+def get_srcset_entry(url, width, height, format, request=None):
+    return {
+        "url" : request.build_absolute_uri(url) if request is not None else url,
+        "width" : width,
+        "height" : height,
+        "type" : f"image/{format}",
+    }
+
 class ShoeImageSerializer(serializers.ModelSerializer):
+    srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = ShoeImage
-        fields = "__all__"
+        fields = ["id", "image", "medium", "thumbnail", "status", "color", "srcset"]
+        # made from the image by the image job workers
+        read_only_fields = ["medium", "thumbnail", "status"]
+
+    def get_srcset(self, obj):
+        """
+        The responsive sizes of the image, by format then width, for the
+        client to pick the smallest one wide enough from. The blob and its
+        derivatives should be prefetched.
+        """
+        if obj.blob_id is None:
+            return []
+        request = self.context.get("request")
+        derivatives = sorted(obj.blob.derivatives.all(), key=lambda derivative: (derivative.format, derivative.width))
+        return [get_srcset_entry(derivative.file.url, derivative.width, derivative.height, derivative.format, request)
+            for derivative in derivatives]
+
+    def create(self, validated_data):
+        with transaction.atomic():
+            self.store_image(validated_data)
+            shoe_image = super().create(validated_data)
+            self.queue(shoe_image)
+        return shoe_image
+
+    def update(self, instance, validated_data):
+        if "image" not in validated_data:
+            return super().update(instance, validated_data)
+        previous = instance.blob_id
+        with transaction.atomic():
+            self.store_image(validated_data, instance)
+            shoe_image = super().update(instance, validated_data)
+            if previous is not None:
+                ImageBlob.objects.release([previous])
+            self.queue(shoe_image)
+        return shoe_image
+
+    def store_image(self, validated_data, instance=None):
+        # the upload is stored once for every image with the same content,
+        # whose sizes are shared too. duplicates are turned down before the
+        # file is written
+        content_hash = ImageBlob.objects.get_hash(validated_data["image"])
+        color = validated_data.get("color", instance.color if instance is not None else None)
+        duplicates = ShoeImage.objects.filter(blob=content_hash, color=color)
+        if instance is not None:
+            duplicates = duplicates.exclude(id=instance.id)
+        if duplicates.exists():
+            raise serializers.ValidationError({"image" : ["This image is already shown in this color"]})
+        blob = ImageBlob.objects.store(validated_data["image"], content_hash)
+        validated_data.update(image=blob.file.name, blob=blob, medium=blob.medium.name, thumbnail=blob.thumbnail.name,
+            status=ShoeImage.READY if blob.medium else ShoeImage.PENDING)
+
+    def queue(self, shoe_image):
+        if shoe_image.status == ShoeImage.PENDING:
+            ImageJob.objects.enqueue([shoe_image.id])
     
 
+class ShoeImageBatchSerializer(serializers.Serializer):
+    """
+    Images uploaded together for the color in `context["color"]`. Each is
+    stored once by content, the images are inserted in bulk and the sizes
+    of those not made before are queued for the image job workers at once.
+    """
+    images = serializers.ListField(child=serializers.ImageField(validators=[validate_file_extension]),
+        allow_empty=False, max_length=50)
+
+    def create(self, validated_data):
+        color = self.context["color"]
+        # duplicates are turned down before any file is written
+        hashes = [ImageBlob.objects.get_hash(image) for image in validated_data["images"]]
+        shown = set(ShoeImage.objects.filter(color=color, blob__in=hashes).values_list("blob", flat=True))
+        errors = {index : ["This image is already shown in this color"] for index, content_hash in enumerate(hashes)
+            if content_hash in shown or content_hash in hashes[:index]}
+        if errors:
+            raise serializers.ValidationError({"images" : errors})
+
+        with transaction.atomic():
+            blobs = [ImageBlob.objects.store(image, content_hash) for image, content_hash in zip(validated_data["images"], hashes)]
+            names = [blob.file.name for blob in blobs]
+            ShoeImage.objects.bulk_create([ShoeImage(color=color, image=blob.file.name, blob=blob, medium=blob.medium.name,
+                thumbnail=blob.thumbnail.name, status=ShoeImage.READY if blob.medium else ShoeImage.PENDING) for blob in blobs])
+            # the inserted ids aren't returned by every database, so the new
+            # images are read back by their file
+            images = ShoeImage.objects.filter(color=color, image__in=names).select_related("blob").prefetch_related(
+                "blob__derivatives")
+            images = {image.image.name : image for image in images}
+            images = [images[name] for name in names]
+
+            ImageJob.objects.enqueue([image.id for image in images if image.status == ShoeImage.PENDING])
+            # the references taken by store() are counted again from the rows
+            ImageBlob.objects.recount({blob.hash for blob in blobs})
+        catalog_bulk_changed.send(sender=ShoeImage, shoe_ids=[color.shoe_id])
+        return images
+
+
+def get_image_prefetches(lookup):
+    # the images under `lookup` with their blobs and derivatives, for the
+    # srcset of ShoeImageSerializer
+    return [Prefetch(lookup, queryset=ShoeImage.objects.select_related("blob")), f"{lookup}__blob__derivatives"]
+
 class ShoeColorSerializer(serializers.ModelSerializer):
     images = ShoeImageSerializer(many=True, read_only=True)
 
@@ -61,6 +169,131 @@ class ShoeVariantDetailSerializer(serializers.ModelSerializer):
         fields = "__all__"
         extra_kwargs = {"size": {"error_messages": {"null": "Enter a valid shoe size"}}}
 
+
+class ShoeVariantBulkListSerializer(serializers.ListSerializer):
+    """
+    Creates or updates a batch of variants of the shoe in `context["shoe_id"]`
+    with a single bulk insert or update. The batch is validated against the
+    shoe's colors and variants in two queries, and the errors of each item
+    are reported at its position in the batch.
+    """
+    # the model attribute each field is written to
+    attnames = {"size" : "size_id", "color" : "color_id"}
+
+    def get_existing(self):
+        if not hasattr(self, "existing"):
+            variants = self.instance if self.instance is not None else ShoeVariant.objects.filter(shoe_id=self.context["shoe_id"])
+            self.existing = {variant.id : variant for variant in variants}
+        return self.existing
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list) or not data:
+            raise serializers.ValidationError({"non_field_errors": ["Expected a non-empty list of variants"]})
+
+        items, errors = [], []
+        for item in data:
+            try:
+                items.append(self.child.run_validation(item))
+                errors.append({})
+            except serializers.ValidationError as exc:
+                items.append(None)
+                errors.append(exc.detail)
+
+        self.validate_batch(items, errors)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+    def validate_batch(self, items, errors):
+        existing = self.get_existing()
+        colors = set(ShoeColor.objects.filter(shoe_id=self.context["shoe_id"]).values_list("id", flat=True))
+        updating = self.instance is not None
+
+        # the (size, color) of every variant of the shoe once the batch is applied
+        pairs = {variant.id : (variant.size_id, variant.color_id) for variant in existing.values()}
+        positions = {}
+        for index, item in enumerate(items):
+            if item is None:
+                continue
+            if "color" in item and item["color"] not in colors:
+                errors[index]["color"] = ["Enter the id of a color of this shoe"]
+            if updating:
+                variant_id = item.get("id")
+                if variant_id not in existing:
+                    errors[index]["id"] = ["Enter the id of a variant of this shoe"]
+                    continue
+                if variant_id in positions:
+                    errors[index]["id"] = ["This variant is already in the batch"]
+                    continue
+            else:
+                variant_id = ("new", index)
+            size_id, color_id = pairs.get(variant_id, (None, None))
+            pairs[variant_id] = (item.get("size", size_id), item.get("color", color_id))
+            positions[variant_id] = index
+
+        owners = {}
+        for variant_id, pair in pairs.items():
+            owners.setdefault(pair, []).append(variant_id)
+        for variant_id, index in positions.items():
+            if len(owners[pairs[variant_id]]) > 1 and not errors[index]:
+                errors[index]["non_field_errors"] = ["A variant of this size and color already exists"]
+
+    def get_values(self, item):
+        return {self.attnames.get(field, field) : value for field, value in item.items() if field != "id"}
+
+    def reread(self, query):
+        variants = ShoeVariant.objects.filter(query, shoe_id=self.context["shoe_id"])
+        return list(variants.select_related("size", "color").prefetch_related(*get_image_prefetches("color__images")))
+
+    def create(self, validated_data):
+        shoe_id = self.context["shoe_id"]
+        ShoeVariant.objects.bulk_create([ShoeVariant(shoe_id=shoe_id, **self.get_values(item)) for item in validated_data])
+        catalog_bulk_changed.send(sender=ShoeVariant, shoe_ids=[shoe_id])
+
+        # the inserted ids aren't returned by every database, so the new
+        # variants are read back by their size and color
+        pairs = [(item["size"], item["color"]) for item in validated_data]
+        query = Q(size_id__in={size_id for size_id, color_id in pairs}, color_id__in={color_id for size_id, color_id in pairs})
+        variants = {(variant.size_id, variant.color_id) : variant for variant in self.reread(query)}
+        return [variants[pair] for pair in pairs]
+
+    def update(self, instance, validated_data):
+        existing = self.get_existing()
+        variants, fields = [], set()
+        for item in validated_data:
+            variant = existing[item["id"]]
+            for field in item:
+                if field != "id":
+                    setattr(variant, self.attnames.get(field, field), item[field])
+                    fields.add(field)
+            variants.append(variant)
+        if fields:
+            ShoeVariant.objects.bulk_update(variants, list(fields))
+            catalog_bulk_changed.send(sender=ShoeVariant, shoe_ids=[self.context["shoe_id"]])
+
+        variants = {variant.id : variant for variant in self.reread(Q(id__in=[item["id"] for item in validated_data]))}
+        return [variants[item["id"]] for item in validated_data]
+
+
+class ShoeVariantBulkSerializer(serializers.ModelSerializer):
+    """
+    A variant in a batch, its size given by name and its color by id
+    """
+    id = serializers.IntegerField(required=False)
+    size = serializers.CharField()
+    color = serializers.IntegerField()
+
+    class Meta:
+        model = ShoeVariant
+        fields = ["id", "size", "color", "quantity", "price", "discount"]
+        list_serializer_class = ShoeVariantBulkListSerializer
+
+    def validate_size(self, value):
+        size_id = size_lookup.get_id(value)
+        if size_id is None:
+            raise serializers.ValidationError("Enter a valid shoe size")
+        return size_id
+
 class CategoryListSerializer(serializers.ModelSerializer):
     class Meta:
         fields = "__all__"
@@ -105,60 +338,211 @@ class ShoeFeatureSerializer(serializers.ModelSerializer):
         fields = "__all__"
         model = ShoeFeature
 
-class ShoeListSerializer(serializers.ModelSerializer):
-    images = ShoeImageSerializer(many=True, read_only=True)
+def get_field_options(params):
+    """
+    The `fields` and `expand` query params as the keyword arguments of a
+    SparseFieldsMixin serializer
+    """
+    options = {}
+    for param in ["fields", "expand"]:
+        if params.get(param):
+            options[param] = {name.strip() for name in params[param].split(",") if name.strip()}
+    return options
+
+class SparseFieldsMixin:
+    """
+    Lets a serializer be narrowed to the names in `fields` and widened with
+    the optional relations in `expandable_fields` named in `expand`.
+
+    `load_related(queryset, **options)` then only joins and prefetches the
+    relations read by the fields that are left: `select_related_fields`
+    and `prefetch_related_fields` map each field to the lookups it needs.
+    """
+    expandable_fields = {}
+    select_related_fields = {}
+    prefetch_related_fields = {}
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        expand = set(expand or ()) & set(self.expandable_fields)
+        for name in expand:
+            serializer_class, serializer_kwargs = self.expandable_fields[name]
+            self.fields[name] = serializer_class(**serializer_kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields) - expand:
+                self.fields.pop(name)
+
+    @classmethod
+    def load_related(cls, queryset, **options):
+        field_names = cls(**options).fields.keys()
+        select_related, prefetch_related = [], []
+        for name in field_names:
+            select_related += [lookup for lookup in cls.select_related_fields.get(name, []) if lookup not in select_related]
+            prefetch_related += cls.prefetch_related_fields.get(name, [])
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+
+def get_summary(shoe):
+    # shoes created before summaries existed fall back to empty figures
+    try:
+        return shoe.summary
+    except ObjectDoesNotExist:
+        return ShoeSummary(shoe=shoe)
+
+# the prefetches of the relations a shoe can be serialized with
+shoe_prefetches = {
+    "features" : ["features"],
+    "categories" : [Prefetch("categories", queryset=ShoeCategory.objects.select_related("category", "shoe"))],
+    "colors" : [Prefetch("colors", queryset=ShoeColor.objects.prefetch_related(*get_image_prefetches("images")))],
+    "variants" : [Prefetch("variants", queryset=ShoeVariant.objects.select_related("size", "color").prefetch_related(
+        *get_image_prefetches("color__images")))],
+}
+
+class ShoeListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """
+    Reads the precomputed `ShoeSummary` of each shoe. The shoes should be
+    loaded through `load_related` so only the relations of the fields
+    kept are joined or prefetched.
+    """
     quantity = serializers.SerializerMethodField("get_quantity")
     price_min = serializers.SerializerMethodField("get_min_price")
     price_max = serializers.SerializerMethodField("get_max_price")
     price_avg = serializers.SerializerMethodField("get_avg_price")
     ratings = serializers.SerializerMethodField("get_ratings")
-    images = serializers.SerializerMethodField()
+    images = ShoeImageSerializer(source="summary.primary_image", read_only=True)
 
     class Meta:
         model = Shoe
         fields = ["id", "name","date_restocked", "images", "quantity", "price_min", "price_max", "price_avg", "ratings"]
 
+    expandable_fields = {
+        "features" : (ShoeFeatureSerializer, {"many" : True, "read_only" : True}),
+        "categories" : (ShoeCategoryListSerializer, {"many" : True, "read_only" : True}),
+        "colors" : (ShoeColorSerializer, {"many" : True, "read_only" : True}),
+    }
+    select_related_fields = {
+        "images" : ["summary", "summary__primary_image", "summary__primary_image__blob"],
+        "quantity" : ["summary"],
+        "price_min" : ["summary"],
+        "price_max" : ["summary"],
+        "price_avg" : ["summary"],
+        "ratings" : ["summary"],
+    }
+    prefetch_related_fields = {**shoe_prefetches, "images" : ["summary__primary_image__blob__derivatives"]}
+
     def get_quantity(self, obj):
-        available_sizes = ShoeVariant.objects.filter(shoe=obj)
-        qty = 0
-        for item in available_sizes:
-            qty+=item.quantity
-        return qty
+        return get_summary(obj).quantity
 
     def get_min_price(self, obj):
-        return ShoeVariant.objects.filter(shoe=obj).aggregate(Min('price'))["price__min"]
+        return get_summary(obj).price_min
 
     def get_max_price(self, obj):
-        return ShoeVariant.objects.filter(shoe=obj).aggregate(Max('price'))["price__max"]
+        return get_summary(obj).price_max
 
     def get_avg_price(self, obj):
-        return ShoeVariant.objects.filter(shoe=obj).aggregate(Avg('price'))["price__avg"]
+        return get_summary(obj).price_avg
 
     def get_ratings(self, obj):
-        ratings = Rating.objects.filter(shoe = obj)
-        count = ratings.count()
-        stars = 0
-        if count > 0:
-            for rating in ratings:
-                stars+= rating.stars
-            stars = stars/count
-        return {"stars" : stars, "count" : count}
-
-    def get_images(self, obj):
-        color = None
-        try:
-            color = ShoeColor.objects.get(name = "default")
-        except:
-            try:
-                color = ShoeColor.objects.filter().first()
-            except:
-                pass
-        if color:
-            return ShoeImageSerializer(color.images.first()).data
-
-
-
-class ShoeDetailSerializer(serializers.ModelSerializer):
+        summary = get_summary(obj)
+        return {"stars" : summary.rating_avg, "count" : summary.rating_count}
+
+
+class ShoeListValuesSerializer:
+    """
+    Read-only ShoeListSerializer building the same output straight from
+    the `.values()` rows of `load_related`, without model instances or a
+    serializer field per value. It can be narrowed with `fields` but not
+    expanded, ShoeListSerializer serves the lists with `expand`.
+    """
+    fields = ShoeListSerializer.Meta.fields
+    # the columns each field is built from
+    columns = {
+        "id" : ["id"],
+        "name" : ["name"],
+        "date_restocked" : ["date_restocked"],
+        "images" : ["summary__primary_image__id", "summary__primary_image__image", "summary__primary_image__medium",
+            "summary__primary_image__thumbnail", "summary__primary_image__status", "summary__primary_image__color",
+            "summary__primary_image__blob"],
+        "quantity" : ["summary__quantity"],
+        "price_min" : ["summary__price_min"],
+        "price_max" : ["summary__price_max"],
+        "price_avg" : ["summary__price_avg"],
+        "ratings" : ["summary__rating_sum", "summary__rating_count"],
+    }
+    date_field = serializers.DateTimeField()
+
+    def __init__(self, instance=None, many=False, fields=None, expand=None):
+        self.instance = instance
+        self.many = many
+        self.field_names = [name for name in self.fields if fields is None or name in fields]
+
+    @classmethod
+    def load_related(cls, queryset, fields=None, **options):
+        # the id and restock date are always read as the list is paginated
+        # by them, as are the annotations such as the search relevance
+        names = [name for name in cls.fields if fields is None or name in fields]
+        columns = ["id", "date_restocked"]
+        for name in names:
+            columns += [column for column in cls.columns[name] if column not in columns]
+        return queryset.values(*columns, *queryset.query.annotations)
+
+    @property
+    def data(self):
+        rows = self.instance if self.many else [self.instance]
+        if "images" in self.field_names:
+            self.srcsets = self.get_srcsets([row["summary__primary_image__blob"] for row in rows])
+        if self.many:
+            return [self.to_representation(row) for row in rows]
+        return self.to_representation(self.instance)
+
+    @staticmethod
+    def get_srcsets(blob_hashes):
+        # the srcset of every image listed, by blob, in one query
+        srcsets = {}
+        storage = ShoeImageDerivative._meta.get_field("file").storage
+        derivatives = ShoeImageDerivative.objects.filter(blob__in=[blob_hash for blob_hash in blob_hashes if blob_hash is not None])
+        for blob_hash, name, width, height, format in derivatives.order_by("format", "width").values_list(
+                "blob", "file", "width", "height", "format"):
+            srcsets.setdefault(blob_hash, []).append(get_srcset_entry(storage.url(name), width, height, format))
+        return srcsets
+
+    def to_representation(self, row):
+        # shoes created before summaries existed have no summary columns
+        ret = {}
+        for name in self.field_names:
+            if name == "date_restocked":
+                ret[name] = self.date_field.to_representation(row["date_restocked"])
+            elif name == "images":
+                ret[name] = self.get_image(row)
+            elif name == "quantity":
+                ret[name] = row["summary__quantity"] or 0
+            elif name == "ratings":
+                count = row["summary__rating_count"] or 0
+                ret[name] = {"stars" : row["summary__rating_sum"] / count if count > 0 else 0, "count" : count}
+            elif name in ("price_min", "price_max", "price_avg"):
+                ret[name] = row[f"summary__{name}"]
+            else:
+                ret[name] = row[name]
+        return ret
+
+    def get_image(self, row):
+        if row["summary__primary_image__id"] is None:
+            return None
+        ret = {"id" : row["summary__primary_image__id"]}
+        for name in ["image", "medium", "thumbnail"]:
+            path = row[f"summary__primary_image__{name}"]
+            ret[name] = ShoeImage._meta.get_field(name).storage.url(path) if path else None
+        ret["status"] = row["summary__primary_image__status"]
+        ret["color"] = row["summary__primary_image__color"]
+        ret["srcset"] = self.srcsets.get(row["summary__primary_image__blob"], [])
+        return ret
+
+
+class ShoeDetailSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     features = ShoeFeatureSerializer(many = True, read_only = False,required = False)
     categories = ShoeCategoryListSerializer(many=True, read_only=False, required=False)
     ratings = serializers.SerializerMethodField()
@@ -168,15 +552,54 @@ class ShoeDetailSerializer(serializers.ModelSerializer):
         fields = "__all__"
         depth = 1
 
+    expandable_fields = {
+        "colors" : (ShoeColorSerializer, {"many" : True, "read_only" : True}),
+        "variants" : (ShoeVariantListSerializer, {"many" : True, "read_only" : True}),
+    }
+    select_related_fields = {"ratings" : ["summary"]}
+    prefetch_related_fields = shoe_prefetches
+
+    def get_ratings(self, obj):
+        summary = get_summary(obj)
+        return {"stars" : summary.rating_avg, "count" : summary.rating_count}
+
+class ShoePageVariantSerializer(serializers.ModelSerializer):
+    """
+    A variant with the name of its size and the id of its color, the
+    colors being listed next to the variants on a product page
+    """
+    size = serializers.SerializerMethodField("get_shoe_size_name")
+
+    class Meta:
+        model = ShoeVariant
+        fields = ["id", "size", "color", "quantity", "price", "discount"]
+
+    def get_shoe_size_name(self, obj):
+        return obj.size.name
+
+class ShoePageSerializer(ShoeDetailSerializer):
+    """
+    Everything a product page shows: the shoe with its features and
+    categories, its colors with their images, its variants and how its
+    ratings are spread over the stars. Loaded through `load_related`, it
+    takes the same number of queries whatever the size of the shoe.
+    """
+    colors = ShoeColorSerializer(many=True, read_only=True)
+    variants = ShoePageVariantSerializer(many=True, read_only=True)
+
+    class Meta(ShoeDetailSerializer.Meta):
+        pass
+
+    prefetch_related_fields = {
+        **shoe_prefetches,
+        "variants" : [Prefetch("variants", queryset=ShoeVariant.objects.select_related("size").order_by("id"))],
+    }
+
     def get_ratings(self, obj):
-        ratings = Rating.objects.filter(shoe = obj)
-        count = ratings.count()
-        stars = 0
-        if count > 0:
-            for rating in ratings:
-                stars+= rating.stars
-            stars = stars/count
-        return {"stars" : stars, "count" : count}
+        ratings = super().get_ratings(obj)
+        counts = dict(Rating.objects.filter(shoe=obj).order_by().values_list("stars").annotate(count=Count("id")))
+        ratings["distribution"] = {stars : counts.get(stars, 0) for stars, label in Rating.STAR_CHOICES}
+        return ratings
 
 class ShoeSerializer(serializers.ModelSerializer):
     features = ShoeFeatureSerializer(many = True, read_only = False, required = False)
@@ -1,16 +1,265 @@
-import os
-from django.db.models.signals import post_delete
-from django.dispatch import receiver
-from .models import ShoeImage
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from .models import (Category, CategoryClosure, ChangeStamp, ImageBlob, Rating, Shoe, ShoeCategory, ShoeColor, ShoeFeature, ShoeImage,
+ShoeImageDerivative, ShoeSize, ShoeSummary, ShoeVariant)
+from .cache import get_list_cache
+from .cleanup import file_cleaner
+from .search import search_index
+from .sizes import size_lookup
 
 
+# bulk_create and bulk_update don't send post_save, so code writing the
+# catalog in bulk sends this instead, with the model written as the sender
+# and the ids of the shoes whose rows changed as `shoe_ids`
+catalog_bulk_changed = Signal()
+
+
+# the files of deleted rows are deleted once the delete commits, in the
+# background, see shoes.cleanup
+
 @receiver(post_delete, sender=ShoeImage)
 def clear_images(sender, instance, **kwargs):
-    if instance.medium:
-        os.remove(instance.medium.path)
-    if instance.thumbnail:
-        os.remove(instance.thumbnail.path)
-    if instance.image:
-        os.remove(instance.image.path)
+    # the files are the blob's, deleted once no image shows it
+    if instance.blob_id is not None:
+        ImageBlob.objects.release([instance.blob_id])
+        return
+    file_cleaner.delete_on_commit([instance.medium, instance.thumbnail, instance.image])
+
+@receiver(post_delete, sender=ImageBlob)
+def clear_blob(sender, instance, **kwargs):
+    file_cleaner.delete_on_commit([instance.medium, instance.thumbnail, instance.file])
+
+@receiver(post_delete, sender=ShoeImageDerivative)
+def clear_derivative(sender, instance, **kwargs):
+    file_cleaner.delete_on_commit([instance.file])
+
+
+# ------ SHOE SUMMARIES ------
+
+def refresh_summary(summaries, part, shoe_id=None):
+    """
+    Runs the `part` refresh on the matching summaries. When `shoe_id` is given
+    and the shoe has no summary yet, it is built from scratch instead.
+    """
+    updated = getattr(summaries, part)()
+    if not updated and shoe_id is not None:
+        ShoeSummary.objects.rebuild(Shoe.objects.filter(pk=shoe_id))
+
+@receiver(post_save, sender=Shoe)
+def create_summary(sender, instance, created, **kwargs):
+    if created:
+        ShoeSummary.objects.create(shoe=instance)
+
+# shoes are only written in bulk by the catalog import, along with their
+# variants, colors, features and categories
+@receiver(catalog_bulk_changed, sender=Shoe)
+def shoes_bulk_changed(sender, shoe_ids, **kwargs):
+    ShoeSummary.objects.rebuild(Shoe.objects.filter(pk__in=shoe_ids))
+
+@receiver(post_save, sender=ShoeVariant)
+def variant_saved(sender, instance, **kwargs):
+    refresh_summary(ShoeSummary.objects.filter(shoe_id=instance.shoe_id), "refresh_variants", instance.shoe_id)
+
+# summaries missing on delete aren't rebuilt since the shoe itself may be
+# what is being deleted
+@receiver(post_delete, sender=ShoeVariant)
+def variant_deleted(sender, instance, **kwargs):
+    refresh_summary(ShoeSummary.objects.filter(shoe_id=instance.shoe_id), "refresh_variants")
+
+@receiver(catalog_bulk_changed, sender=ShoeVariant)
+def variants_bulk_changed(sender, shoe_ids, **kwargs):
+    refresh_summary(ShoeSummary.objects.filter(shoe_id__in=shoe_ids), "refresh_variants")
+
+@receiver(catalog_bulk_changed, sender=Rating)
+def ratings_bulk_changed(sender, shoe_ids, **kwargs):
+    refresh_summary(ShoeSummary.objects.filter(shoe_id__in=shoe_ids), "refresh_ratings")
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, **kwargs):
+    refresh_summary(ShoeSummary.objects.filter(shoe_id=instance.shoe_id), "refresh_ratings", instance.shoe_id)
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, **kwargs):
+    refresh_summary(ShoeSummary.objects.filter(shoe_id=instance.shoe_id), "refresh_ratings")
+
+# the primary image is the first image of the shoe's default color, else of
+# its first color. the handlers below skip the refresh whenever a write
+# can't change which image that is.
+
+@receiver(post_save, sender=ShoeColor)
+def color_saved(sender, instance, created, **kwargs):
+    # a new color has no images yet, a renamed one may become the default
+    if not created:
+        refresh_summary(ShoeSummary.objects.filter(shoe_id=instance.shoe_id), "refresh_primary_image", instance.shoe_id)
+
+@receiver(post_delete, sender=ShoeColor)
+def color_deleted(sender, instance, **kwargs):
+    # the images of the color were deleted (and refreshed) before it
+    refresh_summary(ShoeSummary.objects.filter(shoe_id=instance.shoe_id, primary_image__isnull=True), "refresh_primary_image")
+
+@receiver(post_save, sender=ShoeImage)
+def image_saved(sender, instance, created, **kwargs):
+    summaries = ShoeSummary.objects.filter(shoe__colors=instance.color_id)
+    # a new image comes after every image of its color, so it can only
+    # become primary for a shoe whose primary image is in another color
+    if created:
+        summaries = summaries.exclude(primary_image__color_id=instance.color_id)
+    refresh_summary(summaries, "refresh_primary_image")
+
+@receiver(post_delete, sender=ShoeImage)
+def image_deleted(sender, instance, **kwargs):
+    # deleting the primary image sets the pointer to it to NULL first,
+    # other images leave the primary image as it is
+    refresh_summary(ShoeSummary.objects.filter(shoe__colors=instance.color_id, primary_image__isnull=True), "refresh_primary_image")
+
+@receiver(catalog_bulk_changed, sender=ShoeImage)
+def images_bulk_changed(sender, shoe_ids, **kwargs):
+    refresh_summary(ShoeSummary.objects.filter(shoe_id__in=shoe_ids), "refresh_primary_image")
+
+# ------ CATEGORY CLOSURE ------
+
+# links are removed along with the category by the cascade
+@receiver(post_save, sender=Category)
+def link_category(sender, instance, **kwargs):
+    CategoryClosure.objects.link(instance)
+
+
+# ------ SIZE LOOKUP ------
+
+@receiver(post_save, sender=ShoeSize)
+@receiver(post_delete, sender=ShoeSize)
+def invalidate_size_lookup(sender, **kwargs):
+    size_lookup.invalidate()
+
+
+# ------ SEARCH INDEX ------
+
+@receiver(post_save, sender=Shoe)
+@receiver(post_delete, sender=Shoe)
+@receiver(post_save, sender=ShoeFeature)
+@receiver(post_delete, sender=ShoeFeature)
+@receiver(post_save, sender=ShoeCategory)
+@receiver(post_delete, sender=ShoeCategory)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(catalog_bulk_changed, sender=Shoe)
+def invalidate_search_index(sender, **kwargs):
+    # once the write commits, or the index could be rebuilt from the rows
+    # of before it under the new version
+    transaction.on_commit(search_index.invalidate)
+
+
+# ------ SHOE LIST CACHE ------
+
+# the counters are bumped once the write commits. bumped before, a list
+# read meanwhile could store the rows of before the write as current
+
+# these can change which shoes match a filter or the order they come in
+@receiver(post_save, sender=Shoe)
+@receiver(post_delete, sender=Shoe)
+@receiver(post_save, sender=ShoeVariant)
+@receiver(post_delete, sender=ShoeVariant)
+@receiver(catalog_bulk_changed, sender=Shoe)
+@receiver(catalog_bulk_changed, sender=ShoeVariant)
+@receiver(post_save, sender=ShoeCategory)
+@receiver(post_delete, sender=ShoeCategory)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+# features are searched by `q`, see shoes.search
+@receiver(post_save, sender=ShoeFeature)
+@receiver(post_delete, sender=ShoeFeature)
+def invalidate_shoe_lists(sender, **kwargs):
+    list_cache = get_list_cache()
+    if list_cache:
+        transaction.on_commit(list_cache.invalidate_all)
+
+# these only change how a single shoe is shown in a list
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+@receiver(post_save, sender=ShoeColor)
+@receiver(post_delete, sender=ShoeColor)
+def invalidate_listed_shoe(sender, instance, **kwargs):
+    invalidate_listed_shoes(sender, [instance.shoe_id])
+
+@receiver(catalog_bulk_changed, sender=Rating)
+@receiver(catalog_bulk_changed, sender=ShoeImage)
+def invalidate_listed_shoes(sender, shoe_ids, **kwargs):
+    list_cache = get_list_cache()
+    if list_cache:
+        transaction.on_commit(partial(invalidate_cached_shoes, list_cache, list(shoe_ids)))
+
+@receiver(post_save, sender=ShoeImage)
+@receiver(post_delete, sender=ShoeImage)
+def invalidate_listed_shoe_image(sender, instance, **kwargs):
+    if get_list_cache():
+        invalidate_listed_shoes(sender, ShoeColor.objects.filter(id=instance.color_id).values_list("shoe_id", flat=True))
+
+def invalidate_cached_shoes(list_cache, shoe_ids):
+    for shoe_id in shoe_ids:
+        list_cache.invalidate_shoe(shoe_id)
+
+
+# ------ CHANGE STAMPS ------
+
+# the stamps each catalog endpoint derives its ETag from:
+#   shoe:<id>     the shoe, its features, categories and ratings
+#   colors:<id>   the colors of the shoe and their images
+#   variants:<id> the variants of the shoe
+#   categories    the category table
+#   sizes         the shoe size table
+
+# shoes written in bulk are new ones, which have no stamps to bump yet
+@receiver(post_save, sender=Shoe)
+@receiver(post_delete, sender=Shoe)
+def stamp_shoe(sender, instance, **kwargs):
+    ChangeStamp.objects.bump(f"shoe:{instance.id}")
+
+@receiver(post_save, sender=ShoeFeature)
+@receiver(post_delete, sender=ShoeFeature)
+@receiver(post_save, sender=ShoeCategory)
+@receiver(post_delete, sender=ShoeCategory)
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def stamp_shoe_details(sender, instance, **kwargs):
+    ChangeStamp.objects.bump(f"shoe:{instance.shoe_id}")
+
+# the variants embed their color and its images
+@receiver(post_save, sender=ShoeColor)
+@receiver(post_delete, sender=ShoeColor)
+def stamp_shoe_colors(sender, instance, **kwargs):
+    ChangeStamp.objects.bump(f"colors:{instance.shoe_id}", f"variants:{instance.shoe_id}")
+
+@receiver(post_save, sender=ShoeImage)
+@receiver(post_delete, sender=ShoeImage)
+def stamp_shoe_images(sender, instance, **kwargs):
+    for shoe_id in ShoeColor.objects.filter(id=instance.color_id).values_list("shoe_id", flat=True):
+        ChangeStamp.objects.bump(f"colors:{shoe_id}", f"variants:{shoe_id}")
+
+@receiver(catalog_bulk_changed, sender=ShoeImage)
+def stamp_bulk_images(sender, shoe_ids, **kwargs):
+    ChangeStamp.objects.bump(*[scope for shoe_id in shoe_ids for scope in (f"colors:{shoe_id}", f"variants:{shoe_id}")])
+
+@receiver(catalog_bulk_changed, sender=Rating)
+def stamp_bulk_ratings(sender, shoe_ids, **kwargs):
+    ChangeStamp.objects.bump(*[f"shoe:{shoe_id}" for shoe_id in shoe_ids])
+
+@receiver(post_save, sender=ShoeVariant)
+@receiver(post_delete, sender=ShoeVariant)
+def stamp_shoe_variants(sender, instance, **kwargs):
+    ChangeStamp.objects.bump(f"variants:{instance.shoe_id}")
+
+@receiver(catalog_bulk_changed, sender=ShoeVariant)
+def stamp_bulk_variants(sender, shoe_ids, **kwargs):
+    ChangeStamp.objects.bump(*[f"variants:{shoe_id}" for shoe_id in shoe_ids])
 
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def stamp_categories(sender, **kwargs):
+    ChangeStamp.objects.bump("categories")
 
+@receiver(post_save, sender=ShoeSize)
+@receiver(post_delete, sender=ShoeSize)
+def stamp_sizes(sender, **kwargs):
+    ChangeStamp.objects.bump("sizes")
@@ -0,0 +1,66 @@
+import threading
+import time
+from types import MappingProxyType
+from django.conf import settings
+
+from .models import ShoeSize
+
+
+class SizeLookup:
+    """
+    Process-wide, read-only name -> id map of the shoe sizes.
+
+    Sizes are a tiny table that hardly ever changes, so each worker loads it
+    once and drops it on its own ShoeSize writes. Writes made by other
+    workers are picked up after SHOE_SIZE_LOOKUP_TTL seconds, or sooner
+    when a name isn't found.
+    """
+    # the least time between two reloads caused by unknown names
+    miss_reload_interval = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = MappingProxyType({})
+        self.names = MappingProxyType({})
+        self.loaded_at = None
+
+    def reload(self):
+        ids = dict(ShoeSize.objects.values_list("name", "id"))
+        with self.lock:
+            self.ids = MappingProxyType(ids)
+            self.names = MappingProxyType({size_id : name for name, size_id in ids.items()})
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def ensure_loaded(self, missing=False):
+        ttl = getattr(settings, "SHOE_SIZE_LOOKUP_TTL", 300)
+        age = time.monotonic() - self.loaded_at if self.loaded_at is not None else None
+        if age is None or age > ttl or (missing and age > self.miss_reload_interval):
+            self.reload()
+
+    def get_ids(self, names):
+        """
+        The ids of the sizes called `names`, unknown names being left out
+        """
+        self.ensure_loaded()
+        if any(name not in self.ids for name in names):
+            self.ensure_loaded(missing=True)
+        ids = self.ids
+        return [ids[name] for name in names if name in ids]
+
+    def get_id(self, name):
+        if name is None or isinstance(name, (list, dict)):
+            return None
+        ids = self.get_ids([str(name)])
+        return ids[0] if ids else None
+
+    def get_name(self, size_id):
+        self.ensure_loaded()
+        if size_id not in self.names:
+            self.ensure_loaded(missing=True)
+        return self.names.get(size_id)
+
+
+size_lookup = SizeLookup()
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+def get_content_hash(name):
+    # the sha256 a name given by ContentAddressedStorage is made of
+    return os.path.splitext(posixpath.basename(name))[0]
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every file under the sha256 of its content, as
+    `<upload directory>/<first 2 hex digits>/<sha256><extension>`, so the
+    same content saved again is stored once and its existing name is
+    returned instead of a suffixed copy.
+    """
+
+    def get_content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content_hash = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return posixpath.join(posixpath.dirname(name), content_hash[:2], content_hash + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            return name
+
+        # written aside then moved in place, so a concurrent save of the
+        # same content only replaces the file with the same bytes
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.directory_permissions_mode is not None:
+            os.chmod(os.path.dirname(path), self.directory_permissions_mode)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+            # uploads streamed to a temporary file are moved rather than copied
+            if not hasattr(content, "temporary_file_path"):
+                for chunk in content.chunks():
+                    file.write(chunk)
+        if hasattr(content, "temporary_file_path"):
+            file_move_safe(content.temporary_file_path(), file.name, allow_overwrite=True)
+        os.chmod(file.name, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+        os.replace(file.name, path)
+        return name
+
+
+image_storage = ContentAddressedStorage()
@@ -1,3 +1,965 @@
-from django.test import TestCase
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from users.models import User
+
+from .filters import ShoeFilter
+from .facets import count_facets
+from .categories import category_tree
+from .cleanup import file_cleaner
+from .cache import LocalMemoryBackend, ResponseCache, reset_list_cache
+from .imagecache import DiskLRUCache
+from .pagination import ShoeCursorPagination
+from .search import search_index
+from .models import (Category, CategoryClosure, ImageBlob, ImageJob, Shoe, ShoeCategory, ShoeColor, ShoeFeature,
+    ShoeImage, ShoeImageDerivative, ShoeSize, ShoeVariant)
+
+
+def create_admin():
+    # without the Stripe customer the signals make for new users, and made
+    # an admin with an update since saving one runs the signals again
+    with mock.patch("users.signals.stripe.Customer") as customer:
+        customer.create.return_value.id = "cus_test"
+        user = User.objects.create(email="admin@example.com", first_name="store", last_name="admin", user_type=2)
+    User.objects.filter(id=user.id).update(user_type=1, is_staff=True)
+    user.refresh_from_db()
+    return user
+
+
+class CatalogTestCase(TestCase):
+    """
+    A small catalog of shoes with colors, images, responsive sizes and
+    variants. Prices and restock dates repeat so the orderings have ties to
+    break.
+    """
+    # the list is answered by the view rather than from the cache, unless
+    # a test case turns it on
+    list_cache = {"BACKEND" : None}
+
+    @classmethod
+    def setUpTestData(cls):
+        men = Category.objects.create(name="men", parent=Category.objects.create(name="gender"))
+        sizes = [ShoeSize.objects.create(name=str(size)) for size in range(40, 44)]
+        restocked = timezone.make_aware(datetime(2022, 6, 1))
+
+        cls.shoes = []
+        for number in range(7):
+            shoe = Shoe.objects.create(name=f"shoe {number}", description="a running shoe", display=True,
+                date_restocked=restocked + timedelta(days=number % 3))
+            ShoeFeature.objects.create(shoe=shoe, feature="breathable mesh")
+            ShoeCategory.objects.create(shoe=shoe, category=men)
+            for name in ["default", "red"]:
+                color = ShoeColor.objects.create(shoe=shoe, name=name)
+                blob = ImageBlob.objects.create(hash=f"{number}{name}".ljust(64, "0"),
+                    file=f"shoe_images/{number}{name}.jpg", medium=f"shoe_images/medium/{number}{name}.jpg",
+                    thumbnail=f"shoe_images/thumbnail/{number}{name}.jpg", refcount=1)
+                for width in [320, 640]:
+                    ShoeImageDerivative.objects.create(blob=blob, width=width, height=width * 3 // 4, format="webp",
+                        file=f"shoe_images/derivatives/{number}{name}-{width}.webp")
+                ShoeImage.objects.create(image=blob.file.name, medium=blob.medium.name,
+                    thumbnail=blob.thumbnail.name, blob=blob, color=color, status=ShoeImage.READY)
+                for size in sizes:
+                    ShoeVariant.objects.create(shoe=shoe, color=color, size=size, quantity=3,
+                        price=Decimal(50 + 10 * (number % 4)))
+            cls.shoes.append(shoe)
+
+    def setUp(self):
+        # a cache of the test's own, whose entries would otherwise outlive
+        # its rollback
+        settings = override_settings(SHOE_LIST_CACHE=self.list_cache)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        reset_list_cache()
+        self.addCleanup(reset_list_cache)
+        # the process-wide copies are reloaded from the test's catalog, the
+        # commits that would invalidate them are never made
+        search_index.invalidate()
+        category_tree.version = None
+
+    def walk(self, response, direction):
+        # the ids of `response` and of every page followed by `direction`
+        # from it, and the last response
+        pages = [[shoe["id"] for shoe in response["results"]]]
+        while response[direction]:
+            response = self.client.get(response[direction]).json()
+            pages.append([shoe["id"] for shoe in response["results"]])
+        return pages, response
+
+
+class QueryCountTests(CatalogTestCase):
+    """
+    The shoe list, detail and product page take the same number of queries
+    however many colors, images and variants the shoes have
+    """
+
+    def test_list(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("shoe_list"), {"page_size" : 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 5)
+
+    def test_detail(self):
+        with self.assertNumQueries(10):
+            response = self.client.get(reverse("shoe_detail", args=[self.shoes[0].id]), {"expand" : "colors,variants"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["variants"]), 8)
+
+    def test_page(self):
+        # the shoe, its features, categories, colors, images with their
+        # blobs, the responsive sizes of those, variants and sizes, after
+        # the change stamps
+        with self.assertNumQueries(9):
+            response = self.client.get(reverse("shoe_page", args=[self.shoes[0].id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["colors"]), 2)
+
+
+class CursorPaginationTests(CatalogTestCase):
+
+    def test_round_trip(self):
+        for ordering in ["id", "id_desc", "price", "price_desc", "newest", "oldest"]:
+            with self.subTest(ordering=ordering):
+                first = self.client.get(reverse("shoe_list"), {"order" : ordering, "page_size" : 2}).json()
+                forward, last = self.walk(first, "next")
+                self.assertEqual(len(forward), 4)
+                self.assertCountEqual([shoe_id for page in forward for shoe_id in page], [shoe.id for shoe in self.shoes])
+
+                # walking back from the last page returns the same pages
+                backward, first = self.walk(last, "previous")
+                self.assertEqual(backward, forward[::-1])
+                self.assertIsNone(first["previous"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("shoe_list"), {"cursor" : "not-a-cursor"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_tampered_cursor(self):
+        tampered = [
+            ("price", ["abc", 1]),
+            ("price", ["NaN", 1]),
+            ("price", ["1e30", 1]),
+            ("price", [50, 1]),
+            ("newest", ["xyz", 1]),
+            ("newest", [None, 1]),
+            ("id", [[1]]),
+            ("id", ["a"]),
+            ("id", [True]),
+            ("id", [1, 2]),
+            ("price", {"a" : 1}),
+        ]
+        for ordering, position in tampered:
+            with self.subTest(ordering=ordering, position=position):
+                token = urlsafe_b64encode(json.dumps({"o" : ordering, "p" : position, "r" : 0}).encode()).decode()
+                response = self.client.get(reverse("shoe_list"), {"order" : ordering, "cursor" : token})
+                self.assertEqual(response.status_code, 404)
+
+
+class SearchTests(CatalogTestCase):
+    """
+    Searches matching more shoes than are looked up at a time
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        size = ShoeSize.objects.first()
+        cls.trail_ids = []
+        for number in range(12):
+            shoe = Shoe.objects.create(name=f"trail {number}", description="a trail shoe", display=True,
+                date_restocked=timezone.make_aware(datetime(2022, 5, 1 + number % 5)))
+            color = ShoeColor.objects.create(shoe=shoe, name="default")
+            ShoeVariant.objects.create(shoe=shoe, color=color, size=size, quantity=1, price=Decimal(40 + 15 * (number % 3)))
+            cls.trail_ids.append(shoe.id)
+
+    def setUp(self):
+        super().setUp()
+        # a page of one looks up 8 matches at a time
+        chunk_size = mock.patch.object(ShoeCursorPagination, "ranking_chunk_size", 1)
+        chunk_size.start()
+        self.addCleanup(chunk_size.stop)
+
+    def test_orderings(self):
+        for ordering in ["id", "id_desc", "price", "price_desc", "newest", "oldest"]:
+            with self.subTest(ordering=ordering):
+                listed = self.client.get(reverse("shoe_list"), {"order" : ordering, "page_size" : 100}).json()
+                expected = [shoe["id"] for shoe in listed["results"] if shoe["id"] in self.trail_ids]
+
+                first = self.client.get(reverse("shoe_list"), {"q" : "trail", "order" : ordering, "page_size" : 1})
+                forward, last = self.walk(first.json(), "next")
+                self.assertEqual([shoe_id for page in forward for shoe_id in page], expected)
+                backward, first = self.walk(last, "previous")
+                self.assertEqual(backward, forward[::-1])
+
+    def test_relevance(self):
+        # every match scores the same, ties are broken by id
+        first = self.client.get(reverse("shoe_list"), {"q" : "trail shoe", "page_size" : 1}).json()
+        forward, last = self.walk(first, "next")
+        self.assertEqual([shoe_id for page in forward for shoe_id in page], self.trail_ids)
+        backward, first = self.walk(last, "previous")
+        self.assertEqual(backward, forward[::-1])
+
+    def test_no_query_lists_every_match(self):
+        for ordering in ["relevance", "price"]:
+            with self.subTest(ordering=ordering), CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("shoe_list"), {"q" : "trail", "order" : ordering, "page_size" : 1})
+            self.assertEqual(len(response.json()["results"]), 1)
+            for query in queries:
+                for values in re.findall(r" IN \(([^()]*)\)", query["sql"]):
+                    self.assertLessEqual(len(values.split(",")), 8, query["sql"])
+
+    def test_facets(self):
+        whole = count_facets(ShoeFilter({"q" : "trail"}))
+        self.assertEqual(sum(row["count"] for row in whole["prices"]), 12)
+        with mock.patch.object(ShoeFilter, "max_match_ids", 5):
+            self.assertEqual(len(list(ShoeFilter({"q" : "trail"}).split())), 3)
+            self.assertEqual(count_facets(ShoeFilter({"q" : "trail"})), whole)
+
+
+class FacetTests(CatalogTestCase):
+    """
+    Each facet counts the shoes matching every filter but its own
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        women = Category.objects.create(name="women", parent=Category.objects.get(name="gender"))
+        for name, size, price in [("court", "44", "120"), ("sandal", "40", "30")]:
+            shoe = Shoe.objects.create(name=name, display=True)
+            ShoeCategory.objects.create(shoe=shoe, category=women)
+            color = ShoeColor.objects.create(shoe=shoe, name="default")
+            ShoeVariant.objects.create(shoe=shoe, color=color, size=ShoeSize.objects.get_or_create(name=size)[0],
+                quantity=1, price=Decimal(price))
+
+    def get_counts(self, params):
+        facets = self.client.get(reverse("shoe_facets"), params).json()
+        return {
+            "sizes" : {row["name"] : row["count"] for row in facets["sizes"]},
+            "categories" : {row["name"] : row["count"] for row in facets["categories"]},
+            "prices" : [row["count"] for row in facets["prices"]],
+        }
+
+    def test_counts(self):
+        self.assertEqual(self.get_counts({}), {
+            "sizes" : {"40" : 8, "41" : 7, "42" : 7, "43" : 7, "44" : 1},
+            # a shoe is counted in the categories above its own
+            "categories" : {"gender" : 9, "men" : 7, "women" : 2},
+            "prices" : [1, 7, 1, 0, 0],
+        })
+
+    def test_size_filter(self):
+        self.assertEqual(self.get_counts({"sizes" : "40"}), {
+            "sizes" : {"40" : 8, "41" : 7, "42" : 7, "43" : 7, "44" : 1},
+            "categories" : {"gender" : 8, "men" : 7, "women" : 1},
+            "prices" : [1, 7, 0, 0, 0],
+        })
+
+    def test_category_and_price_filters(self):
+        self.assertEqual(self.get_counts({"categories" : "women", "price_min" : "100"}), {
+            "sizes" : {"44" : 1},
+            "categories" : {"gender" : 1, "women" : 1},
+            "prices" : [1, 0, 1, 0, 0],
+        })
+
+    def test_search(self):
+        self.assertEqual(self.get_counts({"q" : "court"})["sizes"], {"44" : 1})
+
+
+class CategoryFilterTests(CatalogTestCase):
+    """
+    A category filter matches the shoes in the category or any category
+    under it, found through the closure table
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        gender = Category.objects.get(name="gender")
+        cls.running = Category.objects.create(name="running", parent=Category.objects.get(name="men"))
+        cls.women = Category.objects.create(name="women", parent=gender)
+        cls.trainer = Shoe.objects.create(name="trainer", display=True)
+        ShoeCategory.objects.create(shoe=cls.trainer, category=cls.running)
+        cls.heel = Shoe.objects.create(name="heel", display=True)
+        ShoeCategory.objects.create(shoe=cls.heel, category=cls.women)
+
+    def get_ids(self, categories):
+        response = self.client.get(reverse("shoe_list"), {"categories" : categories, "page_size" : 100})
+        return {shoe["id"] for shoe in response.json()["results"]}
+
+    def test_filter(self):
+        men = {shoe.id for shoe in self.shoes}
+        self.assertEqual(self.get_ids("running"), {self.trainer.id})
+        self.assertEqual(self.get_ids("men"), men | {self.trainer.id})
+        self.assertEqual(self.get_ids("gender"), men | {self.trainer.id, self.heel.id})
+        self.assertEqual(self.get_ids("running,women"), {self.trainer.id, self.heel.id})
+
+    def test_links(self):
+        links = set(CategoryClosure.objects.filter(descendant=self.running).values_list("ancestor__name", "depth"))
+        self.assertEqual(links, {("running", 0), ("men", 1), ("gender", 2)})
+
+    def test_move(self):
+        # the category moves along with the shoes under it
+        men = Category.objects.get(name="men")
+        men.parent = self.women
+        men.save()
+        self.assertEqual(self.get_ids("women"), {shoe.id for shoe in self.shoes} | {self.trainer.id, self.heel.id})
+        links = set(CategoryClosure.objects.filter(descendant=self.running).values_list("ancestor__name", "depth"))
+        self.assertEqual(links, {("running", 0), ("men", 1), ("women", 2), ("gender", 3)})
+
+    def test_rebuild(self):
+        links = set(CategoryClosure.objects.values_list("ancestor_id", "descendant_id", "depth"))
+        CategoryClosure.objects.rebuild()
+        self.assertEqual(set(CategoryClosure.objects.values_list("ancestor_id", "descendant_id", "depth")), links)
+
+
+class BulkVariantTests(CatalogTestCase):
+    """
+    Variants created and updated in batches, which are written whole or not
+    at all and report the errors of each item at its position
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        ShoeSize.objects.create(name="44")
+        cls.admin = create_admin()
+
+    def setUp(self):
+        super().setUp()
+        self.api = APIClient()
+        self.api.force_authenticate(self.admin)
+        self.shoe = self.shoes[0]
+        self.url = reverse("available_sizes", args=[self.shoe.id])
+        self.colors = {color.name : color.id for color in self.shoe.colors.all()}
+
+    def test_create(self):
+        response = self.api.post(self.url, [
+            {"size" : "44", "color" : self.colors["default"], "quantity" : 2, "price" : "99.00"},
+            {"size" : "44", "color" : self.colors["red"], "quantity" : 1, "price" : "120.00"},
+        ], format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([(variant["size"], variant["color"]["name"]) for variant in response.json()],
+            [("44", "default"), ("44", "red")])
+        self.assertEqual(self.shoe.variants.count(), 10)
+        # the summary is kept up by the bulk signal
+        self.assertEqual(Shoe.objects.get(id=self.shoe.id).summary.price_max, Decimal("120.00"))
+
+    def test_item_errors(self):
+        other_color = self.shoes[1].colors.first().id
+        response = self.api.post(self.url, [
+            {"size" : "44", "color" : self.colors["default"], "quantity" : 2, "price" : "99.00"},
+            {"size" : "99", "color" : self.colors["default"], "quantity" : 2, "price" : "99.00"},
+            {"size" : "44", "color" : other_color, "quantity" : 2, "price" : "99.00"},
+            {"size" : "44", "color" : self.colors["red"], "price" : "-"},
+        ], format="json")
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertEqual(list(errors[1]), ["size"])
+        self.assertEqual(list(errors[2]), ["color"])
+        self.assertEqual(list(errors[3]), ["price"])
+        self.assertEqual(self.shoe.variants.count(), 8)
+
+    def test_create_conflicts(self):
+        response = self.api.post(self.url, [
+            {"size" : "44", "color" : self.colors["default"], "quantity" : 2, "price" : "99.00"},
+            {"size" : "44", "color" : self.colors["default"], "quantity" : 3, "price" : "99.00"},
+            {"size" : "40", "color" : self.colors["red"], "quantity" : 3, "price" : "99.00"},
+            {"size" : "44", "color" : self.colors["red"], "quantity" : 3, "price" : "99.00"},
+        ], format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([list(error) for error in response.json()],
+            [["non_field_errors"], ["non_field_errors"], ["non_field_errors"], []])
+        self.assertEqual(self.shoe.variants.count(), 8)
+
+    def test_update(self):
+        first, second = self.shoe.variants.order_by("id")[:2]
+        response = self.api.put(self.url, [
+            {"id" : first.id, "quantity" : 9},
+            {"id" : second.id, "price" : "10.00", "size" : "44"},
+        ], format="json")
+        self.assertEqual(response.status_code, 200)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.quantity, 9)
+        self.assertEqual((second.price, second.size.name), (Decimal("10.00"), "44"))
+        self.assertEqual(Shoe.objects.get(id=self.shoe.id).summary.price_min, Decimal("10.00"))
+
+    def test_update_errors(self):
+        first, second = self.shoe.variants.filter(color_id=self.colors["default"]).order_by("id")[:2]
+        other_variant = self.shoes[1].variants.first()
+        response = self.api.put(self.url, [
+            {"id" : first.id, "quantity" : 9},
+            {"id" : other_variant.id, "quantity" : 9},
+            {"id" : first.id, "quantity" : 5},
+            # onto the size and color of another variant of the shoe
+            {"id" : second.id, "size" : first.size.name},
+        ], format="json")
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual([list(error) for error in errors], [["non_field_errors"], ["id"], ["id"], ["non_field_errors"]])
+        first.refresh_from_db()
+        self.assertEqual(first.quantity, 3)
+
+    def test_empty(self):
+        response = self.api.post(self.url, [], format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class CatalogImportTests(CatalogTestCase):
+    """
+    The catalog exported by the export endpoint imported again by the
+    import_catalog command
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number, shoe in enumerate(cls.shoes):
+            Shoe.objects.filter(id=shoe.id).update(sku=f"SKU-{number}", display=number % 2 == 0)
+        ShoeColor.objects.filter(name="red").update(hex_code="CC0000")
+        cls.admin = create_admin()
+
+    def setUp(self):
+        super().setUp()
+        self.api = APIClient()
+        self.api.force_authenticate(self.admin)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.directory = directory
+
+    def export(self, output):
+        response = self.api.get(reverse("shoe_export"), {"output" : output})
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def get_catalog(self):
+        # the exported fields that are imported, by sku
+        catalog = {}
+        for line in self.export("ndjson").splitlines():
+            record = json.loads(line)
+            catalog[record["sku"]] = {
+                "name" : record["name"],
+                "description" : record["description"],
+                "display" : record["display"],
+                "features" : sorted(record["features"]),
+                "categories" : sorted(record["categories"]),
+                "colors" : sorted((color["name"], color["hex_code"]) for color in record["colors"]),
+                "variants" : sorted((variant["size"], variant["color"], variant["price"], variant["quantity"],
+                    variant["discount"]) for variant in record["variants"]),
+                "summary" : (record["quantity"], record["price_min"], record["price_max"]),
+            }
+        return catalog
+
+    def import_catalog(self, name, content, *args):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            file.write(content)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command("import_catalog", path, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_round_trip(self):
+        catalog = self.get_catalog()
+        self.assertEqual(len(catalog), 7)
+        for output, name in [("ndjson", "catalog.jsonl"), ("csv", "catalog.csv")]:
+            with self.subTest(output=output):
+                exported = self.export(output)
+                Shoe.objects.all().delete()
+                self.import_catalog(name, exported, "--batch-size", "3")
+                self.assertEqual(self.get_catalog(), catalog)
+
+    def test_existing_and_invalid_records(self):
+        records = [
+            {"sku" : "SKU-0", "name" : "again"},
+            {"sku" : "NEW-1", "name" : "new", "variants" : [{"size" : "99", "price" : "10"}]},
+            {"sku" : "NEW-2", "name" : "new", "categories" : ["men"],
+                "variants" : [{"size" : "40", "color" : "blue", "price" : "10", "quantity" : 2}]},
+        ]
+        stdout, stderr = self.import_catalog("catalog.jsonl", "".join(json.dumps(record) + "\n" for record in records))
+        self.assertIn("record 2: unknown size '99'", stderr)
+        self.assertIn("1 shoes already existed, 1 records were invalid", stdout)
+        self.assertEqual(Shoe.objects.get(sku="SKU-0").name, "shoe 0")
+        shoe = Shoe.objects.get(sku="NEW-2")
+        self.assertEqual([(variant.size.name, variant.color.name) for variant in shoe.variants.all()], [("40", "blue")])
+        self.assertEqual(shoe.summary.quantity, 2)
+        self.assertFalse(Shoe.objects.filter(sku="NEW-1").exists())
+
+    def test_resume(self):
+        records = [{"sku" : f"NEW-{number}", "name" : "new"} for number in range(3)]
+        path = os.path.join(self.directory, "catalog.jsonl")
+        with open(f"{path}.checkpoint", "w") as file:
+            json.dump({"records" : 2}, file)
+        stdout, stderr = self.import_catalog("catalog.jsonl", "".join(json.dumps(record) + "\n" for record in records))
+        self.assertIn("Resuming after record 2", stdout)
+        self.assertEqual(list(Shoe.objects.filter(sku__startswith="NEW").values_list("sku", flat=True)), ["NEW-2"])
+        self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+
+
+class ConditionalGetTests(CatalogTestCase):
+
+    def test_not_modified(self):
+        url = reverse("shoe_page", args=[self.shoes[0].id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_modified(self):
+        url = reverse("shoe_page", args=[self.shoes[0].id])
+        etag = self.client.get(url)["ETag"]
+
+        variant = ShoeVariant.objects.filter(shoe=self.shoes[0]).first()
+        variant.quantity = 0
+        variant.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_if_modified_since(self):
+        url = reverse("shoe_page", args=[self.shoes[0].id])
+        last_modified = self.client.get(url)["Last-Modified"]
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def get_etags(self):
+        shoe, other = self.shoes[0].id, self.shoes[1].id
+        urls = {
+            "detail" : reverse("shoe_detail", args=[shoe]),
+            "page" : reverse("shoe_page", args=[shoe]),
+            "colors" : reverse("shoe_colors", args=[shoe]),
+            "variants" : reverse("available_sizes", args=[shoe]),
+            "other page" : reverse("shoe_page", args=[other]),
+            "sizes" : reverse("sizes"),
+            "categories" : reverse("categories"),
+        }
+        return {name : self.client.get(url)["ETag"] for name, url in urls.items()}
+
+    def test_bumps(self):
+        # each write changes the ETags of the endpoints showing what it
+        # wrote, and only those
+        shoe = self.shoes[0]
+        color = shoe.colors.get(name="red")
+        writes = [
+            ("feature", lambda: ShoeFeature.objects.create(shoe=shoe, feature="waterproof"), {"detail", "page"}),
+            ("image", lambda: ShoeImage.objects.create(image="shoe_images/other.jpg", color=color),
+                {"page", "colors", "variants"}),
+            ("variant", lambda: ShoeVariant.objects.filter(shoe=shoe).first().save(), {"page", "variants"}),
+            # the tables every shoe shows
+            ("size", lambda: ShoeSize.objects.create(name="45"), {"page", "variants", "sizes", "other page"}),
+            ("category", lambda: Category.objects.create(name="kids"), {"detail", "page", "categories", "other page"}),
+        ]
+        for name, write, changed in writes:
+            with self.subTest(write=name):
+                before = self.get_etags()
+                write()
+                after = self.get_etags()
+                self.assertEqual({endpoint for endpoint in before if before[endpoint] != after[endpoint]}, changed)
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(LocalMemoryBackend(), 60)
+        self.request = RequestFactory().get("/shoes/", {"sizes" : "41,40", "q" : "Running  Shoe"})
+
+    def store(self, shoe_ids):
+        generation = self.cache.get_generation()
+        versions = self.cache.get_versions(shoe_ids)
+        self.cache.set(self.request, {"results" : shoe_ids}, versions, generation)
+
+    def test_hit(self):
+        self.store([1, 2])
+        # the params are normalized
+        request = RequestFactory().get("/shoes/", {"q" : "running shoe", "sizes" : "40,41"})
+        self.assertEqual(self.cache.get(request), {"results" : [1, 2]})
+
+    def test_invalidate_shoe(self):
+        self.store([1, 2])
+        self.cache.invalidate_shoe(3)
+        self.assertIsNotNone(self.cache.get(self.request))
+        self.cache.invalidate_shoe(2)
+        self.assertIsNone(self.cache.get(self.request))
+
+    def test_invalidate_all(self):
+        self.store([1, 2])
+        self.cache.invalidate_all()
+        self.assertIsNone(self.cache.get(self.request))
+
+    def test_bumped_while_built(self):
+        # a write committing between the rows being read and the response
+        # being stored
+        generation = self.cache.get_generation()
+        versions = self.cache.get_versions([1, 2])
+        self.cache.invalidate_shoe(2)
+        self.cache.set(self.request, {"results" : [1, 2]}, versions, generation)
+        self.assertIsNone(self.cache.get(self.request))
+
+        generation = self.cache.get_generation()
+        versions = self.cache.get_versions([1, 2])
+        self.cache.invalidate_all()
+        self.cache.set(self.request, {"results" : [1, 2]}, versions, generation)
+        self.assertIsNone(self.cache.get(self.request))
+
+        # the next response is stored again
+        self.store([1, 2])
+        self.assertIsNotNone(self.cache.get(self.request))
+
+
+class ListCacheTests(CatalogTestCase):
+    list_cache = {"BACKEND" : "shoes.cache.LocalMemoryBackend", "TIMEOUT" : 60}
+
+    def get_ids(self, params):
+        return [shoe["id"] for shoe in self.client.get(reverse("shoe_list"), params).json()["results"]]
+
+    def test_feature_changes_search(self):
+        self.assertEqual(self.get_ids({"q" : "waterproof"}), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            ShoeFeature.objects.create(shoe=self.shoes[0], feature="waterproof")
+        self.assertEqual(self.get_ids({"q" : "waterproof"}), [self.shoes[0].id])
+
+    def test_shoe_change(self):
+        params = {"order" : "id", "page_size" : 2}
+        listed = self.get_ids(params)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_ids(params), listed)
+
+        # a color of a listed shoe is renamed
+        color = ShoeColor.objects.get(shoe=self.shoes[0], name="red")
+        color.name = "blue"
+        with self.captureOnCommitCallbacks(execute=True):
+            color.save()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get_ids(params), listed)
+
+
+def make_image(name="shoe.jpg", size=(800, 600), color=(200, 40, 40)):
+    content = io.BytesIO()
+    Image.new("RGB", size, color).save(content, "JPEG")
+    return SimpleUploadedFile(name, content.getvalue(), content_type="image/jpeg")
+
+
+class MediaTestCase(TestCase):
+    """
+    Stores the files the test writes under a temporary MEDIA_ROOT, and the
+    on-demand image sizes in a temporary resize cache
+    """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.media_root = media_root
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        resize_cache = mock.patch("shoes.imaging.get_resize_cache", return_value=DiskLRUCache(cache_dir, 16 * 1024 * 1024))
+        resize_cache.start()
+        self.addCleanup(resize_cache.stop)
+
+    def get_files(self):
+        # the names of the files under MEDIA_ROOT
+        return {os.path.relpath(os.path.join(root, name), self.media_root).replace(os.sep, "/")
+            for root, folders, names in os.walk(self.media_root) for name in names}
+
+
+class ImageResizeTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        shoe = Shoe.objects.create(name="shoe", display=True)
+        color = ShoeColor.objects.create(shoe=shoe, name="default")
+        blob = ImageBlob.objects.store(make_image())
+        self.image = ShoeImage.objects.create(image=blob.file.name, blob=blob, color=color, status=ShoeImage.READY)
+        self.url = reverse("shoe_image_resize", args=[self.image.id])
+
+    def test_resized(self):
+        response = self.client.get(self.url, {"width" : "300", "output" : "png"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        with Image.open(io.BytesIO(b"".join(response.streaming_content))) as image:
+            # rounded up to the next of the widths
+            self.assertEqual(image.size, (320, 240))
+
+    def test_invalid_width(self):
+        for width in ["", "0", "-3", "abc", "1.5", "\u00b2", "\u00bd"]:
+            with self.subTest(width=width):
+                response = self.client.get(self.url, {"width" : width})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("width", response.json())
+
+
+class ShoeImageTestCase(MediaTestCase):
+    """
+    A shoe with two colors, and an admin uploading their images
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.api = APIClient()
+        self.api.force_authenticate(create_admin())
+        self.shoe = Shoe.objects.create(name="shoe", display=True)
+        self.color = ShoeColor.objects.create(shoe=self.shoe, name="default")
+        self.other_color = ShoeColor.objects.create(shoe=self.shoe, name="red")
+
+    def upload(self, color, image):
+        return self.api.post(reverse("shoe_images"), {"image" : image, "color" : color.id}, format="multipart")
+
+
+class ImageBlobTests(ShoeImageTestCase):
+    """
+    Uploaded images are stored once per content, and the stored file is
+    kept while an image shows it
+    """
+
+    def test_store(self):
+        blob = ImageBlob.objects.store(make_image("first.jpg"))
+        again = ImageBlob.objects.store(make_image("second.jpg"))
+        self.assertEqual(again.hash, blob.hash)
+        self.assertEqual(ImageBlob.objects.get(hash=blob.hash).refcount, 2)
+        self.assertEqual(self.get_files(), {blob.file.name})
+
+    def test_shared_between_colors(self):
+        first = self.upload(self.color, make_image("first.jpg"))
+        second = self.upload(self.other_color, make_image("second.jpg"))
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(first.json()["image"], second.json()["image"])
+        blob = ImageBlob.objects.get()
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(self.get_files(), {blob.file.name})
+
+    def test_duplicate_in_color(self):
+        self.upload(self.color, make_image())
+        files = self.get_files()
+        response = self.upload(self.color, make_image("again.jpg"))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("image", response.json())
+        self.assertEqual(self.get_files(), files)
+        self.assertEqual(ImageBlob.objects.get().refcount, 1)
+
+    def test_release(self):
+        first = self.upload(self.color, make_image()).json()["id"]
+        second = self.upload(self.other_color, make_image()).json()["id"]
+        self.assertEqual(self.api.delete(reverse("shoe_image", args=[first])).status_code, 204)
+        self.assertEqual(ImageBlob.objects.get().refcount, 1)
+        self.api.delete(reverse("shoe_image", args=[second]))
+        self.assertFalse(ImageBlob.objects.exists())
+
+    def test_replace(self):
+        image_id = self.upload(self.color, make_image()).json()["id"]
+        previous = ImageBlob.objects.get()
+        response = self.api.put(reverse("shoe_image", args=[image_id]),
+            {"image" : make_image(color=(0, 0, 255)), "color" : self.color.id}, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        blob = ShoeImage.objects.get(id=image_id).blob
+        self.assertNotEqual(blob.hash, previous.hash)
+        self.assertEqual(list(ImageBlob.objects.values_list("hash", "refcount")), [(blob.hash, 1)])
+
+    def test_legacy_blob(self):
+        # a blob the migration kept under the file's name before hashing
+        image = make_image()
+        os.makedirs(os.path.join(self.media_root, "shoe_images"))
+        with open(os.path.join(self.media_root, "shoe_images", "legacy.jpg"), "wb") as file:
+            file.write(image.read())
+        image.seek(0)
+        ImageBlob.objects.create(hash=ImageBlob.objects.get_hash(image), file="shoe_images/legacy.jpg", refcount=0)
+
+        response = self.upload(self.color, make_image("upload.jpg"))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ShoeImage.objects.get().image.name, "shoe_images/legacy.jpg")
+        self.assertEqual(self.get_files(), {"shoe_images/legacy.jpg"})
+
+
+class ImageBatchTests(ShoeImageTestCase):
+    """
+    Images of a color uploaded in one request, all stored or none
+    """
+
+    def upload_batch(self, color, images):
+        return self.api.post(reverse("shoe_color_images", args=[color.shoe_id, color.id]), {"images" : images},
+            format="multipart")
+
+    def test_upload(self):
+        self.upload(self.other_color, make_image("shared.jpg"))
+        response = self.upload_batch(self.color, [make_image("shared.jpg"), make_image("blue.jpg", color=(0, 0, 255)),
+            make_image("green.png", color=(0, 255, 0))])
+        self.assertEqual(response.status_code, 201)
+        images = response.json()
+        self.assertEqual([image["status"] for image in images], [ShoeImage.PENDING] * 3)
+        self.assertEqual(ShoeImage.objects.filter(color=self.color).count(), 3)
+        # the content already shown by the other color is stored once
+        self.assertEqual(sorted(ImageBlob.objects.values_list("refcount", flat=True)), [1, 1, 2])
+        self.assertEqual(self.get_files(), set(ImageBlob.objects.values_list("file", flat=True)))
+        self.assertEqual(ImageJob.objects.filter(image__color=self.color).count(), 3)
+
+    def test_duplicates(self):
+        self.upload(self.color, make_image("shown.jpg"))
+        files = self.get_files()
+        response = self.upload_batch(self.color, [make_image("new.jpg", color=(0, 0, 255)), make_image("shown.jpg"),
+            make_image("again.jpg", color=(0, 0, 255))])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()["images"]), ["1", "2"])
+        # nothing of the batch is stored
+        self.assertEqual(self.get_files(), files)
+        self.assertEqual(ShoeImage.objects.count(), 1)
+
+    def test_invalid_file(self):
+        text = SimpleUploadedFile("notes.txt", b"not an image", content_type="text/plain")
+        response = self.upload_batch(self.color, [make_image(), text])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_files(), set())
+
+    def test_color_of_another_shoe(self):
+        other = ShoeColor.objects.create(shoe=Shoe.objects.create(name="other"), name="default")
+        response = self.api.post(reverse("shoe_color_images", args=[self.shoe.id, other.id]), {"images" : [make_image()]},
+            format="multipart")
+        self.assertEqual(response.status_code, 404)
+
+
+class FileCleanupTests(ShoeImageTestCase):
+    """
+    The files of deleted rows are deleted once the delete commits, the
+    deletes being run here as they are queued rather than on the cleaner's
+    thread
+    """
+
+    def setUp(self):
+        super().setUp()
+        put = mock.patch.object(file_cleaner, "put", side_effect=file_cleaner.delete)
+        put.start()
+        self.addCleanup(put.stop)
+
+    def test_deleted_after_commit(self):
+        image_id = self.upload(self.color, make_image()).json()["id"]
+        blob = ImageBlob.objects.get()
+        blob.medium.save("medium.jpg", make_image(size=(300, 225)), save=False)
+        blob.save()
+        files = self.get_files()
+        self.assertEqual(len(files), 2)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.api.delete(reverse("shoe_image", args=[image_id]))
+        self.assertEqual(self.get_files(), files)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.get_files(), set())
+
+    def test_rolled_back(self):
+        image_id = self.upload(self.color, make_image()).json()["id"]
+        files = self.get_files()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    ShoeImage.objects.get(id=image_id).delete()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.get_files(), files)
+        self.assertTrue(ImageBlob.objects.exists())
+
+    def test_stored_again(self):
+        # the content is uploaded again before the delete's files are
+        image_id = self.upload(self.color, make_image()).json()["id"]
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.api.delete(reverse("shoe_image", args=[image_id]))
+        self.upload(self.color, make_image())
+        files = self.get_files()
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.get_files(), files)
+        self.assertEqual(len(files), 1)
+
+
+class FileCleanerThreadTests(TransactionTestCase):
+    """
+    The files are deleted on the cleaner's thread, which reads the rows
+    committed by then
+    """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_deleted(self):
+        color = ShoeColor.objects.create(shoe=Shoe.objects.create(name="shoe"), name="default")
+        kept, deleted = [ImageBlob.objects.store(make_image(color=(number * 200, 0, 0))) for number in range(2)]
+        ShoeImage.objects.create(image=kept.file.name, blob=kept, color=color)
+        image = ShoeImage.objects.create(image=deleted.file.name, blob=deleted, color=color)
+        image.delete()
+        file_cleaner.join()
+        self.assertTrue(kept.file.storage.exists(kept.file.name))
+        self.assertFalse(deleted.file.storage.exists(deleted.file.name))
+
+
+class SweepMediaTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        color = ShoeColor.objects.create(shoe=Shoe.objects.create(name="shoe"), name="default")
+        blob = ImageBlob.objects.store(make_image())
+        ShoeImage.objects.create(image=blob.file.name, blob=blob, color=color)
+        self.referenced = blob.file.name
+
+        # files no row refers to, a day old or just written
+        self.orphans = ["shoe_images/ab/old.jpg", "shoe_images/derivatives/old-320w.webp"]
+        self.young = "shoe_images/young.jpg"
+        day_ago = time.time() - 25 * 60 * 60
+        for name in self.orphans + [self.young, self.referenced]:
+            path = os.path.join(self.media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.exists(path):
+                with open(path, "wb") as file:
+                    file.write(b"orphan")
+            if name != self.young:
+                os.utime(path, (day_ago, day_ago))
+
+    def sweep(self, *args):
+        stdout = io.StringIO()
+        call_command("sweep_media", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_dry_run(self):
+        files = self.get_files()
+        output = self.sweep("--dry-run")
+        self.assertEqual(set(output.splitlines()[:-1]), set(self.orphans))
+        self.assertIn("Would delete 2 unreferenced files", output)
+        self.assertEqual(self.get_files(), files)
+
+    def test_sweep(self):
+        self.assertIn("Deleted 2 unreferenced files", self.sweep())
+        self.assertEqual(self.get_files(), {self.referenced, self.young})
+        # the folders emptied are removed
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, "shoe_images", "ab")))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, "shoe_images", "derivatives")))
+
+    def test_grace_period(self):
+        self.sweep("--grace-hours", "0")
+        self.assertEqual(self.get_files(), {self.referenced})
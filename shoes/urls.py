@@ -1,23 +1,29 @@
 from django.urls import path
 from .views import (ShoeCategoryUpdateDeleteView, ShoeColorListCreateView, ShoeVariantDetailView, ShoeVariantListView, 
 CategoryDetailView, CategoryListView, ShoeDetailView, ShoeFeatureListCreateView, ShoeFeatureUpdateDeleteView,
- ShoeImageDetailView, ShoeColorUpdateDeleteView, 
-ShoeImageListView, ShoeListView, ShoeRatingView, ShoeSizeUpdateDeleteView, ShoeSizeView, ShoeCategoryView)
+ ShoeImageDetailView, ShoeColorUpdateDeleteView, ShoeColorImageBatchView, 
+ShoeImageListView, ShoeImageResizeView, ImageJobBacklogView, ShoeListView, ShoeFacetView, ShoeExportView, ShoePageView, ShoeRatingView, ShoeSizeUpdateDeleteView, ShoeSizeView, ShoeCategoryView)
 from rest_framework.urlpatterns import format_suffix_patterns
 
 
 urlpatterns = [
     path("", ShoeListView.as_view(), name="shoe_list"),
     path("<int:id>/", ShoeDetailView.as_view(), name="shoe_detail"),
+    path("<int:id>/page/", ShoePageView.as_view(), name="shoe_page"),
+    path("facets/", ShoeFacetView.as_view(), name="shoe_facets"),
+    path("export/", ShoeExportView.as_view(), name="shoe_export"),
 
     path("images/", ShoeImageListView.as_view(), name="shoe_images"),
     path("images/<int:image_id>/", ShoeImageDetailView.as_view(),  name="shoe_image"),
+    path("images/<int:image_id>/resized/", ShoeImageResizeView.as_view(), name="shoe_image_resize"),
+    path("images/jobs/", ImageJobBacklogView.as_view(), name="image_jobs"),
 
     path("<int:shoe_id>/features/", ShoeFeatureListCreateView.as_view(), name='variants'),
     path("<int:shoe_id>/features/<int:feature_id>/", ShoeFeatureUpdateDeleteView.as_view(), name='variant'),
     
     path("<int:shoe_id>/colors/", ShoeColorListCreateView.as_view(), name='shoe_colors'),
     path("<int:shoe_id>/colors/<int:color_id>/", ShoeColorUpdateDeleteView.as_view(), name='available_size'),
+    path("<int:shoe_id>/colors/<int:color_id>/images/", ShoeColorImageBatchView.as_view(), name="shoe_color_images"),
     
     
     path("<int:shoe_id>/categories/", ShoeCategoryView.as_view(), name="shoe_categories"),
@@ -1,8 +1,12 @@
 import operator
 from functools import reduce
 from django.shortcuts import get_object_or_404
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -10,14 +14,23 @@ from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 
 from users.permissions import IsAdminOrReadOnly, IsOwner, IsOwnerOrReadOnly
-from .serializers import (ShoeColorSerializer, ShoeVariantDetailSerializer, 
+from .serializers import (ShoeColorSerializer, ShoeVariantBulkSerializer, ShoeVariantDetailSerializer, 
 ShoeVariantListSerializer, CartListSerializer, CategoryListSerializer, 
 ModifyCartSerializer, RatingSerializer, ShoeDetailSerializer, ShoeFeatureSerializer, ShoeListSerializer,
- ShoeCategoryListSerializer, ShoeImageSerializer, ShoeSizeSerializer, 
- ParentCategoryListSerializer, ShoeCategorySerializer, ShoeSerializer)
-from .models import (ShoeColor, ShoeVariant, CartItem, Category, Rating, Shoe, 
-ShoeCategory, ShoeFeature, ShoeImage, ShoeSize)
-from .utils import float_or_none
+ ShoeListValuesSerializer, ShoeCategoryListSerializer, ShoeImageBatchSerializer, ShoeImageSerializer, ShoePageSerializer, ShoeSizeSerializer, 
+ ParentCategoryListSerializer, ShoeCategorySerializer, ShoeSerializer, get_field_options,
+ get_image_prefetches)
+from .models import (ShoeColor, ShoeVariant, CartItem, Category, ImageJob, Rating, Shoe, 
+ShoeCategory, ShoeFeature, ShoeImage, ShoeImageDerivative, ShoeSize)
+from .cache import get_list_cache
+from .categories import category_tree
+from .conditional import conditional_get
+from .export import EXPORTERS, iter_shoes
+from .facets import count_facets
+from .filters import ShoeFilter
+from .imaging import OUTPUT_FORMATS, get_output_formats, open_resized
+from .pagination import ShoeCursorPagination
+from .sizes import size_lookup
 
 
 class ShoeListView(APIView):
@@ -27,74 +40,37 @@ class ShoeListView(APIView):
 
     def get(self, request, format=None):
 
-        # splitting the categories into a list
-        categories = request.GET.get("categories")
-        search_query = request.GET.get("q")
-        price_max = request.GET.get("price_max")
-        price_min = request.GET.get("price_min")
-        sizes = request.GET.get("sizes")
-        ordering = request.GET.get("order")
-
-        accepted_values = ["id", "id_desc", "price", "price_desc",
-        "newest", "oldest"]
-
-        if not ordering in accepted_values:
-            ordering = "id"
-        elif ordering.split("_")[-1] == "desc":
-            ordering = "-" + ordering.split("_")[0]
-        elif ordering == "newest":
-            ordering = "date_restocked"
-        elif ordering == "oldest":
-            ordering = "-date_restocked"
-
-        print(request.GET.get("test"))
-        query = []
-
-        # ------ QUERY BUILDING ------
-        if  search_query:
-            # search by name of shoe it's category
-            query.append(Q(name__icontains= search_query) | Q(categories__category__name = search_query))
-
-        if categories:
-            categories = categories.split(",")
-            clauses = (Q(categories__category__name=category) for category in categories)
-            # for each category, return any shoe that has at least one category
-            query.append(reduce(operator.or_,clauses))
-
-        # getting the max price
-        if float_or_none(price_max):
-            price_max = float_or_none(price_max)
-            query.append(Q(variants__price__lte=price_max))
-
-        # getting the minimum price
-        if float_or_none(price_min):
-            price_min = float_or_none(price_min)
-            query.append(Q(variants__price__gte=price_min))
-
-        # getting the sizes to display
-        if sizes:
-            sizes = sizes.replace("-", " ")
-            sizes = sizes.split(",")
-            clauses = (Q(variants__size__name=size) for size in sizes)
-            query.append(reduce(operator.or_, clauses))
-
-
-        if len(query) > 0:
-            query = reduce(operator.and_, query)
-            if sizes and categories:
-                shoes = Shoe.objects.all().prefetch_related('categories', 'variants').filter(query).order_by(ordering).distinct()
-            elif sizes or price_max or price_min:
-                shoes = Shoe.objects.all().prefetch_related( 'variants').filter(query).order_by(ordering).distinct()
-            elif categories or search_query:
-                shoes = Shoe.objects.all().prefetch_related('categories').filter(query).order_by(ordering).distinct()
-            else:
-                shoes = Shoe.objects.all().filter(query).distinct()
-            
-        else:
-            shoes = Shoe.objects.all().order_by(ordering).distinct()
-
-        serializer = ShoeListSerializer(shoes, many=True)
-        return Response(serializer.data)
+        list_cache = get_list_cache()
+        if list_cache:
+            data = list_cache.get(request)
+            if data is not None:
+                return Response(data)
+            generation = list_cache.get_generation()
+
+        # the matches of a search are picked out by the paginator, which
+        # only looks up those of the page
+        shoe_filter = ShoeFilter(request.GET)
+        shoes = shoe_filter.filter(Shoe.objects.all(), exclude=["q"])
+
+        # the listing figures and cover image are read from the precomputed
+        # summaries rather than aggregated for each shoe. only the relations
+        # of the fields asked for are loaded
+        field_options = get_field_options(request.GET)
+        # pages without expanded relations are built straight from rows of
+        # values rather than model instances
+        serializer_class = ShoeListSerializer if field_options.get("expand") else ShoeListValuesSerializer
+        shoes = serializer_class.load_related(shoes, **field_options)
+
+        paginator = ShoeCursorPagination(ranking=shoe_filter.get_ranking())
+        page = paginator.paginate_queryset(shoes, request, view=self)
+        if list_cache:
+            versions = list_cache.get_versions([shoe["id"] if isinstance(shoe, dict) else shoe.id for shoe in page])
+        serializer = serializer_class(page, many=True, **field_options)
+        response = paginator.get_paginated_response(serializer.data)
+
+        if list_cache:
+            list_cache.set(request, response.data, versions, generation)
+        return response
 
     def post(self, request, format=None):
         serializer = ShoeSerializer(data=request.data)
@@ -106,14 +82,57 @@ class ShoeListView(APIView):
 
 
 
+class ShoeFacetView(APIView):
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, format=None):
+        # the number of shoes under each size, category and price bucket
+        # for the filters currently applied to the shoe list
+        facets = count_facets(ShoeFilter(request.GET))
+        return Response(facets)
+
+
+class ShoeExportView(APIView):
+    """
+    Streams the whole catalog as newline delimited JSON, or as CSV with
+    ?output=csv, for feeds and indexers
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        output = request.GET.get("output", "ndjson")
+        if output not in EXPORTERS:
+            return Response({"output" : [f"Choose one of {', '.join(EXPORTERS)}"]}, status=status.HTTP_400_BAD_REQUEST)
+
+        export, content_type = EXPORTERS[output]
+        response = StreamingHttpResponse(export(iter_shoes()), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="catalog.{output}"'
+        return response
+
+
 class ShoeDetailView(APIView):
 
     permission_classes = [IsAdminOrReadOnly]
 
     def get(self, request, id, format=None):
-        shoe = get_object_or_404(Shoe, id=id)
-        serializer = ShoeDetailSerializer(shoe)
-        return Response(serializer.data)
+        field_options = get_field_options(request.GET)
+
+        def get_response():
+            shoe = get_object_or_404(ShoeDetailSerializer.load_related(Shoe.objects.all(), **field_options), id=id)
+            serializer = ShoeDetailSerializer(shoe, **field_options)
+            return Response(serializer.data)
+
+        # the shoe lists the names of its categories, and its expanded
+        # colors and variants
+        scopes = [f"shoe:{id}", "categories"]
+        expand = field_options.get("expand", ())
+        if "colors" in expand:
+            scopes.append(f"colors:{id}")
+        if "variants" in expand:
+            scopes += [f"variants:{id}", "sizes"]
+        return conditional_get(request, scopes, get_response)
 
     def put(self, request, id, format=None):
         shoe = get_object_or_404(Shoe, id=id)
@@ -128,6 +147,22 @@ class ShoeDetailView(APIView):
         shoe.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+class ShoePageView(APIView):
+    """
+    The shoe with everything its product page shows, in place of a request
+    to each of the shoe's detail, colors, variants, features and ratings
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, id, format=None):
+        def get_response():
+            shoe = get_object_or_404(ShoePageSerializer.load_related(Shoe.objects.all()), id=id)
+            serializer = ShoePageSerializer(shoe)
+            return Response(serializer.data)
+
+        return conditional_get(request, [f"shoe:{id}", "categories", f"colors:{id}", f"variants:{id}", "sizes"], get_response)
+
 class ShoeFeatureListCreateView(APIView):
 
     permission_classes = [IsAdminOrReadOnly]
@@ -175,24 +210,80 @@ class ShoeImageListView(APIView):
     permission_classes = [IsAdminOrReadOnly]
 
     def get(self, request, format=None):
-        shoe_images = ShoeImage.objects.all()
+        shoe_images = ShoeImage.objects.select_related("blob").prefetch_related("blob__derivatives")
         serializer = ShoeImageSerializer(shoe_images, many=True)
         return Response(serializer.data)
 
     def post(self, request, format=None):
+        # the image is stored once and answered as pending, its medium and
+        # thumbnail sizes are made by the image job workers
         serializer = ShoeImageSerializer(data=request.data, context={"request" : request})
-        if request.FILES.get("image"):
-            image = request.FILES.get("image")
-            request.FILES["medium"] = image
-            request.FILES["thumbnail"] = image
-            request.data["medium"] = request.FILES["medium"]
-            request.data["thumbnail"] = request.FILES["thumbnail"]
-
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST) 
 
+class ImageJobBacklogView(APIView):
+    """
+    The number of queued, running and failed image jobs and how long the
+    oldest queued one has waited, for monitoring the image workers
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response(ImageJob.objects.backlog())
+
+
+class ShoeImageResizeView(APIView):
+    """
+    A shoe image scaled to ?width= in ?output=webp|jpeg|png (avif where
+    Pillow writes it), made on its first request and kept in the on-disk
+    resize cache. Widths are rounded up to the next of
+    SHOE_IMAGE_RESIZE["WIDTHS"]. With ?v= the start of the content hash in
+    the image's file name, the response is cached as immutable.
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, image_id, format=None):
+        options = getattr(settings, "SHOE_IMAGE_RESIZE", {})
+        widths = sorted(options.get("WIDTHS", [320, 640, 960, 1280]))
+        outputs = get_output_formats()
+
+        errors = {}
+        try:
+            width = int(request.GET.get("width", ""))
+        except ValueError:
+            width = 0
+        if width < 1:
+            errors["width"] = ["A positive whole number is required"]
+        output = request.GET.get("output", "webp")
+        if output not in outputs:
+            errors["output"] = [f"Choose one of {', '.join(outputs)}"]
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        width = next((size for size in widths if size >= width), widths[-1])
+
+        shoe_image = get_object_or_404(ShoeImage.objects.select_related("blob"), id=image_id, blob__isnull=False)
+        blob = shoe_image.blob
+        etag = f'"{blob.hash[:16]}-{width}-{output}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            # a size of the responsive ladder is served as it is
+            derivative = ShoeImageDerivative.objects.filter(blob=blob, width=width, format=output).first()
+            file = derivative.file.open("rb") if derivative else open_resized(blob, width, output)
+            response = FileResponse(file, content_type=OUTPUT_FORMATS[output][1])
+
+        response["ETag"] = etag
+        version = request.GET.get("v", "")
+        if len(version) >= 8 and blob.hash.startswith(version):
+            patch_cache_control(response, public=True, max_age=options.get("MAX_AGE", 31536000), immutable=True)
+        else:
+            patch_cache_control(response, public=True, max_age=options.get("UNVERSIONED_MAX_AGE", 3600))
+        return response
+
+
 class ShoeImageDetailView(APIView):
 
     parser_classes = [JSONParser, MultiPartParser]
@@ -221,9 +312,12 @@ class ShoeSizeView(APIView):
     permission_classes = [IsAdminOrReadOnly]
 
     def get (self, request, format=None):
-        shoe_sizes = ShoeSize.objects.all()
-        serializer = ShoeSizeSerializer(shoe_sizes, many=True)
-        return Response(serializer.data)
+        def get_response():
+            shoe_sizes = ShoeSize.objects.all()
+            serializer = ShoeSizeSerializer(shoe_sizes, many=True)
+            return Response(serializer.data)
+
+        return conditional_get(request, ["sizes"], get_response)
 
     def post (self, request, format=None):
         serializer = ShoeSizeSerializer(data=request.data)
@@ -262,9 +356,12 @@ class ShoeColorListCreateView(APIView):
         return obj
 
     def get(self, request, shoe_id, format=None):
-        colors = ShoeColor.objects.filter(shoe__id = shoe_id)
-        serializer = ShoeColorSerializer(colors, many=True)
-        return Response(serializer.data)
+        def get_response():
+            colors = ShoeColor.objects.filter(shoe__id = shoe_id).prefetch_related(*get_image_prefetches("images"))
+            serializer = ShoeColorSerializer(colors, many=True)
+            return Response(serializer.data)
+
+        return conditional_get(request, [f"colors:{shoe_id}"], get_response)
 
     def post(self, request, shoe_id, format=None):
         if type(request.data) == dict:
@@ -297,24 +394,62 @@ class ShoeColorUpdateDeleteView(APIView):
         shoe_size.delete()
         return Response(status = status.HTTP_204_NO_CONTENT)
 
+class ShoeColorImageBatchView(APIView):
+    """
+    Uploads many images of a color in one multipart request, each file in
+    `images`. The files are streamed to temporary files on disk rather
+    than held in memory, and moved in place once stored.
+    """
+
+    parser_classes = [MultiPartParser]
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, shoe_id, color_id, format=None):
+        color = get_object_or_404(ShoeColor, id=color_id, shoe_id=shoe_id)
+        # set before request.data parses the upload
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        serializer = ShoeImageBatchSerializer(data=request.data, context={"color" : color})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        images = serializer.save()
+        return Response(ShoeImageSerializer(images, many=True, context={"request" : request}).data,
+            status=status.HTTP_201_CREATED)
+
 class ShoeVariantListView(APIView):
 
     permission_classes = [IsAdminOrReadOnly]
 
     def get(self, request, shoe_id, format=None):
-        available_shoe_sizes = ShoeVariant.objects.filter(shoe__id = shoe_id)
-        serializer = ShoeVariantListSerializer(available_shoe_sizes, many=True)
-        return Response(serializer.data)
+        def get_response():
+            available_shoe_sizes = ShoeVariant.objects.filter(shoe__id = shoe_id).select_related(
+                "size", "color").prefetch_related(*get_image_prefetches("color__images"))
+            serializer = ShoeVariantListSerializer(available_shoe_sizes, many=True)
+            return Response(serializer.data)
+
+        # the variants show the name of their size
+        return conditional_get(request, [f"variants:{shoe_id}", "sizes"], get_response)
+
+    def save_batch(self, serializer, success_status):
+        # a batch is applied whole or not at all
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            with transaction.atomic():
+                variants = serializer.save()
+        except IntegrityError:
+            return Response({"non_field_errors": ["A variant of this size and color already exists"]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(ShoeVariantListSerializer(variants, many=True).data, status=success_status)
 
     def post(self, request, shoe_id, format=None):
+        # a list of variants is created in bulk
+        if type(request.data) == list:
+            get_object_or_404(Shoe, id = shoe_id)
+            serializer = ShoeVariantBulkSerializer(data=request.data, many=True, context={"shoe_id" : shoe_id})
+            return self.save_batch(serializer, status.HTTP_201_CREATED)
+
         if type(request.data) == dict:
             request.data["shoe"] = shoe_id
-            try:
-                shoe_size = ShoeSize.objects.get(name=request.data['size'])
-            except :
-                request.data['size'] = None
-            else:
-                request.data['size'] = shoe_size.id
+            request.data['size'] = size_lookup.get_id(request.data.get('size'))
             
         serializer = ShoeVariantDetailSerializer(data=request.data)
         if serializer.is_valid():
@@ -323,6 +458,12 @@ class ShoeVariantListView(APIView):
             return Response(return_serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def put(self, request, shoe_id, format=None):
+        # updates a list of variants, each given by its id, in bulk
+        variants = ShoeVariant.objects.filter(shoe__id = shoe_id)
+        serializer = ShoeVariantBulkSerializer(list(variants), data=request.data, many=True, partial=True, context={"shoe_id" : shoe_id})
+        return self.save_batch(serializer, status.HTTP_200_OK)
+
 
 class ShoeVariantDetailView(APIView):
 
@@ -351,9 +492,10 @@ class CategoryListView(APIView):
     permission_classes = [IsAdminOrReadOnly]
 
     def get(self, request, format=None):
-        categories = Category.objects.filter(parent_id = None)
-        serializer = ParentCategoryListSerializer(categories, many=True)
-        return Response(serializer.data)
+        def get_response():
+            return Response(category_tree.get_serialized())
+
+        return conditional_get(request, ["categories"], get_response)
 
     def post(self, request, format=None):
         serializer = CategoryListSerializer(data=request.data)
@@ -389,7 +531,7 @@ class ShoeCategoryView(APIView):
     permission_classes = [IsAdminOrReadOnly]
 
     def get(self, request, shoe_id, format=None):
-        shoe_categories = ShoeCategory.objects.filter(shoe__id = shoe_id)
+        shoe_categories = ShoeCategory.objects.filter(shoe__id = shoe_id).select_related("category", "shoe")
         serializer = ShoeCategoryListSerializer(shoe_categories, many=True)
         return Response(serializer.data)
 
@@ -7,7 +7,7 @@ from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from shoes.utils import get_user_tokens
 from .permissions import IsCurrentUserOrAdmin
 from .models import User
-from .serializers import LoginUserSerializer, PasswordChangeSerializer, RegisterUserSerializer, UpdateUserSerializer, UserDetailSerializer, UserListSerializer
+from .serializers import LoginUserSerializer, PasswordChangeSerializer, RegisterUserSerializer, UpdateUserSerializer, UserDetailSerializer, UserListSerializer, UserListValuesSerializer
 
 # Create your views here.
 
@@ -29,8 +29,8 @@ class UserListView(APIView):
     permission_classes = [AllowAny]
 
     def get(self, request, format=None):
-        users = User.objects.all()
-        serializer = UserListSerializer(users, many=True)
+        users = UserListValuesSerializer.load_related(User.objects.all())
+        serializer = UserListValuesSerializer(users, many=True)
         return Response(serializer.data)
 
 class UserDetailView(APIView):